@@ -367,6 +367,13 @@ class LotAdmin(admin.ModelAdmin):
         "promotion_budget",
         "promotion_weight",
         "added_by",
+        "bid_book_current",
+        "bid_book_high_bidder",
+        "bid_book_max_bid",
+        "bid_book_second_bid",
+        "bid_book_last_bid_time",
+        "bid_book_reserve_price",
+        "bid_book_end",
     )
     readonly_fields = (
         "user",
@@ -463,6 +470,18 @@ class BidAdmin(admin.ModelAdmin):
         "user",
     )
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # Bid.save() only updates the bid book of the lot the bid is on now
+        if change and "lot_number" in form.changed_data:
+            Lot.objects.get(pk=form.initial["lot_number"]).update_bid_book()
+
+    def delete_queryset(self, request, queryset):
+        lots = list(Lot.objects.filter(pk__in=queryset.values("lot_number")))
+        super().delete_queryset(request, queryset)
+        for lot in lots:
+            lot.update_bid_book()
+
 
 class SoldLotInline(admin.TabularInline):
     fields = ["__str__"]
@@ -3,16 +3,22 @@ import datetime
 import json
 import logging
 import math
+import queue
+import threading
+import time
+from urllib.parse import parse_qs
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.db.models import Q
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
 from django.utils import timezone
 from post_office import mail
 
 from .models import (
+    Auction,
     AuctionTOS,
     Bid,
     ChatSubscription,
@@ -33,8 +39,19 @@ def check_bidding_permissions(lot, user):
     Returns false if everything is OK, or a string error message
     call check_all_permissions first
     """
+    return check_bidding_ended(lot) or check_bidder_permissions(lot, user)
+
+
+def check_bidding_ended(lot):
+    """Returns false if the lot is still open for bidding, or a string error message"""
     if lot.ended:
         return "Bidding on this lot has ended"
+    return False
+
+
+def check_bidder_permissions(lot, user):
+    """The part of check_bidding_permissions() that doesn't change over time, only when someone changes something.
+    Safe to cache, see LotConsumer.permission_error()"""
     if lot.user and lot.user.pk == user.pk:
         return "You can't bid on your own lot"
     if lot.auction:
@@ -97,6 +114,231 @@ def reset_lot_end_time(lot):
     return None
 
 
+def rank_bids(top_bids, bid):
+    """Merge `bid` into the two highest bids on a lot, returning the new two highest bids.
+    Bids can only go up, so the old top two plus the changed bid is all that's needed to find the new top two"""
+    bids = [other_bid for other_bid in top_bids if other_bid.pk != bid.pk]
+    bids.append(bid)
+    bids.sort(key=lambda b: (-b.amount, b.last_bid_time))
+    return bids[:2]
+
+
+class BidSideEffectQueue:
+    """Bookkeeping that has to happen because of a bid, but that doesn't change the price: interest tracking and UserData flags.
+    Jobs are queued when the bid's transaction commits, and run in order on a background thread, so the websocket reply doesn't wait for them.
+    The queue is only kept in memory, so anything still waiting is lost when the worker restarts.  Don't put anything here
+    that someone would miss, outbid emails are queued with post_office instead, see defer_outbid_notification().
+    depth and lag are logged, see metrics()"""
+
+    # log a warning when side effects fall this far behind the bid, in seconds
+    lag_warning = 5
+    # log the metrics every this many jobs
+    log_every = 100
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.last_lag = 0
+        self.max_lag = 0
+
+    def defer(self, func, *args):
+        """Run func(*args) after the current transaction commits.  Nothing runs if the bid is rolled back"""
+        queued_at = time.monotonic()
+        transaction.on_commit(lambda: self.put(queued_at, func, args))
+
+    def put(self, queued_at, func, args):
+        with self.lock:
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.worker, name="bid_side_effects", daemon=True)
+                self.thread.start()
+        self.queue.put((queued_at, func, args))
+
+    def worker(self):
+        while True:
+            queued_at, func, args = self.queue.get()
+            close_old_connections()
+            try:
+                func(*args)
+            except Exception as e:
+                self.failed += 1
+                logger.exception(e)
+            finally:
+                self.queue.task_done()
+            self.processed += 1
+            self.last_lag = time.monotonic() - queued_at
+            self.max_lag = max(self.max_lag, self.last_lag)
+            if self.last_lag > self.lag_warning:
+                logger.warning("bid side effects are %.1f seconds behind, %s queued", self.last_lag, self.depth)
+            if self.processed % self.log_every == 0:
+                logger.info("bid side effects: %s", self.metrics())
+
+    @property
+    def depth(self):
+        """Number of side effects waiting to run"""
+        return self.queue.qsize()
+
+    def metrics(self):
+        return {
+            "depth": self.depth,
+            "processed": self.processed,
+            "failed": self.failed,
+            "last_lag": round(self.last_lag, 3),
+            "max_lag": round(self.max_lag, 3),
+        }
+
+    def join(self):
+        """Block until everything queued so far has run"""
+        self.queue.join()
+
+
+bid_side_effects = BidSideEffectQueue()
+
+
+def record_bid_interest(user_pk, category_pk):
+    """Bidding on a lot means a user is interested in its category"""
+    interest, created = UserInterestCategory.objects.get_or_create(
+        category_id=category_pk,
+        user_id=user_pk,
+        defaults={"interest": settings.BID_WEIGHT},
+    )
+    if not created:
+        interest.interest = F("interest") + settings.BID_WEIGHT
+        interest.save()
+
+
+def record_bidder_flags(user_pk, used_proxy_bidding=False):
+    flags = {"has_bid": True}
+    if used_proxy_bidding:
+        flags["has_used_proxy_bidding"] = True
+    userdata, created = UserData.objects.get_or_create(user_id=user_pk, defaults=flags)
+    if not created:
+        UserData.objects.filter(pk=userdata.pk).update(**flags)
+
+
+def defer_outbid_notification(user_pk, lot_pk):
+    """Queue the outbid email once the bid commits.  post_office keeps it in the database until send_queued_mail sends it,
+    so unlike bid_side_effects it survives a restart.  A failure here is logged and doesn't affect the bid"""
+    transaction.on_commit(lambda: send_outbid_notification(user_pk, lot_pk), robust=True)
+
+
+def send_outbid_notification(user_pk, lot_pk):
+    user = User.objects.get(pk=user_pk)
+    lot = Lot.objects.get(pk=lot_pk)
+    current_site = Site.objects.get_current()
+    logger.debug("%s has been outbid!", user.username)
+    mail.send(
+        user.email,
+        template="outbid_notification",
+        context={
+            "name": user.first_name,
+            "domain": current_site.domain,
+            "lot": lot,
+        },
+    )
+
+
+class WebsocketRateLimiter:
+    """Token bucket per user, per lot, per kind of frame ("bid" or "chat"), limits are in settings.WEBSOCKET_RATE_LIMITS
+    Buckets are kept in the Redis that backs CHANNEL_LAYERS so that the limit holds across workers.
+    When the channel layer isn't Redis (tests, local dev without docker), buckets are kept in memory instead.
+    Rejections are counted in Redis as websocket_rate_limit_rejections:<kind>, see rejections()"""
+
+    # keeps the check and update atomic when several workers get frames from the same user at once
+    script = """
+        local capacity = tonumber(ARGV[1])
+        local rate = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local bucket = redis.call("HMGET", KEYS[1], "tokens", "timestamp")
+        local tokens = tonumber(bucket[1]) or capacity
+        local timestamp = tonumber(bucket[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        else
+            redis.call("INCR", KEYS[2])
+        end
+        redis.call("HSET", KEYS[1], "tokens", tokens, "timestamp", now)
+        redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+        return allowed
+    """
+
+    def __init__(self):
+        self.redis = None
+        self.local_buckets = {}
+        self.local_rejections = {}
+
+    def get_redis(self):
+        if self.redis is None:
+            layer = settings.CHANNEL_LAYERS.get("default", {})
+            if "redis" not in layer.get("BACKEND", "").lower():
+                return None
+            # imported here so that redis is only needed when the channel layer uses it
+            import redis.asyncio
+
+            host = layer["CONFIG"]["hosts"][0]
+            if isinstance(host, str):
+                self.redis = redis.asyncio.from_url(host)
+            else:
+                self.redis = redis.asyncio.Redis(host=host[0], port=host[1])
+        return self.redis
+
+    async def allow(self, kind, user_pk, lot_pk):
+        """True if this frame can be processed"""
+        limit = settings.WEBSOCKET_RATE_LIMITS.get(kind)
+        if not limit:
+            return True
+        key = f"websocket_rate_limit:{kind}:{user_pk}:{lot_pk}"
+        try:
+            connection = self.get_redis()
+            if connection:
+                allowed = await connection.eval(
+                    self.script,
+                    2,
+                    key,
+                    f"websocket_rate_limit_rejections:{kind}",
+                    limit["capacity"],
+                    limit["rate"],
+                    time.time(),
+                )
+                allowed = bool(allowed)
+            else:
+                allowed = self.allow_local(key, kind, limit)
+        except Exception as e:
+            # never block bidding because Redis is having a bad day
+            logger.exception(e)
+            return True
+        if not allowed:
+            logger.info("Rate limited %s frame from user %s on lot %s", kind, user_pk, lot_pk)
+        return allowed
+
+    def allow_local(self, key, kind, limit):
+        now = time.monotonic()
+        tokens, timestamp = self.local_buckets.get(key, (limit["capacity"], now))
+        tokens = min(limit["capacity"], tokens + (now - timestamp) * limit["rate"])
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        else:
+            self.local_rejections[kind] = self.local_rejections.get(kind, 0) + 1
+        self.local_buckets[key] = (tokens, now)
+        return allowed
+
+    async def rejections(self, kind):
+        """How many frames of this kind have been rejected, for monitoring"""
+        connection = self.get_redis()
+        if connection:
+            return int(await connection.get(f"websocket_rate_limit_rejections:{kind}") or 0)
+        return self.local_rejections.get(kind, 0)
+
+
+websocket_rate_limiter = WebsocketRateLimiter()
+
+
 def bid_on_lot(lot, user, amount):
     """
     Check permissions to make sure the user isn't banned before calling this function
@@ -109,309 +351,353 @@ def bid_on_lot(lot, user, amount):
         "high_bidder_name": 'user' # name of high bidder or None.  Used to update DOM
         "current_high_bid": 5 # current bid or None.  Can be the winning price.  Used to update DOM
         }
+
+    Bids on a single lot are serialized: the lot row is locked for the whole bid, and the bid, lot history and end time change are committed together.
+    `lot` is refreshed from the database.
     """
     try:
-        # if True:
         amount = int(amount)
-        result = {
-            "type": "ERROR",
-            "message": "Override this message",
-            "send_to": "user",
-            "high_bidder_pk": None,
-            "high_bidder_name": None,
-            "current_high_bid": None,
-            "winner": None,
-            "date_end": None,
-        }
-        if lot.ended:
-            result["message"] = "Bidding has ended"
+        with transaction.atomic():
+            lot.refresh_from_db(from_queryset=Lot.objects.select_for_update())
+            result = bid_on_locked_lot(lot, user, amount)
+            if result["send_to"] == "everyone":
+                # price changes also go to the lot list and tile pages for this auction
+                message = {
+                    "info": result["type"],
+                    "current_high_bid": result["current_high_bid"],
+                    "high_bidder_pk": result["high_bidder_pk"],
+                    "high_bidder_name": result["high_bidder_name"],
+                    "date_end": result["date_end"],
+                }
+                transaction.on_commit(lambda: lot.send_auction_websocket_message(message), robust=True)
             return result
-        if lot.bidding_error:
-            result["message"] = lot.bidding_error
+    except Exception as e:
+        logger.exception(e)
+
+
+def bid_on_locked_lot(lot, user, amount):
+    """Don't call this directly, use bid_on_lot() which takes the lock"""
+    result = {
+        "type": "ERROR",
+        "message": "Override this message",
+        "send_to": "user",
+        "high_bidder_pk": None,
+        "high_bidder_name": None,
+        "current_high_bid": None,
+        "winner": None,
+        "date_end": None,
+        "history_pk": None,
+    }
+    if lot.ended:
+        result["message"] = "Bidding has ended"
+        return result
+    if lot.bidding_error:
+        result["message"] = lot.bidding_error
+        return result
+    if lot.winner or lot.auctiontos_winner:
+        result["message"] = "This lot has already been sold"
+        return result
+    if lot.auction:
+        invoice = Invoice.objects.filter(auctiontos_user__user=user, auction=lot.auction).first()
+        if invoice and invoice.status != "DRAFT":
+            result["message"] = (
+                "Your invoice for this auction is not open.  An administrator can reopen it and allow you to bid."
+            )
             return result
-        if lot.winner or lot.auctiontos_winner:
-            result["message"] = "This lot has already been sold"
+    if lot.auction and not lot.auction.is_online and lot.auction.online_bidding == "buy_now_only" and lot.buy_now_price:
+        if amount < lot.buy_now_price:
+            result["message"] = "This auction does not allow bids, you can only buy this lot now."
             return result
-        if lot.auction:
-            invoice = Invoice.objects.filter(auctiontos_user__user=user, auction=lot.auction).first()
-            if invoice and invoice.status != "DRAFT":
-                result["message"] = (
-                    "Your invoice for this auction is not open.  An administrator can reopen it and allow you to bid."
-                )
-                return result
-        if (
-            lot.auction
-            and not lot.auction.is_online
-            and lot.auction.online_bidding == "buy_now_only"
-            and lot.buy_now_price
-        ):
-            if amount < lot.buy_now_price:
-                result["message"] = "This auction does not allow bids, you can only buy this lot now."
-                return result
-        originalHighBidder = lot.high_bidder
-        original_bid = lot.high_bid
-        bid, created = Bid.objects.get_or_create(
-            user=user,
-            lot_number=lot,
-            is_deleted=False,
-            defaults={"amount": amount},
-        )
-        # also update category interest, max one per bid
-        interest, interestCreated = UserInterestCategory.objects.get_or_create(
-            category=lot.species_category,
-            user=user,
-            defaults={"interest": settings.BID_WEIGHT},
-        )
-        userData, userdataCreated = UserData.objects.get_or_create(
-            user=user,
-            defaults={},
-        )
-        userData.has_bid = True
-        if userData.username_visible:
-            user_string = str(user)
-        else:
-            user_string = "Anonymous"
-        userData.save()
-        if not interestCreated:
-            interest.interest += settings.BID_WEIGHT
-            interest.save()
-        if lot.sealed_bid:
-            bid.was_high_bid = True
-            bid.amount = amount
-            bid.last_bid_time = timezone.now()
-            bid.save()
-            result["type"] = "INFO"
-            result["message"] = "Bid placed!  You can change your bid at any time until the auction ends"
-            result["send_to"] = "user"
-            # result["high_bidder_pk"] = user.pk
-            # result["high_bidder_name"] = str(user)
-            result["current_high_bid"] = bid.amount
+    if amount < lot.reserve_price:
+        result["message"] = f"You have to bid at least ${lot.reserve_price}"
+        return result
+    # the only read of the current bids; everything below works from these and the user's bid
+    top_bids = lot.top_bids
+    originalHighBidder = False
+    if top_bids and not lot.banned:
+        originalHighBidder = top_bids[0].user
+    original_bid = lot.price_from_top_bids(top_bids)
+    # the lot is locked, so this can't race with another bid by the same user
+    bid = Bid.objects.filter(user=user, lot_number=lot, is_deleted=False).first()
+    created = not bid
+    if created:
+        bid = Bid(user=user, lot_number=lot, amount=amount)
+        bid.save(update_bid_book=False)
+    # also update category interest, max one per bid
+    if lot.species_category_id:
+        bid_side_effects.defer(record_bid_interest, user.pk, lot.species_category_id)
+    bid_side_effects.defer(record_bidder_flags, user.pk)
+    username_visible = UserData.objects.filter(user=user).values_list("username_visible", flat=True).first()
+    if username_visible is False:
+        user_string = "Anonymous"
+    else:
+        user_string = str(user)
+    if lot.sealed_bid:
+        bid.was_high_bid = True
+        bid.amount = amount
+        bid.last_bid_time = timezone.now()
+        # sealed bids can go down, so let save() work out the top two from scratch
+        bid.save()
+        result["type"] = "INFO"
+        result["message"] = "Bid placed!  You can change your bid at any time until the auction ends"
+        result["send_to"] = "user"
+        # result["high_bidder_pk"] = user.pk
+        # result["high_bidder_name"] = str(user)
+        result["current_high_bid"] = bid.amount
+        return result
+    if not created:
+        if amount <= bid.amount:
+            result["message"] = f"Bid more than your current bid (${bid.amount})"
+            logger.debug("%s tried to bid on %s less than their original bid of $%s", user_string, lot, original_bid)
             return result
         else:
-            if not created:
-                if amount <= bid.amount:
-                    result["message"] = f"Bid more than your current bid (${bid.amount})"
-                    logger.debug(
-                        "%s tried to bid on %s less than their original bid of $%s", user_string, lot, original_bid
-                    )
-                    return result
-                else:
-                    bid.last_bid_time = timezone.now()
-                    bid.amount = amount
-                    # bid.amount now contains the actual bid, regardless of whether it was new or not
-                    # bid.save()
-            # no longer true: from here on, lot.high_bidder and lot.high_bid will include the current bid
-            if lot.buy_now_price and not originalHighBidder:
-                if bid.amount >= lot.buy_now_price:
-                    lot.winner = user
-                    if lot.auction:
-                        auctiontos_winner = AuctionTOS.objects.filter(auction=lot.auction, user=user).first()
-                        if auctiontos_winner:
-                            lot.auctiontos_winner = auctiontos_winner
-                            lot.create_update_invoices
-                    lot.winning_price = lot.buy_now_price
-                    lot.buy_now_used = True
-                    if lot.label_printed:
-                        lot.label_printed = False
-                        lot.label_needs_reprinting = True
-                    # this next line makes the lot end immediately after buy now is used
-                    # I have put it in and taken it out a few times now, it is controversial because it causes lots to "disappear" when sold
-                    # see also lot.ended - setting this is needed to make buy now lots go into invoices immediately
-                    lot.date_end = timezone.now()
-                    lot.watch_warning_email_sent = True
-                    lot.save()
-                    result["send_to"] = "everyone"
-                    result["high_bidder_pk"] = user.pk
-                    result["high_bidder_name"] = user_string
-                    result["type"] = "LOT_END_WINNER"
-                    result["message"] = f"{user_string} bought this lot now!!"
-                    result["current_high_bid"] = lot.buy_now_price
-                    bid.was_high_bid = True
-                    bid.last_bid_time = lot.date_end
-                    bid.save()
-                    LotHistory.objects.create(
-                        lot=lot,
-                        user=user,
-                        message=result["message"],
-                        changed_price=True,
-                        current_price=result["current_high_bid"],
-                        bid_amount=amount,
-                    )
-                    return result
-            if (not originalHighBidder) and (lot.high_bidder.pk == user.pk):
-                result["send_to"] = "everyone"
-                result["type"] = "NEW_HIGH_BIDDER"
-                result["message"] = f"{user} has placed the first bid on this lot"
-                result["current_high_bid"] = lot.reserve_price
-                result["high_bidder_pk"] = user.pk
-                result["high_bidder_name"] = user_string
-                bid.was_high_bid = True
-                LotHistory.objects.create(
-                    lot=lot,
-                    user=user,
-                    message=result["message"],
-                    changed_price=True,
-                    current_price=result["current_high_bid"],
-                    bid_amount=amount,
-                )
-                bid.last_bid_time = timezone.now()
-                bid.save()
-                return result
-            # bid increments - also set in views.py and in view_lot_images.html
-            next_allowed_amount = original_bid + max(math.floor(original_bid * 0.05), 1)
-            # if bid.amount <= original_bid:  # changing this to < would allow bumping without being the high bidder
-            if bid.amount < next_allowed_amount:
-                # there's a high bidder already
-                logger.debug("%s tried to bid on %s less than the current bid of $%s", user_string, lot, original_bid)
-                result["message"] = f"You have to bid at least ${next_allowed_amount}"
-                return result
-            if bid.amount > next_allowed_amount:
-                bid.save()
-                userData, userdataCreated = UserData.objects.get_or_create(
-                    user=user,
-                    defaults={},
-                )
-                userData.has_used_proxy_bidding = True
-                userData.save()
-            # if we get to this point, the user has bid >= the high bid
-            bid.was_high_bid = True
             bid.last_bid_time = timezone.now()
-            bid.save()
-            if lot.high_bidder.pk == user.pk:
-                try:
-                    if originalHighBidder.pk == lot.high_bidder.pk:
-                        # user is upping their own price, don't tell other people about it
-                        result["type"] = "INFO"
-                        result["message"] = f"You've raised your proxy bid to ${bid.amount}"
-                        logger.debug("%s has raised their bid on %s to $%s", user_string, lot, bid.amount)
-                        return result
-                except:
-                    pass
-                # New high bidder!  If we get to this point, the user has bid against someone else and changed the price
-                result["date_end"] = reset_lot_end_time(lot)
-                result["type"] = "NEW_HIGH_BIDDER"
-                result["message"] = f"{lot.high_bidder_display} is now the high bidder at ${lot.high_bid}"
-                if result["date_end"]:
-                    result["message"] += ". End time extended!"
-                result["high_bidder_pk"] = lot.high_bidder.pk
-                result["high_bidder_name"] = str(lot.high_bidder_display)
-                result["current_high_bid"] = lot.high_bid
-                result["send_to"] = "everyone"
-                # email the old one
-                current_site = Site.objects.get_current()
-                logger.debug("%s has been outbid!", originalHighBidder.username)
-                mail.send(
-                    originalHighBidder.email,
-                    template="outbid_notification",
-                    context={
-                        "name": originalHighBidder.first_name,
-                        "domain": current_site.domain,
-                        "lot": lot,
-                    },
-                )
-                LotHistory.objects.create(
-                    lot=lot,
-                    user=user,
-                    message=result["message"],
-                    changed_price=True,
-                    current_price=result["current_high_bid"],
-                    bid_amount=amount,
-                )
-                return result
-            # bumped up against a proxy bid
-            result["date_end"] = reset_lot_end_time(lot)
-            result["type"] = "NEW_HIGH_BID"
-            result["current_high_bid"] = lot.high_bid
-            result["message"] = (
-                f"{user_string} bumped the price up to ${lot.high_bid}.  {lot.high_bidder_display} is still the high bidder."
-            )
-            if result["date_end"]:
-                result["message"] += "  End time extended!"
+            bid.amount = amount
+            # bid.amount now contains the actual bid, regardless of whether it was new or not
+            # bid.save()
+    if lot.buy_now_price and not originalHighBidder:
+        if bid.amount >= lot.buy_now_price:
+            lot.winner = user
+            if lot.auction:
+                auctiontos_winner = AuctionTOS.objects.filter(auction=lot.auction, user=user).first()
+                if auctiontos_winner:
+                    lot.auctiontos_winner = auctiontos_winner
+                    lot.create_update_invoices
+            lot.winning_price = lot.buy_now_price
+            lot.buy_now_used = True
+            if lot.label_printed:
+                lot.label_printed = False
+                lot.label_needs_reprinting = True
+            # this next line makes the lot end immediately after buy now is used
+            # I have put it in and taken it out a few times now, it is controversial because it causes lots to "disappear" when sold
+            # see also lot.ended - setting this is needed to make buy now lots go into invoices immediately
+            lot.date_end = timezone.now()
+            lot.watch_warning_email_sent = True
+            lot.save()
             result["send_to"] = "everyone"
-            LotHistory.objects.create(
+            result["high_bidder_pk"] = user.pk
+            result["high_bidder_name"] = user_string
+            result["type"] = "LOT_END_WINNER"
+            result["message"] = f"{user_string} bought this lot now!!"
+            result["current_high_bid"] = lot.buy_now_price
+            bid.was_high_bid = True
+            bid.last_bid_time = lot.date_end
+            bid.save(update_bid_book=False)
+            lot.update_bid_book(rank_bids(top_bids, bid))
+            result["history_pk"] = LotHistory.objects.create(
                 lot=lot,
                 user=user,
                 message=result["message"],
                 changed_price=True,
                 current_price=result["current_high_bid"],
                 bid_amount=amount,
-            )
+            ).pk
             return result
-    except Exception as e:
-        logger.exception(e)
+    if not originalHighBidder:
+        result["send_to"] = "everyone"
+        result["type"] = "NEW_HIGH_BIDDER"
+        result["message"] = f"{user} has placed the first bid on this lot"
+        result["current_high_bid"] = lot.reserve_price
+        result["high_bidder_pk"] = user.pk
+        result["high_bidder_name"] = user_string
+        bid.was_high_bid = True
+        result["history_pk"] = LotHistory.objects.create(
+            lot=lot,
+            user=user,
+            message=result["message"],
+            changed_price=True,
+            current_price=result["current_high_bid"],
+            bid_amount=amount,
+        ).pk
+        bid.last_bid_time = timezone.now()
+        bid.save(update_bid_book=False)
+        lot.update_bid_book(rank_bids(top_bids, bid))
+        return result
+    # bid increments - also set in views.py and in view_lot_images.html
+    next_allowed_amount = original_bid + max(math.floor(original_bid * 0.05), 1)
+    # if bid.amount <= original_bid:  # changing this to < would allow bumping without being the high bidder
+    if bid.amount < next_allowed_amount:
+        # there's a high bidder already
+        logger.debug("%s tried to bid on %s less than the current bid of $%s", user_string, lot, original_bid)
+        result["message"] = f"You have to bid at least ${next_allowed_amount}"
+        if created:
+            # the new bid was saved above and still counts, even though it didn't change the price
+            lot.update_bid_book(rank_bids(top_bids, bid))
+        return result
+    if bid.amount > next_allowed_amount:
+        bid_side_effects.defer(record_bidder_flags, user.pk, True)
+    # if we get to this point, the user has bid >= the high bid
+    bid.was_high_bid = True
+    bid.last_bid_time = timezone.now()
+    bid.save(update_bid_book=False)
+    top_bids = rank_bids(top_bids, bid)
+    lot.update_bid_book(top_bids)
+    high_bidder = top_bids[0].user
+    new_price = lot.price_from_top_bids(top_bids)
+    if high_bidder.pk == user.pk:
+        if originalHighBidder.pk == high_bidder.pk:
+            # user is upping their own price, don't tell other people about it
+            result["type"] = "INFO"
+            result["message"] = f"You've raised your proxy bid to ${bid.amount}"
+            logger.debug("%s has raised their bid on %s to $%s", user_string, lot, bid.amount)
+            return result
+        # New high bidder!  If we get to this point, the user has bid against someone else and changed the price
+        result["date_end"] = reset_lot_end_time(lot)
+        result["type"] = "NEW_HIGH_BIDDER"
+        result["message"] = f"{user_string} is now the high bidder at ${new_price}"
+        if result["date_end"]:
+            result["message"] += ". End time extended!"
+        result["high_bidder_pk"] = high_bidder.pk
+        result["high_bidder_name"] = user_string
+        result["current_high_bid"] = new_price
+        result["send_to"] = "everyone"
+        # email the old one
+        defer_outbid_notification(originalHighBidder.pk, lot.pk)
+        result["history_pk"] = LotHistory.objects.create(
+            lot=lot,
+            user=user,
+            message=result["message"],
+            changed_price=True,
+            current_price=result["current_high_bid"],
+            bid_amount=amount,
+        ).pk
+        return result
+    # bumped up against a proxy bid
+    if high_bidder.userdata.username_visible:
+        high_bidder_string = str(high_bidder)
+    else:
+        high_bidder_string = "Anonymous"
+    result["date_end"] = reset_lot_end_time(lot)
+    result["type"] = "NEW_HIGH_BID"
+    result["current_high_bid"] = new_price
+    result["message"] = (
+        f"{user_string} bumped the price up to ${new_price}.  {high_bidder_string} is still the high bidder."
+    )
+    if result["date_end"]:
+        result["message"] += "  End time extended!"
+    result["send_to"] = "everyone"
+    result["history_pk"] = LotHistory.objects.create(
+        lot=lot,
+        user=user,
+        message=result["message"],
+        changed_price=True,
+        current_price=result["current_high_bid"],
+        bid_amount=amount,
+    ).pk
+    return result
+
 
+class LotConsumer(AsyncWebsocketConsumer):
+    """Bidding and chat for a single lot.
+    This is async so that idle lot pages don't each hold a worker thread; all ORM work goes through database_sync_to_async"""
 
-class LotConsumer(WebsocketConsumer):
-    def connect(self):
+    async def connect(self):
         try:
             self.lot_number = self.scope["url_route"]["kwargs"]["lot_number"]
             self.user = self.scope["user"]
             self.room_group_name = f"lot_{self.lot_number}"
             self.user_room_name = f"private_user_{self.user.pk}_lot_{self.lot_number}"
-            self.lot = Lot.objects.get(pk=self.lot_number)
+            self.lot = await self.get_lot()
+            # outcome of the permission checks, keyed by check.  See permission_error()
+            self.permission_cache = {}
+            self.permissions_room_name = f"permissions_user_{self.user.pk}"
+            self.auction_permissions_room_name = f"permissions_auction_{self.lot.auction_id}"
 
             # Join room group
-            async_to_sync(self.channel_layer.group_add)(self.room_group_name, self.channel_name)
+            await self.channel_layer.group_add(self.room_group_name, self.channel_name)
 
             # Join private room for notifications only to this user
-            async_to_sync(self.channel_layer.group_add)(self.user_room_name, self.channel_name)
-            self.accept()
-            # send the most recent history
-            allHistory = LotHistory.objects.filter(lot=self.lot, removed=False).order_by("-timestamp")[:200]
-            # send oldest first
-            for history in reversed(allHistory):
+            await self.channel_layer.group_add(self.user_room_name, self.channel_name)
+            if self.user.pk:
+                # bans and auction approvals for this user
+                await self.channel_layer.group_add(self.permissions_room_name, self.channel_name)
+            if self.lot.auction_id:
+                # online bidding being turned on or off
+                await self.channel_layer.group_add(self.auction_permissions_room_name, self.channel_name)
+            await self.accept()
+            # a reconnecting client passes the last history_pk it saw, and only gets what it missed
+            since = parse_qs(self.scope.get("query_string", b"").decode()).get("since", [None])[0]
+            since = int(since) if since and since.isdigit() else None
+            messages = await self.get_history_messages(since)
+            if not since:
                 try:
-                    if history.changed_price:
-                        pk = -1
-                        username = "System"
-                    else:
-                        pk = history.user.pk
-                        username = str(history.user)
-
-                    async_to_sync(self.channel_layer.group_send)(
-                        self.user_room_name,
-                        {
-                            "type": "chat_message",
-                            "pk": pk,
-                            "info": "CHAT",
-                            "message": history.message,
-                            "username": username,
-                        },
-                    )
+                    owner_chat_notifications = await self.get_owner_chat_notifications()
+                    if not owner_chat_notifications:
+                        messages.append(
+                            {
+                                "pk": -1,
+                                "info": "CHAT",
+                                "message": "The creator of this lot has turned off email notifications when chat messages are posted.  You may not get a reply.",
+                                "username": "System",
+                            }
+                        )
                 except Exception as e:
                     logger.exception(e)
-            try:
-                owner_chat_notifications = False
-                if self.lot.user:
-                    subscription, created = ChatSubscription.objects.get_or_create(
-                        user=self.lot.user,
-                        lot=self.lot,
-                        defaults={
-                            "unsubscribed": not self.lot.user.userdata.email_me_when_people_comment_on_my_lots,
-                        },
-                    )
-                    if not subscription.unsubscribed:
-                        owner_chat_notifications = True
-                if not owner_chat_notifications:
-                    async_to_sync(self.channel_layer.group_send)(
-                        self.user_room_name,
-                        {
-                            "type": "chat_message",
-                            "pk": -1,
-                            "info": "CHAT",
-                            "message": "The creator of this lot has turned off email notifications when chat messages are posted.  You may not get a reply.",
-                            "username": "System",
-                        },
-                    )
-            except Exception as e:
-                logger.exception(e)
+            # the whole history goes out as one frame straight to this socket
+            await self.send(text_data=json.dumps({"type": "history", "messages": messages}))
 
         except Exception as e:
             logger.exception(e)
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         # Leave room group
-        async_to_sync(self.channel_layer.group_discard)(self.room_group_name, self.channel_name)
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        await self.channel_layer.group_discard(self.user_room_name, self.channel_name)
+        await self.channel_layer.group_discard(self.permissions_room_name, self.channel_name)
+        await self.channel_layer.group_discard(self.auction_permissions_room_name, self.channel_name)
+        await self.mark_chats_seen()
+
+    @database_sync_to_async
+    def get_lot(self):
+        return Lot.objects.select_related("user", "auction", "auctiontos_seller").get(pk=self.lot_number)
+
+    @database_sync_to_async
+    def get_history_messages(self, since=None):
+        """The most recent chat and bid history for this lot, oldest first.
+        Pass since (a LotHistory pk) to get only newer messages"""
+        messages = []
+        allHistory = LotHistory.objects.filter(lot=self.lot, removed=False).select_related("user")
+        if since:
+            allHistory = allHistory.filter(pk__gt=since)
+        allHistory = allHistory.order_by("-timestamp", "-pk")[:200]
+        for history in reversed(allHistory):
+            try:
+                if history.changed_price:
+                    pk = -1
+                    username = "System"
+                else:
+                    pk = history.user.pk
+                    username = str(history.user)
+                messages.append(
+                    {
+                        "pk": pk,
+                        "info": "CHAT",
+                        "message": history.message,
+                        "username": username,
+                        "history_pk": history.pk,
+                    }
+                )
+            except Exception as e:
+                logger.exception(e)
+        return messages
+
+    @database_sync_to_async
+    def get_owner_chat_notifications(self):
+        """True if the creator of this lot will get an email about new chat messages"""
+        if self.lot.user:
+            subscription, created = ChatSubscription.objects.get_or_create(
+                user=self.lot.user,
+                lot=self.lot,
+                defaults={
+                    "unsubscribed": not self.lot.user.userdata.email_me_when_people_comment_on_my_lots,
+                },
+            )
+            if not subscription.unsubscribed:
+                return True
+        return False
+
+    @database_sync_to_async
+    def mark_chats_seen(self):
         # bit redundant, but 'seen' is used for lot notifications for the owner of a given lot
         user_pk = None
         if self.lot.user:
@@ -430,104 +716,125 @@ class LotConsumer(WebsocketConsumer):
                 existing_subscription.last_notification_sent = timezone.now()
                 existing_subscription.save()
 
+    @database_sync_to_async
+    def create_chat_history(self, message):
+        return LotHistory.objects.create(
+            lot=self.lot,
+            user=self.user,
+            message=message,
+            changed_price=False,
+            current_price=self.lot.high_bid,
+        )
+
     # Receive message from WebSocket
-    def receive(self, text_data):
+    async def receive(self, text_data):
         text_data_json = json.loads(text_data)
         if self.user.is_authenticated:
             try:
-                error = check_all_permissions(self.lot, self.user)
+                for kind, key in [("chat", "message"), ("bid", "bid")]:
+                    if key in text_data_json and not await websocket_rate_limiter.allow(
+                        kind, self.user.pk, self.lot_number
+                    ):
+                        await self.error_message({"error": "You're going too fast, wait a few seconds and try again"})
+                        return
+                error = await self.permission_error(check_all_permissions)
                 if error:
-                    async_to_sync(self.channel_layer.group_send)(
-                        self.user_room_name, {"type": "error_message", "error": error}
-                    )
+                    await self.channel_layer.group_send(self.user_room_name, {"type": "error_message", "error": error})
                 else:
-                    try:
-                        message = text_data_json["message"]
-                        error = check_chat_permissions(self.lot, self.user)
-                        if error:
-                            async_to_sync(self.channel_layer.group_send)(
-                                self.user_room_name,
-                                {"type": "error_message", "error": error},
-                            )
-                        else:
-                            if True:
-                                LotHistory.objects.create(
-                                    lot=self.lot,
-                                    user=self.user,
-                                    message=message,
-                                    changed_price=False,
-                                    current_price=self.lot.high_bid,
-                                )
-                            async_to_sync(self.channel_layer.group_send)(
-                                self.room_group_name,
-                                {
-                                    "type": "chat_message",
-                                    "info": "CHAT",
-                                    "message": message,
-                                    "pk": self.user.pk,
-                                    "username": str(self.user),
-                                },
-                            )
-                    except:
-                        pass
-                    try:
-                        # handle bids
-                        amount = text_data_json["bid"]
-                        error = check_bidding_permissions(self.lot, self.user)
-                        if error:
-                            async_to_sync(self.channel_layer.group_send)(
-                                self.user_room_name,
-                                {"type": "error_message", "error": error},
-                            )
-                        else:
-                            result = bid_on_lot(self.lot, self.user, amount)
-                            if result["send_to"] == "user":
-                                if result["type"] == "ERROR":
-                                    async_to_sync(self.channel_layer.group_send)(
-                                        self.user_room_name,
-                                        {
-                                            "type": "error_message",
-                                            "error": result["message"],
-                                        },
-                                    )
-                                else:
-                                    # I think just the sealed bid success and upping your own bids go here
-                                    async_to_sync(self.channel_layer.group_send)(
-                                        self.user_room_name,
-                                        {
-                                            "type": "chat_message",
-                                            "info": result["type"],
-                                            "message": result["message"],
-                                            "high_bidder_pk": result["high_bidder_pk"],
-                                            "high_bidder_name": result["high_bidder_name"],
-                                            "current_high_bid": result["current_high_bid"],
-                                        },
-                                    )
-                            else:
-                                async_to_sync(self.channel_layer.group_send)(
-                                    self.room_group_name,
-                                    {
-                                        "type": "chat_message",
-                                        "info": result["type"],
-                                        "message": result["message"],
-                                        "high_bidder_pk": result["high_bidder_pk"],
-                                        "high_bidder_name": result["high_bidder_name"],
-                                        "current_high_bid": result["current_high_bid"],
-                                        "date_end": result["date_end"],
-                                    },
-                                )
-                    except:
-                        pass
+                    if "message" in text_data_json:
+                        await self.receive_chat(text_data_json["message"])
+                    if "bid" in text_data_json:
+                        await self.receive_bid(text_data_json["bid"])
             except Exception as e:
                 logger.exception(e)
+
+    async def receive_chat(self, message):
+        error = await database_sync_to_async(check_chat_permissions)(self.lot, self.user)
+        if error:
+            await self.channel_layer.group_send(
+                self.user_room_name,
+                {"type": "error_message", "error": error},
+            )
+        else:
+            history = await self.create_chat_history(message)
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    "type": "chat_message",
+                    "info": "CHAT",
+                    "message": message,
+                    "pk": self.user.pk,
+                    "username": str(self.user),
+                    "history_pk": history.pk,
+                },
+            )
+
+    async def receive_bid(self, amount):
+        error = await database_sync_to_async(check_bidding_ended)(self.lot)
+        if not error:
+            error = await self.permission_error(check_bidder_permissions)
+        if error:
+            await self.channel_layer.group_send(
+                self.user_room_name,
+                {"type": "error_message", "error": error},
+            )
+            return
+        result = await database_sync_to_async(bid_on_lot)(self.lot, self.user, amount)
+        if not result:
+            return
+        if result["send_to"] == "user":
+            if result["type"] == "ERROR":
+                await self.channel_layer.group_send(
+                    self.user_room_name,
+                    {
+                        "type": "error_message",
+                        "error": result["message"],
+                    },
+                )
+            else:
+                # I think just the sealed bid success and upping your own bids go here
+                await self.channel_layer.group_send(
+                    self.user_room_name,
+                    {
+                        "type": "chat_message",
+                        "info": result["type"],
+                        "message": result["message"],
+                        "high_bidder_pk": result["high_bidder_pk"],
+                        "high_bidder_name": result["high_bidder_name"],
+                        "current_high_bid": result["current_high_bid"],
+                    },
+                )
         else:
-            pass
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    "type": "chat_message",
+                    "info": result["type"],
+                    "message": result["message"],
+                    "high_bidder_pk": result["high_bidder_pk"],
+                    "high_bidder_name": result["high_bidder_name"],
+                    "current_high_bid": result["current_high_bid"],
+                    "date_end": result["date_end"],
+                    "history_pk": result["history_pk"],
+                },
+            )
+
+    async def permission_error(self, check):
+        """Run check(lot, user), or return what it returned last time on this connection"""
+        if check.__name__ not in self.permission_cache:
+            self.permission_cache[check.__name__] = await database_sync_to_async(check)(self.lot, self.user)
+        return self.permission_cache[check.__name__]
+
+    async def permissions_changed(self, event):
+        """A ban, an auction approval, online bidding being turned off, or this lot being removed.  See models.send_permissions_changed()"""
+        self.permission_cache = {}
+        self.lot = await self.get_lot()
 
     # Send a toast error to a single user
-    def error_message(self, event):
+    async def error_message(self, event):
         error = event["error"]
         # Send error to WebSocket
-        self.send(
+        await self.send(
             text_data=json.dumps(
                 {
                     "error": error,
@@ -536,11 +843,42 @@ class LotConsumer(WebsocketConsumer):
         )
 
     # Receive message from room group
-    def chat_message(self, event):
-        self.send(text_data=json.dumps(event))
+    async def chat_message(self, event):
+        await self.send(text_data=json.dumps(event))
+
+
+class AuctionConsumer(AsyncWebsocketConsumer):
+    """Price, high bidder and end time changes for every lot in an auction, so the lot list and tile pages don't need reloading.
+    This is read only, see Lot.send_auction_websocket_message() for what gets sent"""
+
+    room_group_name = None
+
+    async def connect(self):
+        try:
+            auction_pk = await self.get_auction_pk(self.scope["url_route"]["kwargs"]["slug"])
+            if not auction_pk:
+                await self.close()
+                return
+            self.room_group_name = f"auction_{auction_pk}"
+            await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+            await self.accept()
+        except Exception as e:
+            logger.exception(e)
+            await self.close()
+
+    async def disconnect(self, close_code):
+        if self.room_group_name:
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+
+    @database_sync_to_async
+    def get_auction_pk(self, slug):
+        return Auction.objects.filter(slug=slug, is_deleted=False).values_list("pk", flat=True).first()
+
+    async def lot_delta(self, event):
+        await self.send(text_data=json.dumps(event))
 
 
-class UserConsumer(WebsocketConsumer):
+class UserConsumer(AsyncWebsocketConsumer):
     """This is ready to use and corresponding code to connect added (commented out) to base.html
     You can use userdata.send_websocket_message to message the user, like this:
         result = {
@@ -552,39 +890,39 @@ class UserConsumer(WebsocketConsumer):
     but at this time it does not seem like a good idea
     """
 
-    def connect(self):
+    async def connect(self):
         try:
             self.pk = self.scope["url_route"]["kwargs"]["user_pk"]
-            user_for = User.objects.filter(pk=self.pk).first()
+            user_for = await database_sync_to_async(User.objects.filter(pk=self.pk).first)()
             self.user = self.scope["user"]
             self.user_notification_channel = f"user_{self.pk}"
             if not user_for or user_for != self.user:
-                self.close()
+                await self.close()
             else:
-                self.accept()
+                await self.accept()
                 # Add to the group after accepting the connection
-                async_to_sync(self.channel_layer.group_add)(self.user_notification_channel, self.channel_name)
+                await self.channel_layer.group_add(self.user_notification_channel, self.channel_name)
 
                 # Send a message after accepting the connection
-                # async_to_sync(self.channel_layer.group_send)(
+                # await self.channel_layer.group_send(
                 #     self.user_notification_channel,
                 #     {"type": "toast", "message": 'Welcome!', 'bg': 'success'},
                 # )
         except Exception as e:
             logger.exception(e)
-            self.close()
+            await self.close()
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         # Leave room group
-        async_to_sync(self.channel_layer.group_discard)(self.user_notification_channel, self.channel_name)
+        await self.channel_layer.group_discard(self.user_notification_channel, self.channel_name)
         logger.debug("disconnected")
 
     # Receive message from WebSocket
-    def receive(self, text_data):
+    async def receive(self, text_data):
         text_data_json = json.loads(text_data)
         logger.info(text_data_json)
 
-    def toast(self, event):
+    async def toast(self, event):
         message = event["message"]
         bg = event.get("bg", "info")
-        self.send(text_data=json.dumps({"type": "toast", "message": message, "bg": bg}))
+        await self.send(text_data=json.dumps({"type": "toast", "message": message, "bg": bg}))
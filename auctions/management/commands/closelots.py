@@ -0,0 +1,154 @@
+import asyncio
+import heapq
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.db.models import Q
+
+from auctions.models import LOT_CLOSING_CHANNEL, Lot
+
+from .endauctions import declare_winners_on_lots
+
+logger = logging.getLogger(__name__)
+
+
+class LotClosingScheduler:
+    """Active lots in a heap ordered by the next thing that has to happen to them: the "ending very soon" warning a minute before date_end, and closing at date_end.
+    Lots whose end time changes are rescheduled by messages sent from Lot.save(), see send_lot_end_changed().
+    Old heap entries aren't removed when a lot is rescheduled, they're skipped when they come up because self.date_ends no longer matches them.
+    closing latency (date_end to closed) and lag (how late the scheduler woke up) are logged, see metrics()"""
+
+    # send the "ending very soon" warning this many seconds before a lot ends, see Lot.ending_very_soon
+    warning = 59
+    # reload every active lot from the database this often, in case a message was missed
+    reload_every = 600
+    # log the metrics this often, in seconds
+    log_every = 300
+    # log a warning when lots are closed this many seconds late
+    latency_warning = 5
+
+    def __init__(self):
+        self.heap = []
+        self.date_ends = {}
+        self.next_reload = 0
+        self.next_log = time.time() + self.log_every
+        self.closed = 0
+        self.warned = 0
+        self.last_latency = 0
+        self.max_latency = 0
+        self.last_lag = 0
+        self.max_lag = 0
+
+    def schedule(self, lot_pk, date_end):
+        """date_end is a timestamp"""
+        if self.date_ends.get(lot_pk) == date_end:
+            return
+        self.date_ends[lot_pk] = date_end
+        if date_end - self.warning > time.time():
+            heapq.heappush(self.heap, (date_end - self.warning, lot_pk, date_end))
+        heapq.heappush(self.heap, (date_end, lot_pk, date_end))
+
+    def load(self):
+        """Schedule every lot that endauctions would look at, skipping lots in in-person auctions as they don't end on their own"""
+        self.heap = []
+        self.date_ends = {}
+        lots = (
+            Lot.objects.filter(active=True, is_deleted=False, banned=False, deactivated=False, date_end__isnull=False)
+            .filter(Q(auction__isnull=True) | Q(auction__is_online=True))
+            .values_list("pk", "date_end")
+        )
+        for lot_pk, date_end in lots:
+            self.schedule(lot_pk, date_end.timestamp())
+        self.next_reload = time.time() + self.reload_every
+        logger.info("%s lots scheduled to close", len(self.date_ends))
+
+    def seconds_until_next(self):
+        next_time = self.next_reload
+        if self.heap:
+            next_time = min(next_time, self.heap[0][0])
+        return max(0, next_time - time.time())
+
+    def run_due(self):
+        """Close or warn every lot that's due.  declare_winners_on_lots() does the work, it knows whether a lot has ended or is just ending soon"""
+        now = time.time()
+        due = {}
+        while self.heap and self.heap[0][0] <= now:
+            when, lot_pk, date_end = heapq.heappop(self.heap)
+            if self.date_ends.get(lot_pk) != date_end:
+                # rescheduled since this was pushed
+                continue
+            self.last_lag = now - when
+            self.max_lag = max(self.max_lag, self.last_lag)
+            due[lot_pk] = date_end
+        if due:
+            lots = Lot.objects.filter(pk__in=due, active=True, is_deleted=False, banned=False, deactivated=False)
+            declare_winners_on_lots(lots)
+            still_active = dict(Lot.objects.filter(pk__in=due, active=True).values_list("pk", "date_end"))
+            closed_at = time.time()
+            for lot_pk, date_end in due.items():
+                if lot_pk not in still_active:
+                    self.date_ends.pop(lot_pk, None)
+                    if date_end <= now:
+                        self.closed += 1
+                        self.last_latency = closed_at - date_end
+                        self.max_latency = max(self.max_latency, self.last_latency)
+                elif still_active[lot_pk] and still_active[lot_pk].timestamp() > now:
+                    # warned, or extended by a last minute bid
+                    if date_end > now:
+                        self.warned += 1
+                    self.schedule(lot_pk, still_active[lot_pk].timestamp())
+                else:
+                    # something went wrong closing this lot, leave it for endauctions
+                    self.date_ends.pop(lot_pk, None)
+            if self.last_latency > self.latency_warning:
+                logger.warning("lots are closing %.1f seconds late", self.last_latency)
+        if now > self.next_log:
+            logger.info("lot closing: %s", self.metrics())
+            self.next_log = now + self.log_every
+
+    def metrics(self):
+        return {
+            "scheduled": len(self.date_ends),
+            "closed": self.closed,
+            "warned": self.warned,
+            "last_latency": round(self.last_latency, 3),
+            "max_latency": round(self.max_latency, 3),
+            "last_lag": round(self.last_lag, 3),
+            "max_lag": round(self.max_lag, 3),
+        }
+
+    async def run(self):
+        channel_layer = get_channel_layer()
+        while True:
+            try:
+                message = await asyncio.wait_for(
+                    channel_layer.receive(LOT_CLOSING_CHANNEL), timeout=self.seconds_until_next()
+                )
+                self.schedule(message["lot"], message["date_end"])
+            except asyncio.TimeoutError:
+                pass
+            except Exception as e:
+                # a Redis error shouldn't stop lots from closing, they're still found by load() and run_due() below
+                logger.exception(e)
+                await asyncio.sleep(1)
+            try:
+                # this runs for days, and the database will drop idle connections
+                await database_sync_to_async(close_old_connections)()
+                if time.time() >= self.next_reload:
+                    await database_sync_to_async(self.load)()
+                await database_sync_to_async(self.run_due)()
+            except Exception as e:
+                logger.exception(e)
+                # don't spin if the database is down
+                await asyncio.sleep(1)
+
+
+class Command(BaseCommand):
+    help = "Runs forever, closing lots at the moment they end.  endauctions is still run by cron to pick up anything this misses; lots are claimed before they're closed, so both can run at once"
+
+    def handle(self, *args, **options):
+        asyncio.run(LotClosingScheduler().run())
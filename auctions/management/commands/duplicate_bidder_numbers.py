@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from auctions.models import Auction, AuctionTOS, BidderNumberAllocator
+
+
+class Command(BaseCommand):
+    help = "List people who share a bidder number in the same auction.  The unique constraint on bidder numbers can't be added until these are fixed. \
+        Check the list with the auctions' admins first, these are real people and bidder numbers are printed on their invoices and lot labels"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            help="Give a new bidder number to everyone except the first person who joined with each shared number",
+        )
+
+    def handle(self, *args, **options):
+        duplicates = (
+            AuctionTOS.objects.values("auction", "bidder_number")
+            .annotate(count=Count("pk"))
+            .filter(count__gt=1)
+            .order_by()
+        )
+        shared = {}
+        for duplicate in duplicates:
+            shared.setdefault(duplicate["auction"], []).append(duplicate["bidder_number"])
+        if not shared:
+            self.stdout.write("No bidder numbers are shared")
+            return
+        renumbered = []
+        # only() here and below, this is run before the migration that adds the constraint and any after it
+        for auction in Auction.objects.filter(pk__in=shared).only("pk", "title", "slug", "created_by").order_by("pk"):
+            allocator = BidderNumberAllocator(auction)
+            sharing = (
+                AuctionTOS.objects.filter(auction=auction, bidder_number__in=shared[auction.pk])
+                .only("pk", "name", "email", "bidder_number", "createdon")
+                .order_by("bidder_number", "createdon", "pk")
+            )
+            first = None
+            for tos in sharing:
+                if first is None or first.bidder_number != tos.bidder_number:
+                    first = tos
+                    self.stdout.write(f"{auction.slug}: {tos.name} ({tos.email}) has bidder number {tos.bidder_number}")
+                elif options["fix"]:
+                    tos.bidder_number = allocator.random_number()
+                    allocator.used.add(tos.bidder_number)
+                    renumbered.append(tos)
+                    self.stdout.write(
+                        f"{auction.slug}: {tos.name} ({tos.email}) now has bidder number {tos.bidder_number}"
+                    )
+                else:
+                    self.stdout.write(
+                        f"{auction.slug}: {tos.name} ({tos.email}) also has bidder number {tos.bidder_number}"
+                    )
+        if options["fix"]:
+            AuctionTOS.objects.bulk_update(renumbered, ["bidder_number"], batch_size=500)
+            self.stdout.write(f"Renumbered {len(renumbered)} people")
+        else:
+            self.stdout.write(
+                "Nothing was changed, run this again with --fix to renumber everyone listed as also having a number"
+            )
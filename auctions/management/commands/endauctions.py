@@ -1,154 +1,359 @@
+import asyncio
 import datetime
 import logging
 
+import channels.layers
+from asgiref.sync import async_to_sync
 from django.contrib.sites.models import Site
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+from django.db.models.query import QuerySet
 from django.utils import timezone
 from easy_thumbnails.files import get_thumbnailer
 from post_office import mail
 
-from auctions.models import Lot, LotHistory, LotImage
+from auctions.models import (
+    AuctionTOS,
+    Bid,
+    Invoice,
+    Lot,
+    LotHistory,
+    LotImage,
+    mark_invoices_for_recalculation,
+)
 
 logger = logging.getLogger(__name__)
 
 
 def declare_winners_on_lots(lots):
-    """Set the winner and winning price on all lots"""
+    """Set the winner and winning price on all ended lots, and warn people watching lots that are about to end.
+    Lots that are part of an auction are closed together, see close_auction_lots().  Every lot is claimed before it's closed, see claim_lots()"""
+    if isinstance(lots, QuerySet):
+        lots = lots.select_related("auction", "bid_book_high_bidder__userdata")
+    auction_lots = []
+    messages = []
     for lot in lots:
         if lot.ended:
-            # note - lots that are part of in-person auctions will not get here
-            # if they are active, they always have lot.ended = False, and if they are sold,
-            # the method that sells them should set active=False, so they won't be filtered here
-            # But, see https://github.com/iragm/fishauctions/issues/116
-            try:
-                lot.active = False
-                # lots with a winner or auctiontos winner and winning price are "sold"
-                if lot.sold:
-                    # lots will be bought via buy now will get here
-                    # as well as in-person auction lots whose winner has been set manually
-                    # We still need to make those active=False, done above, and then save, below
-                    # I don't think the above is true anymore, lots bought with buy now should also be made inactive
-                    pass
-                else:
-                    info = None
-                    if lot.high_bidder:
-                        lot.sell_to_online_high_bidder
-                        info = "LOT_END_WINNER"
-                        bidder = lot.high_bidder
-                        high_bidder_pk = lot.high_bidder.pk
-                        high_bidder_name = str(lot.high_bidder_display)
-                        current_high_bid = lot.high_bid
-                        message = f"Won by {lot.high_bidder_display}"
-                    # at this point, the lot should have a winner filled out if it's sold.  If it still doesn't:
-                    if not lot.sold:
-                        high_bidder_pk = None
-                        high_bidder_name = None
-                        current_high_bid = None
-                        message = "This lot did not sell"
-                        bidder = None
-                        info = "ENDED_NO_WINNER"
-                    result = {
-                        "type": "chat_message",
-                        "info": info,
-                        "message": message,
-                        "high_bidder_pk": high_bidder_pk,
-                        "high_bidder_name": high_bidder_name,
-                        "current_high_bid": current_high_bid,
-                    }
-                    if info:
-                        lot.send_websocket_message(result)
-                        LotHistory.objects.create(
-                            lot=lot,
-                            user=bidder,
-                            message=message,
-                            changed_price=True,
-                            current_price=lot.high_bid,
-                        )
-                lot.create_update_invoices
-                # logic to email winner and buyer for lots not in an auction
-                if lot.winner and not lot.auction:
-                    current_site = Site.objects.get_current()
-                    # email the winner first
-                    mail.send(
-                        lot.winner.email,
-                        headers={"Reply-to": lot.user.email},
-                        template="non_auction_lot_winner",
-                        context={"lot": lot, "domain": current_site.domain},
-                    )
-                    # now, email the seller
-                    mail.send(
-                        lot.user.email,
-                        headers={"Reply-to": lot.winner.email},
-                        template="non_auction_lot_seller",
-                        context={"lot": lot, "domain": current_site.domain},
-                    )
-                # automatic relisting of lots
-                relist = False
-                sendNoRelistWarning = False
-                if not lot.auction:
-                    if lot.winner and lot.relist_if_sold and (not lot.relist_countdown):
-                        sendNoRelistWarning = True
-                    if (not lot.winner) and lot.relist_if_not_sold and (not lot.relist_countdown):
-                        sendNoRelistWarning = True
-                    if lot.winner and lot.relist_if_sold and lot.relist_countdown:
-                        lot.relist_countdown -= 1
-                        relist = True
-                    if (not lot.winner) and lot.relist_if_not_sold and lot.relist_countdown:
-                        # no need to relist unsold lots, just decrement the countdown
-                        lot.relist_countdown -= 1
-                        lot.date_end = timezone.now() + datetime.timedelta(days=lot.lot_run_duration)
-                        lot.active = True
-                        lot.seller_invoice = None
-                        lot.buyer_invoice = None
-                # this is needed for any changes made above, as well as in-person and buy now auction lots
-                lot.save()
-                if sendNoRelistWarning:
-                    current_site = Site.objects.get_current()
-                    mail.send(
-                        lot.user.email,
-                        template="lot_ended_relist",
-                        context={"domain": current_site.domain, "lot": lot},
-                    )
-                if relist:
-                    originalImages = LotImage.objects.filter(lot_number=lot.pk)
-                    originalPk = lot.pk
-                    lot.pk = None  # create a new, duplicate lot
-                    lot.date_end = timezone.now() + datetime.timedelta(days=lot.lot_run_duration)
-                    lot.active = True
-                    lot.winner = None
-                    lot.winning_price = None
-                    lot.seller_invoice = None
-                    lot.buyer_invoice = None
-                    lot.buy_now_used = False
-                    lot.save()
-                    for location in Lot.objects.get(lot_number=originalPk).shipping_locations.all():
-                        lot.shipping_locations.add(location)
-                    for originalImage in originalImages:
-                        newImage = LotImage.objects.create(
-                            createdon=originalImage.createdon,
-                            lot_number=lot,
-                            image_source=originalImage.image_source,
-                            is_primary=originalImage.is_primary,
-                        )
-                        newImage.image = get_thumbnailer(originalImage.image)
-                        # if the original lot sold, this picture sure isn't of the actual item
-                        if originalImage.image_source == "ACTUAL":
-                            newImage.image_source = "REPRESENTATIVE"
-                        newImage.save()
-            except Exception as e:
-                logger.warning('Unable to set winner on "%s":', lot)
-                logger.exception(e)
+            if lot.auction:
+                auction_lots.append(lot)
+            else:
+                with transaction.atomic():
+                    for claimed in claim_lots([lot]):
+                        end_lot(claimed)
+        # note: once again, lots that are part of an in-person auction are not included here
+        elif lot.ending_very_soon and not lot.sold:
+            result = {
+                "type": "chat_message",
+                "info": "CHAT",
+                "message": "Bidding ends in less than a minute!!",
+                "pk": -1,
+                "username": "System",
+            }
+            messages.append((f"lot_{lot.pk}", result))
+    if auction_lots:
+        messages += close_auction_lots(auction_lots)
+    send_websocket_messages(messages)
+
+
+def top_bids_by_lot(lots):
+    """The two highest bids on each lot, highest first, in one query.  Same rules as Lot.bids"""
+    if not lots:
+        return {}
+    bids = (
+        Bid.objects.exclude(is_deleted=True)
+        .filter(lot_number__in=lots, amount__gte=F("lot_number__reserve_price"))
+        .filter(Q(last_bid_time__lte=F("lot_number__date_end")) | Q(lot_number__date_end__isnull=True))
+        .annotate(
+            rank=Window(
+                RowNumber(),
+                partition_by=F("lot_number"),
+                order_by=[F("amount").desc(), F("last_bid_time").asc()],
+            )
+        )
+        .filter(rank__lte=2)
+        .select_related("user__userdata")
+        .order_by("lot_number", "rank")
+    )
+    top_bids = {}
+    for bid in bids:
+        top_bids.setdefault(bid.lot_number_id, []).append(bid)
+    return top_bids
+
+
+def close_auction_lots(lots):
+    """Close ended lots that are part of an auction.  For a big online auction this is thousands of lots at once, so
+    the two highest bids on every lot are found with one query, lots are written with one bulk_update and their history with one bulk_create,
+    and each invoice is recalculated once at the end instead of once per lot.
+    Lots are claimed first, see claim_lots(), and only the claimed lots are closed.
+    Returns the websocket messages to send, see send_websocket_messages()"""
+    try:
+        with transaction.atomic():
+            claimed = claim_lots(lots)
+            messages, history = prepare_to_close(claimed)
+            if claimed:
+                Lot.objects.bulk_update(
+                    claimed,
+                    ["active", "winner", "winning_price", "auctiontos_winner", "donation", *claimed[0].bid_book_fields],
+                    batch_size=500,
+                )
+                LotHistory.objects.bulk_create(history, batch_size=500)
+    except Exception as e:
+        logger.warning("Unable to close %s lots together, closing them one at a time", len(lots))
+        logger.exception(e)
+        for lot in lots:
+            lot.refresh_from_db()
+            if lot.active:
+                end_lot(lot)
+        return []
+    create_update_invoices(claimed)
+    return messages
+
+
+def claim_lots(lots):
+    """Lock the rows of the lots that are still active and reload them, skipping any that are locked.
+    A lot is locked while someone bids on it (see bid_on_lot()) or while another closer has it, those are picked up on the next pass.
+    The lots are reloaded so that they're closed with the bids that are in the database now, not the ones that were there when they were read.
+    Call this inside a transaction"""
+    pks = list(
+        Lot.objects.select_for_update(skip_locked=True)
+        .filter(pk__in=[lot.pk for lot in lots], active=True)
+        .values_list("pk", flat=True)
+    )
+    claimed = Lot.objects.filter(pk__in=pks).select_related("auction", "bid_book_high_bidder__userdata")
+    # a last minute bid may have extended a lot since it was read
+    return [lot for lot in claimed if lot.ended]
+
+
+def prepare_to_close(lots):
+    """Set the winner and winning price on each lot without saving it.  Returns (websocket messages, LotHistory to create)"""
+    rebuild = [lot for lot in lots if not lot.sold and not lot.banned and not lot.bid_book_is_valid]
+    top_bids = top_bids_by_lot(rebuild)
+    for lot in rebuild:
+        lot.update_bid_book(top_bids.get(lot.pk, []), save=False)
+    # the most recent AuctionTOS for each winner, same as Lot.sell_to_online_high_bidder
+    winners = set()
+    for lot in lots:
+        if not lot.sold and lot.high_bidder:
+            winners.add((lot.auction_id, lot.high_bidder.pk))
+        elif lot.sold and lot.winner_id and not lot.auctiontos_winner_id:
+            winners.add((lot.auction_id, lot.winner_id))
+    winning_tos = {}
+    if winners:
+        for tos in (
+            AuctionTOS.objects.filter(
+                auction__in={auction for auction, user in winners}, user__in={user for auction, user in winners}
+            )
+            .select_related("auction", "user__userdata")
+            .order_by("createdon")
+        ):
+            winning_tos[(tos.auction_id, tos.user_id)] = tos
+    messages = []
+    history = []
+    for lot in lots:
+        lot.active = False
+        # lots with a winner or auctiontos winner and winning price are "sold", see end_lot()
+        if not lot.sold:
+            if lot.high_bidder:
+                lot.winner = lot.high_bidder
+                lot.winning_price = lot.high_bid
+                lot.auctiontos_winner = winning_tos.get((lot.auction_id, lot.winner.pk), lot.auctiontos_winner)
+                lot.force_donation_under_threshold()
+                info = "LOT_END_WINNER"
+                bidder = lot.high_bidder
+                high_bidder_pk = bidder.pk
+                high_bidder_name = str(lot.high_bidder_display)
+                current_high_bid = lot.high_bid
+                message = f"Won by {lot.high_bidder_display}"
+            else:
+                info = "ENDED_NO_WINNER"
+                bidder = None
+                high_bidder_pk = None
+                high_bidder_name = None
+                current_high_bid = None
+                message = "This lot did not sell"
+            result = {
+                "type": "chat_message",
+                "info": info,
+                "message": message,
+                "high_bidder_pk": high_bidder_pk,
+                "high_bidder_name": high_bidder_name,
+                "current_high_bid": current_high_bid,
+            }
+            messages.append((f"lot_{lot.pk}", result))
+            messages.append((f"auction_{lot.auction_id}", lot.auction_websocket_message(result)))
+            history.append(
+                LotHistory(
+                    lot=lot,
+                    user=bidder,
+                    message=message,
+                    changed_price=True,
+                    current_price=lot.high_bid,
+                )
+            )
+        elif lot.winner_id and not lot.auctiontos_winner_id:
+            lot.auctiontos_winner = winning_tos.get((lot.auction_id, lot.winner_id))
+    return messages, history
+
+
+def create_update_invoices(lots):
+    """Make sure the buyer and seller of each lot have an invoice, and flag all of them for recalculation in one query.  See Lot.create_update_invoices"""
+    tos_pks = set()
+    for lot in lots:
+        if lot.auctiontos_winner_id:
+            tos_pks.add(lot.auctiontos_winner_id)
+        if lot.auctiontos_seller_id:
+            tos_pks.add(lot.auctiontos_seller_id)
+    have_invoices = set(Invoice.objects.filter(auctiontos_user__in=tos_pks).values_list("auctiontos_user", flat=True))
+    for tos in AuctionTOS.objects.filter(pk__in=tos_pks - have_invoices):
+        Invoice.objects.get_or_create(auctiontos_user=tos, auction_id=tos.auction_id, defaults={})
+    mark_invoices_for_recalculation(Invoice.objects.filter(auctiontos_user__in=tos_pks))
+
+
+def send_websocket_messages(messages):
+    """Send (group, message) pairs to the channel layer together instead of waiting on each one in turn"""
+    if not messages:
+        return
+    channel_layer = channels.layers.get_channel_layer()
+
+    async def send_all():
+        for i in range(0, len(messages), 100):
+            await asyncio.gather(
+                *[channel_layer.group_send(group, message) for group, message in messages[i : i + 100]]
+            )
+
+    try:
+        async_to_sync(send_all)()
+    except Exception as e:
+        logger.exception(e)
+
+
+def end_lot(lot):
+    """Set the winner and winning price on one ended lot, and relist it if needed"""
+    # note - lots that are part of in-person auctions will not get here
+    # if they are active, they always have lot.ended = False, and if they are sold,
+    # the method that sells them should set active=False, so they won't be filtered here
+    # But, see https://github.com/iragm/fishauctions/issues/116
+    try:
+        lot.active = False
+        # lots with a winner or auctiontos winner and winning price are "sold"
+        if lot.sold:
+            # lots will be bought via buy now will get here
+            # as well as in-person auction lots whose winner has been set manually
+            # We still need to make those active=False, done above, and then save, below
+            # I don't think the above is true anymore, lots bought with buy now should also be made inactive
+            pass
         else:
-            # note: once again, lots that are part of an in-person auction are not included here
-            if lot.ending_very_soon and not lot.sold:
-                result = {
-                    "type": "chat_message",
-                    "info": "CHAT",
-                    "message": "Bidding ends in less than a minute!!",
-                    "pk": -1,
-                    "username": "System",
-                }
+            info = None
+            if lot.high_bidder:
+                lot.sell_to_online_high_bidder
+                info = "LOT_END_WINNER"
+                bidder = lot.high_bidder
+                high_bidder_pk = lot.high_bidder.pk
+                high_bidder_name = str(lot.high_bidder_display)
+                current_high_bid = lot.high_bid
+                message = f"Won by {lot.high_bidder_display}"
+            # at this point, the lot should have a winner filled out if it's sold.  If it still doesn't:
+            if not lot.sold:
+                high_bidder_pk = None
+                high_bidder_name = None
+                current_high_bid = None
+                message = "This lot did not sell"
+                bidder = None
+                info = "ENDED_NO_WINNER"
+            result = {
+                "type": "chat_message",
+                "info": info,
+                "message": message,
+                "high_bidder_pk": high_bidder_pk,
+                "high_bidder_name": high_bidder_name,
+                "current_high_bid": current_high_bid,
+            }
+            if info:
                 lot.send_websocket_message(result)
+                lot.send_auction_websocket_message(result)
+                LotHistory.objects.create(
+                    lot=lot,
+                    user=bidder,
+                    message=message,
+                    changed_price=True,
+                    current_price=lot.high_bid,
+                )
+        lot.create_update_invoices
+        # logic to email winner and buyer for lots not in an auction
+        if lot.winner and not lot.auction:
+            current_site = Site.objects.get_current()
+            # email the winner first
+            mail.send(
+                lot.winner.email,
+                headers={"Reply-to": lot.user.email},
+                template="non_auction_lot_winner",
+                context={"lot": lot, "domain": current_site.domain},
+            )
+            # now, email the seller
+            mail.send(
+                lot.user.email,
+                headers={"Reply-to": lot.winner.email},
+                template="non_auction_lot_seller",
+                context={"lot": lot, "domain": current_site.domain},
+            )
+        # automatic relisting of lots
+        relist = False
+        sendNoRelistWarning = False
+        if not lot.auction:
+            if lot.winner and lot.relist_if_sold and (not lot.relist_countdown):
+                sendNoRelistWarning = True
+            if (not lot.winner) and lot.relist_if_not_sold and (not lot.relist_countdown):
+                sendNoRelistWarning = True
+            if lot.winner and lot.relist_if_sold and lot.relist_countdown:
+                lot.relist_countdown -= 1
+                relist = True
+            if (not lot.winner) and lot.relist_if_not_sold and lot.relist_countdown:
+                # no need to relist unsold lots, just decrement the countdown
+                lot.relist_countdown -= 1
+                lot.date_end = timezone.now() + datetime.timedelta(days=lot.lot_run_duration)
+                lot.active = True
+                lot.seller_invoice = None
+                lot.buyer_invoice = None
+        # this is needed for any changes made above, as well as in-person and buy now auction lots
+        lot.save()
+        if sendNoRelistWarning:
+            current_site = Site.objects.get_current()
+            mail.send(
+                lot.user.email,
+                template="lot_ended_relist",
+                context={"domain": current_site.domain, "lot": lot},
+            )
+        if relist:
+            originalImages = LotImage.objects.filter(lot_number=lot.pk)
+            originalPk = lot.pk
+            lot.pk = None  # create a new, duplicate lot
+            lot.date_end = timezone.now() + datetime.timedelta(days=lot.lot_run_duration)
+            lot.active = True
+            lot.winner = None
+            lot.winning_price = None
+            lot.seller_invoice = None
+            lot.buyer_invoice = None
+            lot.buy_now_used = False
+            lot.save()
+            for location in Lot.objects.get(lot_number=originalPk).shipping_locations.all():
+                lot.shipping_locations.add(location)
+            for originalImage in originalImages:
+                newImage = LotImage.objects.create(
+                    createdon=originalImage.createdon,
+                    lot_number=lot,
+                    image_source=originalImage.image_source,
+                    is_primary=originalImage.is_primary,
+                )
+                newImage.image = get_thumbnailer(originalImage.image)
+                # if the original lot sold, this picture sure isn't of the actual item
+                if originalImage.image_source == "ACTUAL":
+                    newImage.image_source = "REPRESENTATIVE"
+                newImage.save()
+    except Exception as e:
+        logger.warning('Unable to set winner on "%s":', lot)
+        logger.exception(e)
 
 
 class Command(BaseCommand):
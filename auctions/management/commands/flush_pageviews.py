@@ -0,0 +1,73 @@
+import json
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import InterfaceError, OperationalError, close_old_connections
+
+from auctions.models import PAGEVIEW_BUFFER_KEY, pageview_buffer, record_pageviews
+
+logger = logging.getLogger(__name__)
+
+
+def save_events(events):
+    """Save page views with record_pageviews(), splitting the batch in half until the views that can't be saved are found.  Those are logged and dropped.
+    Returns the number of views saved"""
+    try:
+        record_pageviews(events)
+        return len(events)
+    except (OperationalError, InterfaceError):
+        # the database is down
+        raise
+    except Exception as e:
+        if len(events) == 1:
+            logger.warning("Dropping page view %s", events[0])
+            logger.exception(e)
+            return 0
+        middle = len(events) // 2
+        return save_events(events[:middle]) + save_events(events[middle:])
+
+
+def flush_pageview_buffer(batch_size=1000):
+    """Save everything in the page view buffer, batch_size views at a time.  Returns the number of views saved
+    Views are only removed from the buffer once they've been saved.  If the database is down, the error is raised and they're saved on the next flush"""
+    buffer = pageview_buffer()
+    total = 0
+    while True:
+        events = buffer.lrange(PAGEVIEW_BUFFER_KEY, 0, batch_size - 1)
+        if not events:
+            return total
+        views = []
+        for event in events:
+            try:
+                views.append(json.loads(event))
+            except ValueError:
+                # these are just stats; don't keep something that can't be read, or it would be retried forever
+                logger.warning("Dropping page view that isn't JSON: %s", event)
+        total += save_events(views)
+        # new views are pushed onto the other end, and this is the only thing that takes them off
+        buffer.ltrim(PAGEVIEW_BUFFER_KEY, len(events), -1)
+
+
+class Command(BaseCommand):
+    help = "Runs forever, saving the page views that /api/pageview/ pushes onto Redis when PAGEVIEW_BUFFER is set"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=5, help="Seconds between flushes")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Page views saved per query")
+        parser.add_argument("--once", action="store_true", help="Save what's in the buffer now and exit")
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.time()
+            try:
+                # this runs for days, and the database will drop idle connections
+                close_old_connections()
+                saved = flush_pageview_buffer(options["batch_size"])
+                if saved:
+                    logger.debug("saved %s page views", saved)
+            except Exception as e:
+                logger.exception(e)
+            if options["once"]:
+                return
+            time.sleep(max(0, options["interval"] - (time.time() - started)))
@@ -0,0 +1,122 @@
+import csv
+import ipaddress
+import logging
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from auctions.models import IPGeo, Location, PageView, UserData
+
+logger = logging.getLogger(__name__)
+
+
+def parse_ips(ip_addresses):
+    """Returns a dict of {version: [(ip, ip string)]}, sorted so that they can be walked alongside a sorted blocks file"""
+    by_version = {4: [], 6: []}
+    for ip in ip_addresses:
+        try:
+            parsed = ipaddress.ip_address(ip.strip())
+        except ValueError:
+            continue
+        by_version[parsed.version].append((parsed, ip))
+    for ips in by_version.values():
+        ips.sort()
+    return by_version
+
+
+def match_blocks(blocks_path, by_version):
+    """Walk a GeoLite2 City Blocks csv (which MaxMind ships sorted by network) and the sorted IPs together.
+    Returns a dict of {ip string: (geoname_id, latitude, longitude)}"""
+    found = {}
+    with Path(blocks_path).open(newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        ips = None
+        position = 0
+        for row in reader:
+            try:
+                network = ipaddress.ip_network(row["network"])
+            except (KeyError, ValueError):
+                continue
+            if ips is None:
+                # each blocks file only has one IP version
+                ips = by_version[network.version]
+            while position < len(ips) and ips[position][0] < network.network_address:
+                position += 1
+            while position < len(ips) and ips[position][0] in network:
+                if row.get("latitude") and row.get("longitude"):
+                    found[ips[position][1]] = (
+                        row.get("geoname_id") or row.get("registered_country_geoname_id"),
+                        float(row["latitude"]),
+                        float(row["longitude"]),
+                    )
+                position += 1
+            if position >= len(ips):
+                break
+    return found
+
+
+def read_geonames(locations_path):
+    """Returns a dict of {geoname_id: (continent name, country name)} from a GeoLite2 City Locations csv"""
+    with Path(locations_path).open(newline="", encoding="utf-8") as f:
+        return {
+            row["geoname_id"]: (row.get("continent_name", ""), row.get("country_name", "")) for row in csv.DictReader(f)
+        }
+
+
+class Command(BaseCommand):
+    help = "Locate IP addresses from page views and users with an offline GeoLite2 City csv database, so they don't need to be looked up with ip-api.com"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--blocks",
+            nargs="+",
+            required=True,
+            help="GeoLite2-City-Blocks-IPv4.csv and/or GeoLite2-City-Blocks-IPv6.csv",
+        )
+        parser.add_argument("--locations", help="GeoLite2-City-Locations-en.csv, used to fill in country and continent")
+        parser.add_argument("--batch-size", type=int, default=1000, help="IPGeo rows created per query")
+        parser.add_argument(
+            "--update-pageviews", action="store_true", help="Also set lat/long on page views from the located IPs"
+        )
+
+    def handle(self, *args, **options):
+        for path in options["blocks"] + [options["locations"] or ""]:
+            if path and not Path(path).exists():
+                msg = f"{path} does not exist"
+                raise CommandError(msg)
+        known = set(IPGeo.objects.values_list("ip_address", flat=True))
+        ip_addresses = set(
+            PageView.objects.filter(ip_address__isnull=False).values_list("ip_address", flat=True).distinct()
+        )
+        ip_addresses |= set(
+            UserData.objects.filter(last_ip_address__isnull=False).values_list("last_ip_address", flat=True)
+        )
+        by_version = parse_ips(ip_addresses - known)
+        found = {}
+        for blocks_path in options["blocks"]:
+            found.update(match_blocks(blocks_path, by_version))
+        geonames = read_geonames(options["locations"]) if options["locations"] else {}
+        locations = {location.name: location for location in Location.objects.all()}
+        now = timezone.now()
+        new_geos = []
+        for ip, (geoname_id, latitude, longitude) in found.items():
+            continent, country = geonames.get(geoname_id, ("", ""))
+            new_geos.append(
+                IPGeo(
+                    ip_address=ip,
+                    latitude=latitude,
+                    longitude=longitude,
+                    continent=locations.get(continent),
+                    country=locations.get(country),
+                    source="GEOIP",
+                    last_seen=now,
+                )
+            )
+        IPGeo.objects.bulk_create(new_geos, batch_size=options["batch_size"], ignore_conflicts=True)
+        logger.info("located %s of %s new IP addresses", len(new_geos), len(ip_addresses - known))
+        if options["update_pageviews"]:
+            for geo in new_geos:
+                PageView.objects.filter(ip_address=geo.ip_address, latitude=0, longitude=0).update(
+                    latitude=geo.latitude, longitude=geo.longitude
+                )
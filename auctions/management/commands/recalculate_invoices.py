@@ -0,0 +1,16 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from auctions.models import recalculate_dirty_invoices
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Update the totals of invoices that have changed since this last ran.  See Invoice.mark_for_recalculation()"
+
+    def handle(self, *args, **options):
+        count = recalculate_dirty_invoices()
+        if count:
+            logger.info("recalculated %s invoices", count)
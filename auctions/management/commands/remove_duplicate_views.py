@@ -1,14 +1,92 @@
 from django.core.management.base import BaseCommand
+from django.db.models import Count, Exists, Max, Min, Q, Sum
 
 from auctions.models import PageView
 
+# views with the same values for these are one visit, see PageView.duplicates
+VISIT_FIELDS = ["user", "lot_number", "url", "auction", "session_id"]
+
+
+def merge_duplicate_views():
+    """Merge every group of duplicate views that has a view in it which hasn't been checked yet into the oldest view in the group.
+    Groups are found and totalled with one GROUP BY query, the merged views are saved with bulk_update() and the rest are deleted in one go.
+    Returns the number of views deleted"""
+    last_pk = PageView.objects.filter(duplicate_check_completed=False).aggregate(Max("pk"))["pk__max"]
+    if last_pk is None:
+        return 0
+    unchecked = PageView.objects.filter(duplicate_check_completed=False, pk__lte=last_pk)
+    # only pages with unchecked views can have new duplicates, this keeps the group by off most of the table
+    # url__in never matches NULL, views without a url are only picked up when some of them are unchecked
+    candidates = PageView.objects.filter(
+        Q(url__in=unchecked.values("url")) | Q(Exists(unchecked.filter(url__isnull=True)), url__isnull=True)
+    )
+    groups = {
+        tuple(group[field] for field in VISIT_FIELDS): group
+        for group in candidates.values(*VISIT_FIELDS)
+        .annotate(
+            views=Count("pk"),
+            unchecked=Count("pk", filter=Q(duplicate_check_completed=False)),
+            keep=Min("pk"),
+            first_date_start=Min("date_start"),
+            last_date_end=Max("date_end"),
+            all_total_time=Sum("total_time"),
+            all_counter=Sum("counter"),
+            notifications_sent=Count("pk", filter=Q(notification_sent=True)),
+            any_source=Max("source"),
+            any_title=Max("title"),
+            any_referrer=Max("referrer"),
+            any_visit_key=Max("visit_key"),
+        )
+        .filter(views__gt=1, unchecked__gt=0)
+        .order_by()
+    }
+    deleted = 0
+    if groups:
+        keep = {group["keep"] for group in groups.values()}
+        urls = {key[2] for key in groups}
+        duplicates = [
+            pk
+            for pk, *fields in candidates.filter(
+                Q(url__in=urls - {None}) | Q(url__isnull=True) if None in urls else Q(url__in=urls)
+            ).values_list("pk", *VISIT_FIELDS)
+            if tuple(fields) in groups and pk not in keep
+        ]
+        # delete first, the kept view may be taking a duplicate's visit_key
+        deleted, by_model = PageView.objects.filter(pk__in=duplicates).delete()
+        views = PageView.objects.in_bulk(keep)
+        for group in groups.values():
+            view = views[group["keep"]]
+            view.date_start = group["first_date_start"]
+            view.date_end = group["last_date_end"]
+            view.total_time = group["all_total_time"]
+            # each duplicate was another view of the same page
+            view.counter = group["all_counter"] + group["views"] - 1
+            view.notification_sent = group["notifications_sent"] > 0
+            view.source = view.source or group["any_source"]
+            view.title = view.title or group["any_title"]
+            view.referrer = view.referrer or group["any_referrer"]
+            view.visit_key = view.visit_key or group["any_visit_key"]
+        PageView.objects.bulk_update(
+            views.values(),
+            [
+                "date_start",
+                "date_end",
+                "total_time",
+                "counter",
+                "notification_sent",
+                "source",
+                "title",
+                "referrer",
+                "visit_key",
+            ],
+            batch_size=500,
+        )
+    unchecked.update(duplicate_check_completed=True)
+    return deleted
+
 
 class Command(BaseCommand):
     help = "Duplicate pageviews appear when the user views the same page twice in rapid succession; this will merge the duplicate views"
 
     def handle(self, *args, **options):
-        views = PageView.objects.filter(duplicate_check_completed=False)
-        for view in views:
-            view.merge_and_delete_duplicate
-            view.duplicate_check_completed = True
-            view.save()
+        merge_duplicate_views()
@@ -0,0 +1,125 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q, Sum
+from django.db.models.functions import Coalesce, TruncHour
+from django.utils import timezone
+
+from auctions.management.commands.update_user_interest import parse_since
+from auctions.models import (
+    ActivityRollup,
+    AuctionTOS,
+    Lot,
+    LotHistory,
+    PageView,
+    PageViewRollup,
+    SearchHistory,
+    Watch,
+)
+
+HOUR = datetime.timedelta(hours=1)
+# hours already counted are counted again this far back, see Command.handle()
+RECOUNT = datetime.timedelta(days=1)
+
+
+def floor_hour(when):
+    return when.astimezone(datetime.UTC).replace(minute=0, second=0, microsecond=0)
+
+
+def by_hour(qs, date_field, auction, start, end, fields=(), **aggregates):
+    """Group qs by hour, both for each auction and for the whole site.  Yields (auction pk or None, hour, row)"""
+    # hours are truncated in UTC so that daylight saving time doesn't merge or split them
+    qs = qs.filter(**{f"{date_field}__gte": start, f"{date_field}__lt": end}).annotate(
+        rollup_hour=TruncHour(date_field, tzinfo=datetime.UTC)
+    )
+    per_auction = qs.annotate(rollup_auction=auction).filter(rollup_auction__isnull=False)
+    for rows, group_by in [(per_auction, ["rollup_auction", "rollup_hour"]), (qs, ["rollup_hour"])]:
+        for row in rows.values(*group_by, *fields).annotate(**aggregates).order_by():
+            yield row.get("rollup_auction"), row["rollup_hour"], row
+
+
+def rollup_activity(start, end):
+    """Recount ActivityRollup and PageViewRollup for every hour from start up to (but not including) end.
+    Each source is counted with one grouped query per auction and one for the site, and the hours are replaced in one transaction"""
+    views = PageView.objects.all()
+    view_auction = Coalesce("auction", "lot_number__auction")
+    sources = [
+        (
+            views,
+            "date_start",
+            view_auction,
+            {
+                "views": Count("pk"),
+                "unique_users": Count("user", distinct=True),
+                "unique_sessions": Count("session_id", distinct=True, filter=Q(user__isnull=True)),
+            },
+        ),
+        (AuctionTOS.objects.all(), "createdon", F("auction"), {"joins": Count("pk")}),
+        (Lot.objects.all(), "date_posted", F("auction"), {"lots": Count("pk")}),
+        (LotHistory.objects.filter(changed_price=True), "timestamp", F("lot__auction"), {"bids": Count("pk")}),
+        (Watch.objects.all(), "createdon", F("lot_number__auction"), {"watches": Count("pk")}),
+        (SearchHistory.objects.all(), "createdon", F("auction"), {"searches": Count("pk")}),
+    ]
+    activity = {}
+    for qs, date_field, auction, aggregates in sources:
+        for auction_pk, hour, row in by_hour(qs, date_field, auction, start, end, **aggregates):
+            rollup = activity.setdefault((auction_pk, hour), ActivityRollup(auction_id=auction_pk, hour=hour))
+            for name in aggregates:
+                setattr(rollup, name, row[name])
+    pages = [
+        PageViewRollup(
+            auction_id=auction_pk,
+            hour=hour,
+            url=row["url"],
+            title=row["title"],
+            referrer=row["referrer"],
+            views=row["page_views"],
+            total_views=row["page_views"] + row["repeat_views"],
+        )
+        for auction_pk, hour, row in by_hour(
+            views,
+            "date_start",
+            view_auction,
+            start,
+            end,
+            fields=["url", "title", "referrer"],
+            page_views=Count("pk"),
+            repeat_views=Coalesce(Sum("counter"), 0),
+        )
+    ]
+    with transaction.atomic():
+        ActivityRollup.objects.filter(hour__gte=start, hour__lt=end).delete()
+        PageViewRollup.objects.filter(hour__gte=start, hour__lt=end).delete()
+        ActivityRollup.objects.bulk_create(activity.values(), batch_size=1000)
+        PageViewRollup.objects.bulk_create(pages, batch_size=1000)
+
+
+class Command(BaseCommand):
+    help = "Count page views, joins, bids, watches and searches per hour for the stats pages and the admin dashboard"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--since",
+            help="Recount everything since this date.  By default, the last day is recounted, or all page views the first time it's run. \
+                Page views are counted in the hour they started, so a repeat view or merged duplicate of a page first viewed before that only shows up after recounting with this",
+        )
+
+    def handle(self, *args, **options):
+        # the current hour is counted too; it'll be recounted on the next run
+        end = floor_hour(timezone.now()) + HOUR
+        if options["since"]:
+            start = parse_since(options["since"])
+        else:
+            last_hour = ActivityRollup.objects.aggregate(Max("hour"))["hour__max"]
+            if last_hour:
+                # page views that were still waiting in the buffer, and the counters of older views that were viewed again or merged,
+                # see record_pageviews() and merge_duplicate_views()
+                start = last_hour - RECOUNT
+            else:
+                start = PageView.objects.aggregate(Min("date_start"))["date_start__min"] or end - HOUR
+        start = floor_hour(start)
+        while start < end:
+            # a day at a time, to keep each transaction small
+            rollup_activity(start, min(end, start + datetime.timedelta(days=1)))
+            start += datetime.timedelta(days=1)
@@ -0,0 +1,84 @@
+import datetime
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from auctions.models import Auction, AuctionTOS, Lot, PickupLocation
+
+
+class Command(BaseCommand):
+    help = "Create an auction full of lots and bidders to point locustfile.py at.  Writes the users and lots it made to a json file that the load test reads"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lots", type=int, default=200, help="Number of lots in the auction")
+        parser.add_argument("--bidders", type=int, default=100, help="Number of users who have joined the auction")
+        parser.add_argument("--minutes", type=int, default=60, help="Lots end this many minutes from now")
+        parser.add_argument("--password", default="loadtest", help="Password for every user created")
+        parser.add_argument("--output", default="loadtest.json", help="Where to write the fixture for locustfile.py")
+        parser.add_argument(
+            "--force", action="store_true", help="Run even when DEBUG is off.  Never do this on the real site"
+        )
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options["force"]:
+            msg = "This fills the database with fake users and lots; set DEBUG or pass --force"
+            raise CommandError(msg)
+        now = timezone.now()
+        date_end = now + datetime.timedelta(minutes=options["minutes"])
+        # hashing is slow, and every user gets the same password anyway
+        password = make_password(options["password"])
+        admin, created = User.objects.get_or_create(
+            username="loadtest_admin", defaults={"email": "loadtest_admin@example.com", "password": password}
+        )
+        auction = Auction.objects.create(
+            title=f"Load test {now:%Y-%m-%d %H%M}",
+            created_by=admin,
+            date_start=now - datetime.timedelta(days=1),
+            date_end=date_end,
+            is_online=True,
+            promote_this_auction=False,
+        )
+        location = PickupLocation.objects.create(
+            name="Load test pickup", auction=auction, pickup_time=date_end + datetime.timedelta(days=1)
+        )
+        AuctionTOS.objects.create(user=admin, auction=auction, pickup_location=location, is_admin=True)
+        bidders = []
+        for i in range(options["bidders"]):
+            user, created = User.objects.get_or_create(
+                username=f"loadtest_{i}", defaults={"email": f"loadtest_{i}@example.com", "password": password}
+            )
+            tos = AuctionTOS.objects.create(user=user, auction=auction, pickup_location=location)
+            bidders.append({"username": user.username, "bidder_number": tos.bidder_number})
+        sellers = list(AuctionTOS.objects.filter(auction=auction, user__username__startswith="loadtest_")[:10])
+        lots = []
+        for i in range(options["lots"]):
+            seller = sellers[i % len(sellers)]
+            lot = Lot.objects.create(
+                lot_name=f"Load test lot {i}",
+                auction=auction,
+                auctiontos_seller=seller,
+                user=seller.user,
+                quantity=1,
+                reserve_price=auction.minimum_bid,
+                date_end=date_end,
+            )
+            lots.append({"pk": lot.pk, "lot_number": lot.lot_number_display})
+        # bidding isn't allowed on very new lots
+        Lot.objects.filter(auction=auction).update(date_posted=now - datetime.timedelta(days=1))
+        fixture = {
+            "auction": auction.slug,
+            "password": options["password"],
+            "admin": admin.username,
+            "bidders": bidders,
+            "lots": lots,
+        }
+        with Path(options["output"]).open("w") as f:
+            json.dump(fixture, f, indent=2)
+        self.stdout.write(
+            f"Created {auction.slug} with {len(lots)} lots and {len(bidders)} bidders, fixture written to {options['output']}"
+        )
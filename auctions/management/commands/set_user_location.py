@@ -3,16 +3,83 @@ import logging
 
 import requests
 from django.core.management.base import BaseCommand
-from django.db.models import Q
+from django.db.models import Max, Q
 from django.utils import timezone
 
-from auctions.models import Location, PageView, UserData
+from auctions.models import IPGeo, Location, PageView, UserData
 
 logger = logging.getLogger(__name__)
 
 
+def locate(ip_addresses, need_location=False):
+    """Returns a dict of {ip_address: IPGeo}.  IPs that aren't in IPGeo yet are copied from an older page view with the same IP if there is one,
+    otherwise looked up with ip-api.com.  Load an offline database with the load_geoip command to avoid most of these lookups
+    Page views only have a lat/long, so with need_location IPs without a continent or country are always looked up with ip-api.com"""
+    ip_addresses = {ip for ip in ip_addresses if ip}
+    found = IPGeo.lookup(ip_addresses)
+    if need_location:
+        found = {ip: geo for ip, geo in found.items() if geo.continent_id or geo.country_id}
+    missing = ip_addresses - set(found)
+    if missing and not need_location:
+        last_located = (
+            PageView.objects.exclude(latitude=0, longitude=0)
+            .filter(ip_address__in=missing)
+            .values("ip_address")
+            .annotate(last=Max("pk"))
+            .values_list("last", flat=True)
+        )
+        for ip, latitude, longitude in PageView.objects.filter(pk__in=list(last_located)).values_list(
+            "ip_address", "latitude", "longitude"
+        ):
+            found[ip], created = IPGeo.objects.get_or_create(
+                ip_address=ip,
+                defaults={
+                    "latitude": latitude,
+                    "longitude": longitude,
+                    "source": "PAGEVIEW",
+                    "last_seen": timezone.now(),
+                },
+            )
+        missing -= set(found)
+    if missing:
+        # we are capped at 100 lookups per query, and 15 queries per minute
+        # bit awkward as we can't use single quotes here, and it has to be a string, not a list
+        ip_list = "[" + ",".join(f'"{ip}"' for ip in list(missing)[:100]) + "]"
+        # See here for more documentation: https://ip-api.com/docs/api:batch#test
+        # lat lng and country
+        r = requests.post("http://ip-api.com/batch?fields=1106113", data=ip_list)
+        if r.status_code == 200:
+            locations = {location.name: location for location in Location.objects.all()}
+            for value in r.json():
+                try:
+                    if value["status"] == "success":
+                        found[value["query"]], created = IPGeo.objects.update_or_create(
+                            ip_address=value["query"],
+                            defaults={
+                                "latitude": value["lat"],
+                                "longitude": value["lon"],
+                                "continent": locations.get(value["continent"]),
+                                "country": locations.get(value["country"]),
+                                "source": "IPAPI",
+                                "last_seen": timezone.now(),
+                            },
+                        )
+                    else:
+                        logger.info(
+                            "IP %s may not be valid - verify it and set their location manually",
+                            value["query"],
+                        )
+                except Exception as e:
+                    logger.exception(e)
+        else:
+            logger.warning("Query failed for this IP list:")
+            logger.warning(ip_list)
+            logger.warning(r.text)
+    return found
+
+
 class Command(BaseCommand):
-    help = "Set user lat/long based on their IP address"
+    help = "Set user and page view lat/long based on their IP address"
 
     def handle(self, *args, **options):
         # get users that have been on the site for at least 1 days, but have not set their location
@@ -22,92 +89,31 @@ class Command(BaseCommand):
             last_ip_address__isnull=False,
             user__date_joined__lte=recently,
         ).order_by("-last_activity")[:100]
-        # build a list of IPs - bit awkward as we can't use single quotes here, and it has to be a string, not a list
-        ip_list = "["
-        if users:
-            for user in users:
-                ip_list += f'"{user.last_ip_address}",'
-            ip_list = ip_list[:-1] + "]"  # trailing , breaks things
-            # See here for more documentation: https://ip-api.com/docs/api:batch#test
-            # lat and lng only
-            # r = requests.post("http://ip-api.com/batch?fields=25024", data=ip_list)
-            # lat lng and country
-            r = requests.post("http://ip-api.com/batch?fields=1106113", data=ip_list)
-            if r.status_code == 200:
-                ip_addresses = r.json()
-                # now, we cycle through users again and assign their location based on IP
-                for user in users:
-                    for value in ip_addresses:
-                        try:
-                            if user.last_ip_address == value["query"]:
-                                if value["status"] == "success":
-                                    if not user.latitude:
-                                        user.latitude = value["lat"]
-                                    if not user.longitude:
-                                        user.longitude = value["lon"]
-                                    if not user.location:
-                                        continent = Location.objects.filter(name=value["continent"]).first()
-                                        country = Location.objects.filter(name=value["country"]).first()
-                                        default = Location.objects.filter(name="Other").first()
-                                        user.location = next(
-                                            value for value in [continent, country, default] if value is not None
-                                        )
-                                    user.save()
-                                    logger.info(
-                                        "assigning %s with IP %s a location", user.user.email, user.last_ip_address
-                                    )
-                                    break
-                                else:
-                                    logger.info(
-                                        "IP %s may not be valid - verify it and set their location manually",
-                                        user.last_ip_address,
-                                    )
-                        except Exception as e:
-                            logger.exception(e)
-            else:
-                logger.warning("Query failed for this IP list:")
-                logger.warning(ip_list)
-                logger.warning(r["text"])
-            # some limitations to note:
-            # we are capped at 100 lookups per query
-            # Looks like the cap on this service is 15 per minute, so it's easily able to meet our needs if the cron job is run more often.
-            # right now, this is run once per day via cron.  Not a big deal for current user loads, and this can be run twice a day if needed
-            # older users don't have a location assigned (around 440 users, I do not have a way to assign a location to these automatically)
-            # if there is a problematic IP, it may be hard to spot, the error checking is minimal here
+        # older users don't have a location assigned (around 440 users, I do not have a way to assign a location to these automatically)
+        # if there is a problematic IP, it may be hard to spot, the error checking is minimal here
+        geos = locate(user.last_ip_address for user in users if user.location_id)
+        geos.update(locate((user.last_ip_address for user in users if not user.location_id), need_location=True))
+        for user in users:
+            geo = geos.get(user.last_ip_address)
+            if geo:
+                if not user.latitude:
+                    user.latitude = geo.latitude
+                if not user.longitude:
+                    user.longitude = geo.longitude
+                if not user.location:
+                    user.location = geo.location
+                user.save()
+                logger.info("assigning %s with IP %s a location", user.user.email, user.last_ip_address)
 
-        # now, we handle pageviews separately.  There is some duplicate code here that could get merged with the user lookup above
-        # first check is to see if we've already got this IP address in the system somewhere
-        pageviews = (
+        # now, we handle pageviews separately
+        ip_addresses = (
             PageView.objects.exclude(ip_address="172.21.0.1")
             .exclude(ip_address="172.22.0.1")
             .filter(ip_address__isnull=False, latitude=0, longitude=0)
-            .order_by("-date_start")[:100]
+            .order_by("-date_start")
+            .values_list("ip_address", flat=True)[:100]
         )
-        # now that we've cycled
-        ip_list = "["
-        if pageviews:
-            for view in pageviews:
-                if view.ip_address not in ip_list:
-                    ip_list += f'"{view.ip_address}",'
-            ip_list = ip_list[:-1] + "]"  # trailing , breaks things
-            # See here for more documentation: https://ip-api.com/docs/api:batch#test
-            r = requests.post("http://ip-api.com/batch?fields=25024", data=ip_list)
-            if r.status_code == 200:
-                ip_addresses = r.json()
-                # now, we cycle through views again and assign their location based on IP
-                for view in pageviews:
-                    for value in ip_addresses:
-                        try:
-                            if view.ip_address == value["query"]:
-                                if value["status"] == "success":
-                                    view.latitude = value["lat"]
-                                    view.longitude = value["lon"]
-                                    view.save()
-                                    break
-                                else:
-                                    logger.warning(
-                                        "IP %s may not be valid - verify it and set their location manually",
-                                        view.ip_address,
-                                    )
-                        except Exception as e:
-                            logger.exception(e)
+        for ip, geo in locate(ip_addresses).items():
+            PageView.objects.filter(ip_address=ip, latitude=0, longitude=0).update(
+                latitude=geo.latitude, longitude=geo.longitude
+            )
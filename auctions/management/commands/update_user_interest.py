@@ -1,36 +1,51 @@
-from django.conf import settings
+import datetime
+
 from django.contrib.auth.models import User
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 
-from auctions.models import Bid, PageView, UserInterestCategory
+from auctions.models import Bid, PageView, rebuild_user_interest
 
 
-def updateInterest(category, user, weight):
-    interest, created = UserInterestCategory.objects.get_or_create(
-        category=category, user=user, defaults={"interest": 0}
-    )
-    interest.interest += weight
-    interest.save()
-    return
+def parse_since(value):
+    """A date or datetime, in the current timezone unless it says otherwise"""
+    since = parse_datetime(value)
+    if since is None:
+        day = parse_date(value)
+        if day is None:
+            msg = f"Can't read {value} as a date, use something like 2025-03-01 or 2025-03-01T12:00"
+            raise CommandError(msg)
+        since = datetime.datetime.combine(day, datetime.time())
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
 
 
 class Command(BaseCommand):
-    help = "Update how interested a given user is in all categories. \
-        This will reset all user data.  It needs to be run only if the BID_WEIGHT or VIEW_WEIGHT settings change"
+    help = "Rebuild how interested users are in each category from their bids and page views. \
+        Interest is kept up to date as people bid and view lots, so this needs to be run only if the BID_WEIGHT or VIEW_WEIGHT settings change"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--since",
+            help="Only rebuild users who have bid or viewed a lot since this date or datetime.  Users are rebuilt from all of their activity, not just what's new",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000, help="Users rebuilt at a time")
 
     def handle(self, *args, **options):
-        self.stdout.write("Creating userdata")
-        users = User.objects.all()
-        for user in users:
-            allBids = (
-                Bid.objects.exclude(is_deleted=True).select_related("lot_number__species_category").filter(user=user)
+        if options["since"]:
+            since = parse_since(options["since"])
+            user_pks = set(Bid.objects.filter(last_bid_time__gte=since).values_list("user", flat=True))
+            user_pks |= set(
+                PageView.objects.filter(date_end__gte=since, user__isnull=False).values_list("user", flat=True)
             )
-            pageViews = PageView.objects.select_related("lot_number__species_category").filter(user=user)
-            # remove all user interests
-            UserInterestCategory.objects.filter(user=user).delete()
-            # regenerate them
-            for item in allBids:
-                # bids weigh more than views
-                updateInterest(item.lot_number.species_category, user, settings.BID_WEIGHT)
-            for item in pageViews:
-                updateInterest(item.lot_number.species_category, user, settings.VIEW_WEIGHT)
+            user_pks = sorted(user_pks)
+        else:
+            user_pks = list(User.objects.order_by("pk").values_list("pk", flat=True))
+        batch_size = options["batch_size"]
+        total = 0
+        for start in range(0, len(user_pks), batch_size):
+            batch = user_pks[start : start + batch_size]
+            total += rebuild_user_interest(batch)
+            self.stdout.write(f"Rebuilt {total} interests for users up to {batch[-1]}")
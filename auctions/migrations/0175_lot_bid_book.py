@@ -0,0 +1,52 @@
+# Generated by Django 5.1.6 on 2026-10-18 04:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0174_alter_auction_allow_bulk_adding_lots_and_more"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="lot",
+            name="bid_book_current",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="lot",
+            name="bid_book_high_bidder",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddField(
+            model_name="lot",
+            name="bid_book_last_bid_time",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="lot",
+            name="bid_book_max_bid",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="lot",
+            name="bid_book_second_bid",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        # existing lots fill in their bid book the first time it's read, new lots start with an empty (and correct) book
+        migrations.AlterField(
+            model_name="lot",
+            name="bid_book_current",
+            field=models.BooleanField(default=True),
+        ),
+    ]
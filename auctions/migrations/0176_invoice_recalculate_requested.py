@@ -0,0 +1,22 @@
+# Generated by Django 5.1.6 on 2026-10-18 05:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0175_lot_bid_book"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="invoice",
+            name="recalculate_requested",
+            field=models.DateTimeField(
+                blank=True,
+                db_index=True,
+                help_text="Set when calculated_total is out of date, see recalculate_dirty_invoices()",
+                null=True,
+            ),
+        ),
+    ]
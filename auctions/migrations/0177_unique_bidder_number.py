@@ -0,0 +1,34 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:02
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def check_for_duplicate_bidder_numbers(apps, schema_editor):
+    """The unique constraint can't be added while people share a bidder number.  They're real people, often in finished auctions,
+    so they aren't renumbered here, see the duplicate_bidder_numbers command"""
+    AuctionTOS = apps.get_model("auctions", "AuctionTOS")
+    duplicates = AuctionTOS.objects.values("auction", "bidder_number").annotate(count=Count("pk")).filter(count__gt=1)
+    if duplicates.exists():
+        msg = (
+            f"{duplicates.count()} bidder numbers are shared by more than one person in the same auction.  "
+            "Run `python manage.py duplicate_bidder_numbers` to list them, check with the auctions' admins, "
+            "then run it again with --fix and migrate again"
+        )
+        raise RuntimeError(msg)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0176_invoice_recalculate_requested"),
+    ]
+
+    operations = [
+        migrations.RunPython(check_for_duplicate_bidder_numbers, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="auctiontos",
+            constraint=models.UniqueConstraint(
+                fields=("auction", "bidder_number"), name="unique_bidder_number_in_auction"
+            ),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.6 on 2026-10-18 05:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0177_unique_bidder_number"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LotNumberSequence",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("last_lot_number", models.PositiveIntegerField(default=0)),
+                ("auction", models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to="auctions.auction")),
+            ],
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.1.6 on 2026-10-18 05:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0178_lot_number_sequence"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IPGeo",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("ip_address", models.CharField(max_length=100, unique=True)),
+                ("latitude", models.FloatField(default=0)),
+                ("longitude", models.FloatField(default=0)),
+                (
+                    "source",
+                    models.CharField(
+                        blank=True,
+                        default="",
+                        help_text="Where this came from: GEOIP, IPAPI, or PAGEVIEW for locations copied from an older page view",
+                        max_length=20,
+                    ),
+                ),
+                ("last_seen", models.DateTimeField(blank=True, null=True)),
+                (
+                    "continent",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to="auctions.location",
+                    ),
+                ),
+                (
+                    "country",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to="auctions.location",
+                    ),
+                ),
+            ],
+        ),
+    ]
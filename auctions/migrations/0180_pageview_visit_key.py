@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0179_ipgeo"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="pageview",
+            name="visit_key",
+            field=models.CharField(
+                blank=True,
+                help_text="Set by record_pageviews() so that viewing the same page again updates this view instead of adding a duplicate",
+                max_length=40,
+                null=True,
+                unique=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,93 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0180_pageview_visit_key"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="auctiontos",
+            name="createdon",
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name="lot",
+            name="date_posted",
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name="lothistory",
+            name="timestamp",
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name="pageview",
+            name="date_start",
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name="searchhistory",
+            name="createdon",
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name="watch",
+            name="createdon",
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.CreateModel(
+            name="ActivityRollup",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("hour", models.DateTimeField(help_text="The start of the hour")),
+                ("views", models.PositiveIntegerField(default=0)),
+                ("unique_users", models.PositiveIntegerField(default=0)),
+                ("unique_sessions", models.PositiveIntegerField(default=0, help_text="Anonymous users, by session")),
+                ("joins", models.PositiveIntegerField(default=0)),
+                ("lots", models.PositiveIntegerField(default=0)),
+                ("bids", models.PositiveIntegerField(default=0, help_text="Bids that changed the price")),
+                ("watches", models.PositiveIntegerField(default=0)),
+                ("searches", models.PositiveIntegerField(default=0)),
+                (
+                    "auction",
+                    models.ForeignKey(
+                        blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to="auctions.auction"
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [models.Index(fields=["auction", "hour"], name="auctions_ac_auction_e4e531_idx")],
+            },
+        ),
+        migrations.CreateModel(
+            name="PageViewRollup",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("hour", models.DateTimeField()),
+                ("url", models.CharField(blank=True, max_length=600, null=True)),
+                ("title", models.CharField(blank=True, max_length=600, null=True)),
+                ("referrer", models.CharField(blank=True, max_length=600, null=True)),
+                ("views", models.PositiveIntegerField(default=0, help_text="Number of PageViews")),
+                (
+                    "total_views",
+                    models.PositiveIntegerField(
+                        default=0, help_text="Includes viewing the same page again, see PageView.counter"
+                    ),
+                ),
+                (
+                    "auction",
+                    models.ForeignKey(
+                        blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to="auctions.auction"
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [models.Index(fields=["auction", "hour"], name="auctions_pa_auction_700176_idx")],
+            },
+        ),
+    ]
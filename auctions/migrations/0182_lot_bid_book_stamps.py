@@ -0,0 +1,22 @@
+# Generated by Django 5.1.6 on 2026-10-18 06:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("auctions", "0181_activity_rollups"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="lot",
+            name="bid_book_end",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="lot",
+            name="bid_book_reserve_price",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -1,20 +1,27 @@
 import datetime
+import functools
+import hashlib
+import json
 import logging
+import math
 import re
 import uuid
+from collections import Counter
 from datetime import time
-from random import randint
+from random import choice
 
 import channels.layers
+import redis
 from asgiref.sync import async_to_sync
 from autoslug import AutoSlugField
+from channels.exceptions import ChannelFull
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.auth.signals import user_logged_in
 from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.db.models import (
     Case,
     Count,
@@ -44,10 +51,97 @@ from location_field.models.plain import PlainLocationField
 from markdownfield.models import MarkdownField, RenderedMarkdownField
 from markdownfield.validators import VALIDATOR_STANDARD
 from pytz import timezone as pytz_timezone
+from user_agents import parse
 
 logger = logging.getLogger(__name__)
 
 
+def send_permissions_changed(group):
+    """Websocket consumers cache permission checks for as long as they're connected, see LotConsumer.permission_error()
+    Call this when something those checks depend on changes.  group is lot_<pk>, permissions_user_<pk> or permissions_auction_<pk>"""
+
+    def send():
+        try:
+            channel_layer = channels.layers.get_channel_layer()
+            async_to_sync(channel_layer.group_send)(group, {"type": "permissions_changed"})
+        except Exception as e:
+            logger.exception(e)
+
+    transaction.on_commit(send)
+
+
+# the closelots command listens on this channel
+LOT_CLOSING_CHANNEL = "lot_closing"
+# page views waiting to be saved by the flush_pageviews command, see buffer_pageview()
+PAGEVIEW_BUFFER_KEY = "pageview_buffer"
+
+
+def send_lot_end_changed(lot_pk, date_end):
+    """Tell the lot closing scheduler (see the closelots command) that a lot's end time has changed, so it can wake up at the new time"""
+
+    def send():
+        try:
+            channel_layer = channels.layers.get_channel_layer()
+            async_to_sync(channel_layer.send)(
+                LOT_CLOSING_CHANNEL,
+                {"type": "lot_end_changed", "lot": lot_pk, "date_end": date_end.timestamp()},
+            )
+        except ChannelFull:
+            # closelots isn't running; endauctions will still close this lot
+            logger.debug("lot closing channel is full, not rescheduling lot %s", lot_pk)
+        except Exception as e:
+            logger.exception(e)
+
+    transaction.on_commit(send)
+
+
+def mark_invoices_for_recalculation(invoices):
+    """Flag a queryset of invoices as needing their calculated_total updated, see recalculate_dirty_invoices()"""
+    invoices.update(recalculate_requested=timezone.now())
+
+
+def load_invoices_with_totals(invoices):
+    """A list of the invoices in a queryset, with their totals (see Invoice.totals) already added up for all of them at once"""
+    invoices_with_totals = list(invoices.select_related("auction"))
+    totals = InvoiceTotals.for_invoices(invoices)
+    for invoice in invoices_with_totals:
+        invoice._totals = totals.get(invoice.pk)
+    return invoices_with_totals
+
+
+def recalculate_invoices(invoices):
+    """Set calculated_total on a queryset of invoices right now, in a handful of queries no matter how many invoices there are.
+    Same result as calling Invoice.recalculate on each one"""
+    invoices_with_totals = load_invoices_with_totals(invoices)
+    for invoice in invoices_with_totals:
+        invoice.calculated_total = invoice.rounded_net
+    Invoice.objects.bulk_update(invoices_with_totals, ["calculated_total"], batch_size=500)
+    return invoices_with_totals
+
+
+def recalculate_dirty_invoices(invoices=None):
+    """Update calculated_total on invoices flagged by mark_invoices_for_recalculation(), once each no matter how many lots sold in the meantime.
+    An invoice flagged again while this is running stays flagged for next time.  Returns the number of invoices updated"""
+    if invoices is None:
+        invoices = Invoice.objects.all()
+    invoices = invoices.filter(recalculate_requested__isnull=False)
+    count = 0
+    for invoice in load_invoices_with_totals(invoices):
+        try:
+            Invoice.objects.filter(pk=invoice.pk).update(
+                calculated_total=invoice.rounded_net,
+                recalculate_requested=Case(
+                    When(recalculate_requested=invoice.recalculate_requested, then=None),
+                    default=F("recalculate_requested"),
+                    output_field=models.DateTimeField(),
+                ),
+            )
+            count += 1
+        except Exception as e:
+            logger.exception(e)
+    return count
+
+
 def nearby_auctions(
     latitude,
     longitude,
@@ -258,6 +352,19 @@ def distance_to(
     return distance_raw_sql
 
 
+def distance_between(latitude, longitude, other_latitude, other_longitude, unit="miles", approximate_distance_to=10):
+    """The same distance as distance_to(), calculated in Python for when both locations are already loaded"""
+    if unit == "miles":
+        correction = 0.6213712  # close enough
+    else:
+        correction = 1  # km
+    cos_angle = math.cos(math.radians(latitude)) * math.cos(math.radians(other_latitude)) * math.cos(
+        math.radians(other_longitude) - math.radians(longitude)
+    ) + math.sin(math.radians(latitude)) * math.sin(math.radians(other_latitude))
+    distance = 6371 * math.acos(min(max(cos_angle, -1), 1))
+    return math.ceil(distance * correction / approximate_distance_to) * approximate_distance_to
+
+
 def add_tos_info(qs):
     """Add fields to a given AuctionTOS queryset."""
     if not (isinstance(qs, QuerySet) and qs.model == AuctionTOS):
@@ -341,6 +448,57 @@ def add_tos_info(qs):
     )
 
 
+def add_tos_report_info(qs, auction):
+    """Add the per-user columns of the auction report (see views.auctionReport) to a given AuctionTOS queryset, as subqueries"""
+    if not (isinstance(qs, QuerySet) and qs.model == AuctionTOS):
+        msg = "must be passed a queryset of the AuctionTOS model"
+        raise TypeError(msg)
+
+    def count(subquery, group_by):
+        return Coalesce(
+            Subquery(
+                subquery.order_by().values(group_by).annotate(count=Count("*")).values("count"),
+                output_field=IntegerField(),
+            ),
+            0,
+        )
+
+    lots = Lot.objects.exclude(is_deleted=True)
+    if auction.is_online:
+        outside_auction_end = auction.date_end + datetime.timedelta(days=2)
+    else:
+        outside_auction_end = auction.date_start + datetime.timedelta(days=5)
+    lots_outside_auction = lots.filter(
+        user=OuterRef("user"),
+        auction__isnull=True,
+        date_posted__gte=auction.date_start - datetime.timedelta(days=2),
+        date_posted__lte=outside_auction_end,
+    )
+    return qs.annotate(
+        pageview_count=count(PageView.objects.filter(user=OuterRef("user"), lot_number__auction=auction), "user"),
+        bid_count=count(
+            Bid.objects.exclude(is_deleted=True).filter(user=OuterRef("user"), lot_number__auction=auction), "user"
+        ),
+        lots_submitted_count=count(lots.filter(auctiontos_seller=OuterRef("pk"), auction=auction), "auctiontos_seller"),
+        lots_won_count=count(lots.filter(auctiontos_winner=OuterRef("pk"), auction=auction), "auctiontos_winner"),
+        breeder_points_count=count(
+            lots.filter(auctiontos_seller=OuterRef("pk"), auction=auction, i_bred_this_fish=True), "auctiontos_seller"
+        ),
+        lots_outside_auction=count(lots_outside_auction, "user"),
+        value_outside_auction=Coalesce(
+            Subquery(
+                lots_outside_auction.order_by().values("user").annotate(total=Sum("winning_price")).values("total"),
+                output_field=IntegerField(),
+            ),
+            0,
+        ),
+        other_auctions_joined=count(
+            AuctionTOS.objects.filter(user=OuterRef("user")).exclude(pk=OuterRef("pk")), "user"
+        ),
+        userban_count=count(UserBan.objects.filter(banned_user=OuterRef("user")), "banned_user"),
+    )
+
+
 def add_tos_distance_info(qs):
     """Add a distance_traveled to an auctiontos query"""
     if not (isinstance(qs, QuerySet) and qs.model == AuctionTOS):
@@ -367,14 +525,19 @@ def add_tos_distance_info(qs):
 
 def guess_category(text):
     """Given some text, look up lots with similar names and make a guess at the category this `text` belongs to based on the category used there"""
-    keywords = []
-    words = re.findall("[A-Z|a-z]{3,}", text.lower())
-    for word in words:
-        if word not in settings.IGNORE_WORDS:
-            keywords.append(word)
-
-    if not keywords:
-        return None
+    return guess_categories([text])[0]
+
+
+def guess_categories(texts):
+    """guess_category() for lots of text at once.  Lots with names similar to any of the texts are loaded with one query,
+    returns a list of categories (or None) in the same order as texts"""
+    keyword_lists = []
+    for text in texts:
+        words = re.findall("[A-Z|a-z]{3,}", text.lower())
+        keyword_lists.append([word for word in words if word not in settings.IGNORE_WORDS])
+    all_keywords = {keyword for keywords in keyword_lists for keyword in keywords}
+    if not all_keywords:
+        return [None for text in texts]
     lot_qs = (
         Lot.objects.exclude(is_deleted=True)
         .filter(
@@ -386,26 +549,128 @@ def guess_category(text):
         .exclude(auction__promote_this_auction=False)
     )
     q_objects = Q()
-    for keyword in keywords:
+    for keyword in all_keywords:
         q_objects |= Q(lot_name__iregex=rf"\b{re.escape(keyword)}\b")
-
-    lot_qs = lot_qs.filter(q_objects)
+    similar_lots = list(lot_qs.filter(q_objects).values_list("lot_name", "species_category"))
+    patterns = {keyword: re.compile(rf"\b{re.escape(keyword)}\b", re.IGNORECASE) for keyword in all_keywords}
 
     # category = lot_qs.values('species_category').annotate(count=Count('species_category')).order_by('-count').first()
     # attempting this as a single-shot query is extremely difficult to debug
-    categories = {}
-    for lot in lot_qs:
-        matches = 0
-        for keyword in keywords:
-            if keyword in lot.lot_name.lower():
-                matches += 1
-        category_total = categories.get(lot.species_category.pk, 0)
-        categories[lot.species_category.pk] = category_total + matches
-    sorted_categories = sorted(categories.items(), key=lambda x: x[1], reverse=True)
-    for key, value in sorted_categories:
-        logger.debug("%s, %s", Category.objects.filter(pk=key).first(), value)
-        return Category.objects.filter(pk=key).first()
-    return None
+    best_categories = []
+    for keywords in keyword_lists:
+        categories = {}
+        for lot_name, category in similar_lots:
+            if not any(patterns[keyword].search(lot_name) for keyword in keywords):
+                continue
+            matches = 0
+            for keyword in keywords:
+                if keyword in lot_name.lower():
+                    matches += 1
+            categories[category] = categories.get(category, 0) + matches
+        sorted_categories = sorted(categories.items(), key=lambda x: x[1], reverse=True)
+        best_categories.append(sorted_categories[0][0] if sorted_categories else None)
+    found = Category.objects.in_bulk({pk for pk in best_categories if pk})
+    return [found.get(pk) for pk in best_categories]
+
+
+def create_lots(lots):
+    """Save lots of new lots with bulk_create().  This does what Lot.save() and update_lot_info() do for each new lot, but once per batch:
+    lot numbers are allocated as a range, categories are guessed in one pass, UserData is loaded with one query, and each seller's invoice is made once.
+    Every lot must be unsaved and in an auction.  Returns the lots"""
+    if not lots:
+        return lots
+    user_pks = {lot.user_id for lot in lots if lot.user_id}
+    userdata = {data.user_id: data for data in UserData.objects.filter(user__in=user_pks)}
+    for user_pk in user_pks - set(userdata):
+        userdata[user_pk] = UserData.objects.create(user_id=user_pk)
+    next_lot_numbers = {}
+    next_custom_lot_numbers = {}
+    uncategorized = None
+    to_categorize = []
+    invoices = {}
+    for lot in lots:
+        auction = lot.auction
+        # update_lot_info()
+        lot.date_end = auction.date_end
+        if lot.user_id:
+            lot.latitude = userdata[lot.user_id].latitude
+            lot.longitude = userdata[lot.user_id].longitude
+            lot.address = userdata[lot.user_id].address
+        for tos in [lot.auctiontos_seller, lot.auctiontos_winner]:
+            if tos:
+                invoices[(tos.pk, auction.pk)] = (tos, auction)
+        if not lot.reserve_price or lot.reserve_price < auction.minimum_bid:
+            lot.reserve_price = auction.minimum_bid
+        # Lot.save()
+        if lot.lot_number_int is None:
+            if auction.pk not in next_lot_numbers:
+                count = len(
+                    [other for other in lots if other.auction_id == auction.pk and other.lot_number_int is None]
+                )
+                next_lot_numbers[auction.pk] = LotNumberSequence.allocate(auction, count)
+            lot.lot_number_int = next_lot_numbers[auction.pk]
+            next_lot_numbers[auction.pk] += 1
+        if not lot.custom_lot_number and auction.use_seller_dash_lot_numbering and lot.auctiontos_seller:
+            seller = lot.auctiontos_seller
+            if seller.pk not in next_custom_lot_numbers:
+                next_custom_lot_numbers[seller.pk] = 1
+                for custom_lot_number in seller.lots_qs.values_list("custom_lot_number", flat=True):
+                    match = re.findall(r"\d+", f"{custom_lot_number}")
+                    if match:
+                        next_custom_lot_numbers[seller.pk] = max(next_custom_lot_numbers[seller.pk], int(match[-1]) + 1)
+            lot.custom_lot_number = f"{seller.bidder_number}-{next_custom_lot_numbers[seller.pk]}"[:9]
+            next_custom_lot_numbers[seller.pk] += 1
+        if not lot.category_checked and (not lot.species_category or lot.species_category.pk == 21):
+            lot.category_checked = True
+            if not auction.use_categories:
+                # force uncategorized for non-fish auctions
+                if not uncategorized:
+                    uncategorized = Category.objects.filter(pk=21).first()
+                lot.species_category = uncategorized
+            else:
+                to_categorize.append(lot)
+        if not lot.reference_link:
+            search = lot.lot_name.replace(" ", "%20")
+            lot.reference_link = f"https://www.google.com/search?q={search}&tbm=isch"
+        lot.force_donation_under_threshold()
+        lot.update_bid_book(top_bids=[], save=False)
+    for lot, category in zip(to_categorize, guess_categories([lot.lot_name for lot in to_categorize])):
+        if category:
+            lot.species_category = category
+            lot.category_automatically_added = True
+    for tos, auction in invoices.values():
+        Invoice.objects.get_or_create(auctiontos_user=tos, auction=auction, defaults={})
+    Lot.objects.bulk_create(lots)
+    for auction_pk in {lot.auction_id for lot in lots if lot.pk is None}:
+        # MySQL doesn't return the pks of rows made by bulk_create(), but lot numbers are unique within an auction
+        auction_lots = [lot for lot in lots if lot.auction_id == auction_pk]
+        pks = dict(
+            Lot.objects.filter(
+                auction=auction_pk, lot_number_int__in=[lot.lot_number_int for lot in auction_lots]
+            ).values_list("lot_number_int", "pk")
+        )
+        for lot in auction_lots:
+            lot.pk = pks.get(lot.lot_number_int)
+    # chat history subscription for the owner
+    now = timezone.now()
+    ChatSubscription.objects.bulk_create(
+        [
+            ChatSubscription(
+                user_id=lot.user_id,
+                lot=lot,
+                unsubscribed=not userdata[lot.user_id].email_me_when_people_comment_on_my_lots,
+                last_notification_sent=now,
+                last_seen=now,
+            )
+            for lot in lots
+            if lot.user_id
+        ]
+    )
+    for lot in lots:
+        lot._loaded_values = {"banned": lot.banned, "date_end": lot.date_end}
+        if lot.date_end and lot.active:
+            send_lot_end_changed(lot.pk, lot.date_end)
+    return lots
 
 
 class BlogPost(models.Model):
@@ -1042,10 +1307,7 @@ class Auction(models.Model):
     @property
     def invoice_recalculate(self):
         """Force update of all invoice totals in this auction"""
-        invoices = Invoice.objects.filter(auction=self.pk)
-        for invoice in invoices:
-            invoice.recalculate
-            invoice.save()
+        recalculate_invoices(Invoice.objects.filter(auction=self.pk))
 
     @property
     def number_of_confirmed_tos(self):
@@ -1380,6 +1642,27 @@ class Auction(models.Model):
         """For use in querysets, pks only"""
         return self.auction_admins_qs.values_list("user__pk", flat=True)
 
+    # fields that websocket consumers check before allowing bids, see consumers.check_bidder_permissions()
+    bidding_permission_fields = ["is_online", "online_bidding"]
+    # values as loaded from the database, see from_db()
+    _loaded_values = {}
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # see save(), used to tell websocket consumers when online bidding is turned on or off
+        instance._loaded_values = {field: instance.__dict__.get(field) for field in cls.bidding_permission_fields}
+        return instance
+
+    def save(self, *args, **kwargs):
+        bidding_changed = self.pk and any(
+            self._loaded_values.get(field) != self.__dict__.get(field) for field in self.bidding_permission_fields
+        )
+        super().save(*args, **kwargs)
+        if bidding_changed:
+            send_permissions_changed(f"permissions_auction_{self.pk}")
+        self._loaded_values = {field: self.__dict__.get(field) for field in self.bidding_permission_fields}
+
 
 class PickupLocation(models.Model):
     """
@@ -1531,6 +1814,217 @@ class AuctionIgnore(models.Model):
         verbose_name_plural = "User ignoring auction"
 
 
+class BidderNumberAllocator:
+    """Picks unused bidder numbers for an auction.  The numbers already in use are loaded once,
+    so picking lots of numbers (for example, when importing users) doesn't run a query for each candidate.
+    Two people joining at the same time can still be given the same number; the unique constraint on AuctionTOS catches that, see AuctionTOS.save()
+    """
+
+    # bidder numbers that look like ages, see is_free()
+    dont_use_these = ["13", "14", "15", "16", "17", "18", "19"]
+
+    def __init__(self, auction):
+        self.auction = auction
+        self.last_numbers = {}
+        self.reload()
+
+    def reload(self):
+        self.used = set(AuctionTOS.objects.filter(auction=self.auction).values_list("bidder_number", flat=True))
+
+    def preload_last_numbers(self, emails):
+        """Look up the numbers that a lot of people used in this club's previous auctions with one query, see last_number()"""
+        emails = [email for email in emails if email and email not in self.last_numbers]
+        for email in emails:
+            self.last_numbers[email] = None
+        previous = (
+            AuctionTOS.objects.filter(auction__created_by=self.auction.created_by, email__in=emails)
+            .order_by("auction__date_posted")
+            .values_list("email", "bidder_number")
+        )
+        # the most recent auction wins
+        for email, bidder_number in previous:
+            self.last_numbers[email] = bidder_number
+
+    def last_number(self, email):
+        """The bidder number this email had in the most recent auction run by the same person"""
+        if email not in self.last_numbers:
+            self.preload_last_numbers([email])
+        return self.last_numbers.get(email)
+
+    def is_free(self, number):
+        number = str(number)
+        return bool(number) and number != "None" and number[:-2] not in self.dont_use_these and number not in self.used
+
+    def candidates(self, tos, userdata=None):
+        """Numbers to try for this person, best first: the number from their last auction,
+        then their preferred number, or the last digits of their phone number or address"""
+        yield self.last_number(tos.email) if tos.email else None
+        search = None
+        if tos.phone_number:
+            search = re.search(r"([\d]{3}$)|$", tos.phone_number).group()
+        if not search or str(search) in self.dont_use_these:
+            if tos.address:
+                search = re.search(r"([\d]{3}$)|$", tos.address).group()
+        if userdata and userdata.preferred_bidder_number:
+            search = userdata.preferred_bidder_number
+        # bidder numbers shouldn't start with 0
+        yield str(search or "").lstrip("0")
+
+    def random_number(self):
+        free = [number for number in range(1, 1000) if self.is_free(number)]
+        if free:
+            return str(choice(free))
+        # someone made 999 accounts and had them all join this auction
+        number = 1000
+        while not self.is_free(number):
+            number += 1
+        return str(number)
+
+    def allocate(self, tos, userdata=None):
+        """Pick a number for this AuctionTOS and mark it as used.  Also sets the user's preferred_bidder_number if it's not set"""
+        if tos.user and not userdata:
+            userdata, created = UserData.objects.get_or_create(user=tos.user, defaults={})
+        candidates = self.candidates(tos, userdata)
+        number = next(candidates)
+        if not (number and number not in self.used):
+            number = next(candidates)
+            if not self.is_free(number):
+                number = self.random_number()
+            if userdata and not userdata.preferred_bidder_number:
+                userdata.preferred_bidder_number = number
+                userdata.save()
+        self.used.add(number)
+        return number
+
+
+class AuctionTOSImporter:
+    """Adds lots of people to an auction at once, see BulkAddUsers.
+    The people already in the auction are loaded once, and each batch of rows looks up email statuses and previous bidder numbers with one query each
+    and is saved with bulk_create().  bulk_create() skips AuctionTOS.save(), so what save() does for new, manually added people is done in add() instead
+    """
+
+    # rows are passed to add() this many at a time
+    batch_size = 500
+    # values in the club member column that mean no
+    not_club_member = ["", "no", "n", "false", "0"]
+    # everyone added needs a pickup location, this is shown instead of adding anyone if the auction doesn't have one
+    no_pickup_location_error = "This auction doesn't have a pickup location yet, add one before adding people"
+
+    def __init__(self, auction):
+        self.auction = auction
+        self.allocator = BidderNumberAllocator(auction)
+        self.pickup_location = auction.location_qs.first()
+        self.emails = set()
+        self.names = set()
+        for email, name in AuctionTOS.objects.filter(auction=auction).values_list("email", "name"):
+            self.remember(name, email)
+        self.added = 0
+        self.skipped = 0
+        self.errors = []
+
+    def remember(self, name, email):
+        if email:
+            self.emails.add(email.lower())
+        elif name:
+            self.names.add(name)
+
+    def is_in_auction(self, name, email):
+        """Matched by email, or by name if there's no email"""
+        if email:
+            return email.lower() in self.emails
+        return bool(name) and name in self.names
+
+    def build(self, row):
+        """Make an unsaved AuctionTOS from a dict with name, email, phone_number, address, bidder_number and is_club_member keys.
+        Raises ValidationError if the row can't be added"""
+        tos = AuctionTOS(
+            auction=self.auction,
+            pickup_location=self.pickup_location,
+            bidder_number=str(row.get("bidder_number") or "").strip(),
+            name=str(row.get("name") or "").strip(),
+            email=str(row.get("email") or "").strip() or None,
+            phone_number=str(row.get("phone_number") or "").strip() or None,
+            address=str(row.get("address") or "").strip() or None,
+            is_club_member=str(row.get("is_club_member") or "").strip().lower() not in self.not_club_member,
+            manually_added=True,
+            memo="",
+        )
+        if not tos.name:
+            msg = "Name is required"
+            raise ValidationError(msg)
+        tos.clean_fields(exclude=["auction", "pickup_location", "user"])
+        if tos.bidder_number and tos.bidder_number in self.allocator.used:
+            msg = f"Bidder number {tos.bidder_number} is already in use"
+            raise ValidationError(msg)
+        return tos
+
+    def add(self, rows):
+        """Add a batch of rows, skipping people that are already in the auction.  Returns the new AuctionTOS"""
+        if not self.pickup_location:
+            self.errors.append(self.no_pickup_location_error)
+            return []
+        new_tos = []
+        for row in rows:
+            if self.is_in_auction(row.get("name"), row.get("email")):
+                self.skipped += 1
+                continue
+            try:
+                tos = self.build(row)
+            except ValidationError as e:
+                self.errors.append(f"{row.get('name') or row.get('email')}: {' '.join(e.messages)}")
+                continue
+            if tos.bidder_number:
+                self.allocator.used.add(tos.bidder_number)
+            self.remember(tos.name, tos.email)
+            new_tos.append(tos)
+        if not new_tos:
+            return []
+        emails = [tos.email for tos in new_tos if tos.email]
+        self.allocator.preload_last_numbers(emails)
+        email_statuses = dict(
+            AuctionTOS.objects.exclude(email_address_status="UNKNOWN")
+            .filter(email__in=emails, auction__created_by=self.auction.created_by)
+            .order_by("createdon")
+            .values_list("email", "email_address_status")
+        )
+        # model instances can't be hashed before they're saved
+        auto_numbered = set()
+        for tos in new_tos:
+            if not tos.bidder_number:
+                tos.bidder_number = self.allocator.allocate(tos)
+                auto_numbered.add(id(tos))
+            # the most recent status wins, same as AuctionTOS.save()
+            tos.email_address_status = email_statuses.get(tos.email, "UNKNOWN")
+            if self.auction.only_approved_sellers:
+                tos.selling_allowed = False
+            # anyone manually added can bid, even with only_approved_bidders
+        for attempt in range(5):
+            try:
+                with transaction.atomic():
+                    AuctionTOS.objects.bulk_create(new_tos)
+                break
+            except IntegrityError:
+                self.allocator.reload()
+                # retried only when someone joined while this was running and got one of these numbers
+                if attempt == 4 or not any(tos.bidder_number in self.allocator.used for tos in new_tos):
+                    raise
+                chosen = [tos for tos in new_tos if id(tos) not in auto_numbered]
+                for tos in chosen:
+                    if tos.bidder_number in self.allocator.used:
+                        self.errors.append(f"{tos.name}: Bidder number {tos.bidder_number} is already in use")
+                        new_tos.remove(tos)
+                    else:
+                        self.allocator.used.add(tos.bidder_number)
+                for tos in new_tos:
+                    if id(tos) in auto_numbered:
+                        tos.bidder_number = self.allocator.allocate(tos)
+        self.added += len(new_tos)
+        # see AuctionTOS.save(), users with these emails can now bid
+        for user in User.objects.filter(email__in=emails).values_list("pk", flat=True):
+            send_permissions_changed(f"permissions_user_{user}")
+        return new_tos
+
+
 class AuctionTOS(models.Model):
     """Models how a user engages with an auction and is the basis for the user view when running an auction
     Usually this will correspond with a single person which may or may not also be a user"""
@@ -1538,7 +2032,7 @@ class AuctionTOS(models.Model):
     user = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True)
     auction = models.ForeignKey(Auction, on_delete=models.CASCADE)
     pickup_location = models.ForeignKey(PickupLocation, on_delete=models.CASCADE)
-    createdon = models.DateTimeField(auto_now_add=True, blank=True)
+    createdon = models.DateTimeField(auto_now_add=True, db_index=True, blank=True)
     confirm_email_sent = models.BooleanField(default=False, blank=True)
     second_confirm_email_sent = models.BooleanField(default=False, blank=True)
     print_reminder_email_sent = models.BooleanField(default=False, blank=True)
@@ -1727,11 +2221,10 @@ class AuctionTOS(models.Model):
             return self.invoice.total_sold_club_cut
         return 0
 
-    def save(self, *args, **kwargs):
-        def check_number_in_auction(number):
-            """See if any other auctiontos are currently using a given bidder number"""
-            return AuctionTOS.objects.filter(bidder_number=number, auction=self.auction).count()
+    # values as loaded from the database, see from_db()
+    _loaded_values = {}
 
+    def save(self, *args, **kwargs):
         if not self.pk:
             # logger.debug("new instance of auctionTOS")
             if self.auction.only_approved_sellers:
@@ -1778,53 +2271,10 @@ class AuctionTOS(models.Model):
         # if not self.address:
         # self.address = userData.address
         # set the bidder number based on the phone, address, last used number, or just at random
+        allocator = None
         if not self.bidder_number or self.bidder_number == "None":
-            # recycle numbers from the last auction if we can
-            last_number_used = (
-                AuctionTOS.objects.filter(auction__created_by=self.auction.created_by, email=self.email)
-                .order_by("-auction__date_posted")
-                .first()
-            )
-            if self.email and last_number_used and check_number_in_auction(last_number_used.bidder_number) == 0:
-                self.bidder_number = last_number_used.bidder_number
-            else:
-                dont_use_these = ["13", "14", "15", "16", "17", "18", "19"]
-                search = None
-                if self.phone_number:
-                    search = re.search(r"([\d]{3}$)|$", self.phone_number).group()
-                if not search or str(search) in dont_use_these:
-                    if self.address:
-                        search = re.search(r"([\d]{3}$)|$", self.address).group()
-                if self.user:
-                    userData, created = UserData.objects.get_or_create(
-                        user=self.user,
-                        defaults={},
-                    )
-                    if userData.preferred_bidder_number:
-                        search = userData.preferred_bidder_number
-                # I guess it's possible that someone could make 999 accounts and have them all join a single auction, which would turn this into an infinite loop
-                failsafe = 0
-                # bidder numbers shouldn't start with 0
-                try:
-                    if str(search)[0] == "0":
-                        search = search[1:]
-                    if str(search)[0] == "0":
-                        search = search[1:]
-                except:
-                    pass
-                while failsafe < 6000:
-                    search = str(search)
-                    if search[:-2] not in dont_use_these and search != "None":
-                        if check_number_in_auction(search) == 0:
-                            self.bidder_number = search
-                            if self.user:
-                                if not userData.preferred_bidder_number:
-                                    userData.preferred_bidder_number = search
-                                    userData.save()
-                            break
-                    # OK, give up and just randomly generate something
-                    search = randint(1, 999)
-                    failsafe += 1
+            allocator = BidderNumberAllocator(self.auction)
+            self.bidder_number = allocator.allocate(self)
         if not self.bidder_number:
             # I don't ever want this to be null
             self.bidder_number = "ERROR"
@@ -1849,7 +2299,36 @@ class AuctionTOS(models.Model):
             )
             if existing_instance:
                 self.email_address_status = existing_instance.email_address_status
-        super().save(*args, **kwargs)
+        bidding_allowed_changed = self._loaded_values.get("bidding_allowed") != self.bidding_allowed
+        for attempt in range(5):
+            try:
+                with transaction.atomic():
+                    super().save(*args, **kwargs)
+                break
+            except IntegrityError:
+                # someone else joined at the same moment and got the same number
+                if not allocator or attempt == 4:
+                    raise
+                allocator.reload()
+                self.bidder_number = allocator.allocate(self)
+        if bidding_allowed_changed or self._loaded_values.get("user_id") != self.user_id:
+            # joining, or an admin approving or blocking a bidder
+            users = [self.user_id] if self.user_id else []
+            if self.email:
+                users += list(User.objects.filter(email=self.email).values_list("pk", flat=True))
+            for user in set(users):
+                send_permissions_changed(f"permissions_user_{user}")
+        self._loaded_values = {"bidding_allowed": self.bidding_allowed, "user_id": self.user_id}
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # see save(), used to tell websocket consumers when bidding_allowed changes
+        instance._loaded_values = {
+            "bidding_allowed": instance.__dict__.get("bidding_allowed"),
+            "user_id": instance.__dict__.get("user_id"),
+        }
+        return instance
 
     @property
     def display_name_for_admins(self):
@@ -1867,10 +2346,13 @@ class AuctionTOS(models.Model):
         # return f"{self.user} will meet at {self.pickup_location} for {self.auction}"
         if self.auction.is_online:
             if self.user and not self.manually_added:
-                userData, created = UserData.objects.get_or_create(
-                    user=self.user,
-                    defaults={},
-                )
+                # userdata may already have been loaded with select_related
+                userData = getattr(self.user, "userdata", None)
+                if not userData:
+                    userData, created = UserData.objects.get_or_create(
+                        user=self.user,
+                        defaults={},
+                    )
                 if userData.username_visible:
                     return self.user.username
                 else:
@@ -1885,6 +2367,9 @@ class AuctionTOS(models.Model):
     class Meta:
         verbose_name = "User in auction"
         verbose_name_plural = "Users in auction"
+        constraints = [
+            models.UniqueConstraint(fields=["auction", "bidder_number"], name="unique_bidder_number_in_auction"),
+        ]
 
     @property
     def closest_location_for_this_user(self):
@@ -2020,6 +2505,35 @@ class AuctionTOS(models.Model):
         return ""
 
 
+class LotNumberSequence(models.Model):
+    """The last lot number handed out in an auction, see allocate()
+    Lot numbers used to be Max(lot_number_int) + 1, which reads every lot in the auction and could give two lots created at the same moment the same number"""
+
+    auction = models.OneToOneField(Auction, on_delete=models.CASCADE)
+    last_lot_number = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.auction} at lot {self.last_lot_number}"
+
+    @classmethod
+    def allocate(cls, auction, count=1):
+        """Reserve `count` lot numbers in this auction and return the first one"""
+        with transaction.atomic():
+            # the update locks this auction's row until the transaction commits, so nobody else can be given the same numbers
+            if not cls.objects.filter(auction=auction).update(last_lot_number=F("last_lot_number") + count):
+                # the first lot number for this auction, carry on from the lots that are already in it
+                # This is deliberately not excluding deleted and removed lots -- don't use auction.lots_qs here
+                max_number = Lot.objects.filter(auction=auction).aggregate(Max("lot_number_int"))["lot_number_int__max"]
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(auction=auction, last_lot_number=(max_number or 0) + count)
+                except IntegrityError:
+                    # someone else got here first
+                    cls.objects.filter(auction=auction).update(last_lot_number=F("last_lot_number") + count)
+            last_lot_number = cls.objects.filter(auction=auction).values_list("last_lot_number", flat=True).get()
+        return last_lot_number - count + 1
+
+
 class Lot(models.Model):
     """A lot is something to bid on"""
 
@@ -2091,7 +2605,7 @@ class Lot(models.Model):
         verbose_name="Category",
     )
     species_category.help_text = "An accurate category will help people find this lot more easily"
-    date_posted = models.DateTimeField(auto_now_add=True, blank=True)
+    date_posted = models.DateTimeField(auto_now_add=True, db_index=True, blank=True)
     last_bump_date = models.DateTimeField(null=True, blank=True)
     last_bump_date.help_text = (
         "Any time a lot is bumped, this date gets changed.  It's used for sorting by newest lots."
@@ -2168,6 +2682,18 @@ class Lot(models.Model):
         "Uncheck to prevent chatting on this lot.  This will not remove any existing chat messages"
     )
     buy_now_used = models.BooleanField(default=False)
+    # values as loaded from the database, see from_db()
+    _loaded_values = {}
+    # The bid book is a copy of the top two bids on this lot, so high_bid, high_bidder and max_bid don't need to query Bid
+    # It's kept current by update_bid_book(), see that for details
+    bid_book_current = models.BooleanField(default=True)
+    bid_book_high_bidder = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+    bid_book_max_bid = models.PositiveIntegerField(null=True, blank=True)
+    bid_book_second_bid = models.PositiveIntegerField(null=True, blank=True)
+    bid_book_last_bid_time = models.DateTimeField(null=True, blank=True)
+    # the reserve price and end time the book was built with, bids outside of these aren't in it
+    bid_book_reserve_price = models.PositiveIntegerField(null=True, blank=True)
+    bid_book_end = models.DateTimeField(null=True, blank=True)
 
     # Location, populated from userdata.  This is needed to prevent users from changing their address after posting a lot
     latitude = models.FloatField(blank=True, null=True)
@@ -2206,13 +2732,7 @@ class Lot(models.Model):
     def save(self, *args, **kwargs):
         # for old and new auctions, generate a lot number int
         if self.lot_number_int is None and self.auction:
-            minimum_lot_number = 1
-            # Get the current maximum lot_number_int for the auction
-            # This is deliberately not excluding deleted and removed lots -- don't use auction.lots_qs here
-            max_number = Lot.objects.filter(auction=self.auction).aggregate(Max("lot_number_int"))[
-                "lot_number_int__max"
-            ]
-            self.lot_number_int = (max_number or (minimum_lot_number - 1)) + 1
+            self.lot_number_int = LotNumberSequence.allocate(self.auction)
         # custom lot number set for old auctions: bidder_number-lot_number format
         if not self.custom_lot_number and self.auction and self.auction.use_seller_dash_lot_numbering:
             if self.auctiontos_seller:
@@ -2253,14 +2773,28 @@ class Lot(models.Model):
         # when an auction is set to be buy now only
         # if self.auction and self.auction.online_bidding == "buy_now_only":
         #    self.reserve_price = self.buy_now_price
-        if (
-            self.auction
-            and self.auction.force_donation_threshold
-            and self.winning_price
-            and self.winning_price <= self.auction.force_donation_threshold
-        ):
-            self.donation = True
+        self.force_donation_under_threshold()
+        if self.pk is None:
+            # a brand new (or copied, see endauctions relisting) lot has no bids yet
+            self.update_bid_book(top_bids=[], save=False)
+        banned_changed = self._loaded_values.get("banned", False) != self.banned
+        # deferred fields would be loaded just to compare them, and a deferred date_end can't have been changed anyway
+        date_end_changed = "date_end" in self.__dict__ and self._loaded_values.get("date_end") != self.date_end
+        if self.pk is not None and not self._state.adding and not args and kwargs.get("update_fields") is None:
+            # the bid book is only written by update_bid_book(), so don't overwrite it with whatever was loaded with this lot.
+            # Deferred fields are left out, the same as a plain save() does
+            deferred = self.get_deferred_fields()
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.bid_book_fields and field.attname not in deferred
+            ]
         super().save(*args, **kwargs)
+        if banned_changed:
+            send_permissions_changed(f"lot_{self.pk}")
+        if date_end_changed and self.date_end and self.active:
+            send_lot_end_changed(self.pk, self.date_end)
+        self._loaded_values = {"banned": self.banned, "date_end": self.__dict__.get("date_end")}
 
         # chat history subscription for the owner
         if self.user:
@@ -2275,6 +2809,16 @@ class Lot(models.Model):
     def __str__(self):
         return "" + str(self.lot_number_display) + " - " + self.lot_name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # see save(), used to tell websocket consumers when a lot is removed and the closing scheduler when a lot's end changes
+        instance._loaded_values = {
+            "banned": instance.__dict__.get("banned"),
+            "date_end": instance.__dict__.get("date_end"),
+        }
+        return instance
+
     def add_winner_message(self, user, tos, winning_price):
         """Create a lot history message when a winner is declared (or changed)
         It's critical that this function is called every time the winner is changed so that invoices get recalculated"""
@@ -2293,22 +2837,48 @@ class Lot(models.Model):
         invoice = Invoice.objects.filter(auctiontos_user=tos, auction=self.auction).first()
         if not invoice:
             invoice = Invoice.objects.create(auctiontos_user=tos, auction=self.auction)
-        invoice.recalculate
-        self.send_websocket_message(
-            {
-                "type": "chat_message",
-                "info": "LOT_END_WINNER",
-                "message": message,
-                "high_bidder_pk": tos.user.pk if tos.user else -1,
-                "high_bidder_name": tos.display_name_for_admins,
-                "current_high_bid": winning_price,
-            }
-        )
+        invoice.mark_for_recalculation()
+        result = {
+            "type": "chat_message",
+            "info": "LOT_END_WINNER",
+            "message": message,
+            "high_bidder_pk": tos.user.pk if tos.user else -1,
+            "high_bidder_name": tos.display_name_for_admins,
+            "current_high_bid": winning_price,
+        }
+        self.send_websocket_message(result)
+        self.send_auction_websocket_message(result)
+
+    def force_donation_under_threshold(self):
+        """Cheap lots are donations in some auctions, see Auction.force_donation_threshold"""
+        if (
+            self.auction
+            and self.auction.force_donation_threshold
+            and self.winning_price
+            and self.winning_price <= self.auction.force_donation_threshold
+        ):
+            self.donation = True
 
     def send_websocket_message(self, message):
         channel_layer = channels.layers.get_channel_layer()
         async_to_sync(channel_layer.group_send)(f"lot_{self.pk}", message)
 
+    def send_auction_websocket_message(self, message):
+        """Pass the same message sent with send_websocket_message() to also tell the lot list and tile pages
+        for this lot's auction about the new price, high bidder and end time.  See AuctionConsumer"""
+        if not self.auction_id:
+            return
+        channel_layer = channels.layers.get_channel_layer()
+        async_to_sync(channel_layer.group_send)(f"auction_{self.auction_id}", self.auction_websocket_message(message))
+
+    def auction_websocket_message(self, message):
+        """The part of a lot_<pk> message that the auction_<pk> group needs"""
+        delta = {"type": "lot_delta", "lot": self.pk}
+        for key in ["info", "current_high_bid", "high_bidder_pk", "high_bidder_name", "date_end"]:
+            if key in message:
+                delta[key] = message[key]
+        return delta
+
     def refund(self, amount, user, message=None):
         """Call this to add a message when refunding a lot"""
         if amount and amount != self.partial_refund_percent:
@@ -2854,21 +3424,10 @@ class Lot(models.Model):
     @property
     def max_bid(self):
         """returns the highest bid amount for this lot - this number should not be visible to the public"""
-        allBids = (
-            Bid.objects.exclude(is_deleted=True)
-            .filter(
-                lot_number=self.lot_number,
-                last_bid_time__lte=self.calculated_end,
-                amount__gte=self.reserve_price,
-            )
-            .order_by("-amount", "last_bid_time")[:2]
-        )
-        try:
-            # $1 more than the second highest bid
-            bidPrice = allBids[0].amount
-            return bidPrice
-        except:
+        max_bid, second_bid, high_bidder = self.bid_book
+        if max_bid is None:
             return self.reserve_price
+        return max_bid
 
     @property
     def bids(self):
@@ -2890,42 +3449,114 @@ class Lot(models.Model):
         """returns the high bid amount for this lot"""
         if self.winning_price:
             return self.winning_price
+        max_bid, second_bid, high_bidder = self.bid_book
         if self.sealed_bid:
-            try:
-                bids = self.bids
-                return self.bids[0].amount
-            except:
-                return 0
+            return max_bid or 0
         else:
-            if self.auction and self.auction.online_bidding == "buy_now_only" and not self.bids:
+            if self.auction and self.auction.online_bidding == "buy_now_only" and max_bid is None:
                 if self.buy_now_price:
                     return self.buy_now_price
                 return ""
-            try:
-                bids = self.bids
-                # highest bid is the winner, but the second highest determines the price
-                if bids[0].amount == bids[1].amount:
-                    return bids[0].amount
-                else:
-                    # this is the old method: 1 dollar more than the second highest bidder
-                    # this would cause an issue if someone was tied for high bidder, and increased their proxy bid
-                    bidPrice = bids[1].amount + 1
-                    # instead, we'll just return the second highest bid in the case of a tie
-                    # bidPrice = bids[1].amount
-                return bidPrice
-            except IndexError:
-                return self.reserve_price
+            return self.price_from_bid_amounts(max_bid, second_bid)
+
+    @property
+    def top_bids(self):
+        """The two highest bids on this lot, highest first.  See price_from_top_bids()"""
+        return list(self.bids.select_related("user__userdata")[:2])
+
+    def price_from_top_bids(self, top_bids):
+        """Given the two highest bids on this lot (highest first), return the current price"""
+        amounts = [bid.amount for bid in top_bids[:2]] + [None, None]
+        return self.price_from_bid_amounts(amounts[0], amounts[1])
+
+    def price_from_bid_amounts(self, max_bid, second_bid):
+        """Given the amounts of the two highest bids on this lot (None if there aren't that many bids), return the current price"""
+        if max_bid is None or second_bid is None:
+            return self.reserve_price
+        # highest bid is the winner, but the second highest determines the price
+        if max_bid == second_bid:
+            return max_bid
+        else:
+            # this is the old method: 1 dollar more than the second highest bidder
+            # this would cause an issue if someone was tied for high bidder, and increased their proxy bid
+            bidPrice = second_bid + 1
+            # instead, we'll just return the second highest bid in the case of a tie
+            # bidPrice = second_bid
+        return bidPrice
+
+    @property
+    def bid_book_is_valid(self):
+        """The stored bid book can only be used if it was built with the current end time and reserve price.
+        Either one changing in either direction can add bids to the book or remove them from it"""
+        return (
+            self.bid_book_current
+            and self.bid_book_reserve_price == self.reserve_price
+            and self.bid_book_end == self.bid_book_cutoff
+        )
+
+    @property
+    def bid_book_cutoff(self):
+        """calculated_end, or None for a lot that has no end yet (calculated_end would be now, which never matches)"""
+        if self.date_end or self.is_part_of_in_person_auction:
+            return self.calculated_end
+        return None
+
+    @property
+    def bid_book(self):
+        """Returns max_bid, second_bid, high_bidder for this lot, any of which can be None.
+        Normally this does not query the Bid table at all, see update_bid_book()"""
+        if not self.bid_book_is_valid:
+            # only replace the book that was read, never one written by a bid placed since this lot was loaded
+            read_book = {
+                "bid_book_current": self.bid_book_current,
+                "bid_book_high_bidder": self.bid_book_high_bidder_id,
+                "bid_book_max_bid": self.bid_book_max_bid,
+                "bid_book_second_bid": self.bid_book_second_bid,
+                "bid_book_last_bid_time": self.bid_book_last_bid_time,
+            }
+            self.update_bid_book(save=False)
+            Lot.objects.filter(pk=self.pk, **read_book).update(**self.bid_book_fields)
+        high_bidder = None
+        if self.bid_book_high_bidder_id:
+            high_bidder = self.bid_book_high_bidder
+        return self.bid_book_max_bid, self.bid_book_second_bid, high_bidder
+
+    def update_bid_book(self, top_bids=None, save=True):
+        """Rebuild the bid book from the two highest bids (highest first), or from the Bid table if top_bids isn't passed.
+        This needs to be called any time a bid on this lot is placed, changed, or removed.
+        When bidding, this should be called with the lot locked, see consumers.bid_on_lot()
+        The book is written with update() so that none of the side effects in save() happen"""
+        if top_bids is None:
+            top_bids = list(self.bids.select_related("user")[:2])
+        self.bid_book_current = True
+        self.bid_book_high_bidder = top_bids[0].user if top_bids else None
+        self.bid_book_max_bid = top_bids[0].amount if top_bids else None
+        self.bid_book_second_bid = top_bids[1].amount if len(top_bids) > 1 else None
+        self.bid_book_last_bid_time = max([bid.last_bid_time for bid in top_bids], default=None)
+        self.bid_book_reserve_price = self.reserve_price
+        self.bid_book_end = self.bid_book_cutoff
+        if save:
+            Lot.objects.filter(pk=self.pk).update(**self.bid_book_fields)
+
+    @property
+    def bid_book_fields(self):
+        return {
+            "bid_book_current": self.bid_book_current,
+            "bid_book_high_bidder": self.bid_book_high_bidder,
+            "bid_book_max_bid": self.bid_book_max_bid,
+            "bid_book_second_bid": self.bid_book_second_bid,
+            "bid_book_last_bid_time": self.bid_book_last_bid_time,
+            "bid_book_reserve_price": self.bid_book_reserve_price,
+            "bid_book_end": self.bid_book_end,
+        }
 
     @property
     def high_bidder(self):
         """Name of the highest bidder"""
         if self.banned:
             return False
-        try:
-            bids = self.bids
-            return bids[0].user
-        except:
-            return False
+        max_bid, second_bid, high_bidder = self.bid_book
+        return high_bidder or False
 
     @property
     def all_page_views(self):
@@ -3150,14 +3781,14 @@ class Lot(models.Model):
                 auction=self.auction,
                 defaults={},
             )
-            invoice.recalculate
+            invoice.mark_for_recalculation()
         if self.auction and self.auctiontos_seller:
             invoice, created = Invoice.objects.get_or_create(
                 auctiontos_user=self.auctiontos_seller,
                 auction=self.auction,
                 defaults={},
             )
-            invoice.recalculate
+            invoice.mark_for_recalculation()
 
     @property
     def category(self):
@@ -3216,6 +3847,99 @@ class Lot(models.Model):
         return re.sub(r'(style="[^"]*?)color:[^;"]*;?([^"]*")', r"\1\2", self.summernote_description)
 
 
+class InvoiceTotals:
+    """Everything on an invoice that's added up from lots and adjustments.
+    Use Invoice.totals instead of making one of these, so that it's only calculated once per invoice,
+    or InvoiceTotals.for_invoices() to add up a lot of invoices at once"""
+
+    adjustment_types = ["ADD", "DISCOUNT", "ADD_PERCENT", "DISCOUNT_PERCENT"]
+
+    def __init__(self, lots=None, adjustments=None):
+        """lots and adjustments are the results of the aggregates below"""
+        lots = lots or {}
+        adjustments = adjustments or {}
+        for key in [*self.sold_aggregates(), *self.bought_aggregates()]:
+            setattr(self, key, lots.get(key) or 0)
+        self.pre_register_used = bool(self.pre_register_used)
+        self.adjustments = {key: adjustments.get(key) or 0 for key in self.adjustment_types}
+
+    @staticmethod
+    def sold_aggregates(sold=None):
+        """Totals for lots sold by an invoice's user.  sold is only needed when lots that weren't sold are included"""
+        sold = sold or Q()
+        return {
+            "lots_sold": Count("pk", filter=sold),
+            "lots_sold_successfully": Count("pk", filter=sold & Q(auctiontos_winner__isnull=False)),
+            "unsold_lots": Count("pk", filter=sold & Q(auctiontos_winner__isnull=True)),
+            "unsold_non_donation_lots": Count(
+                "pk", filter=sold & Q(active=True, auctiontos_winner__isnull=True, donation=False, banned=False)
+            ),
+            "pre_register_used": Count("pk", filter=sold & Q(pre_register_discount__gt=0)),
+            "total_sold": Sum("your_cut", filter=sold),
+            "total_sold_gross": Sum("winning_price", filter=sold),
+            "total_sold_club_cut": Sum("club_cut", filter=sold),
+            "total_donations": Sum("winning_price", filter=sold & Q(winning_price__isnull=False, donation=True)),
+        }
+
+    @staticmethod
+    def bought_aggregates(bought=None):
+        """Totals for lots bought by an invoice's user.  bought is only needed when lots that weren't bought are included"""
+        bought = bought or Q()
+        return {
+            "lots_bought": Count("pk", filter=bought),
+            "total_bought": Sum(F("winning_price") * (100 - F("partial_refund_percent")) / 100, filter=bought),
+        }
+
+    @classmethod
+    def adjustment_aggregates(cls):
+        return {
+            adjustment_type: Sum("amount", filter=Q(adjustment_type=adjustment_type))
+            for adjustment_type in cls.adjustment_types
+        }
+
+    @classmethod
+    def for_invoice(cls, invoice):
+        """Two queries: one conditional aggregate over both sold and bought lots, and one for adjustments"""
+        sold = Q(auctiontos_seller=invoice.auctiontos_user_id, auction=invoice.auction_id)
+        bought = Q(auctiontos_winner=invoice.auctiontos_user_id, winning_price__isnull=False)
+        lots = add_price_info(Lot.objects.filter(sold | bought, is_deleted=False)).aggregate(
+            **cls.sold_aggregates(sold), **cls.bought_aggregates(bought)
+        )
+        adjustments = InvoiceAdjustment.objects.filter(invoice=invoice).aggregate(**cls.adjustment_aggregates())
+        return cls(lots, adjustments)
+
+    @classmethod
+    def for_invoices(cls, invoices):
+        """Returns {invoice pk: InvoiceTotals} for a queryset of invoices, in three grouped queries no matter how many invoices there are"""
+        users = invoices.values("auctiontos_user")
+        sold = {
+            (row.pop("auctiontos_seller"), row.pop("auction")): row
+            for row in add_price_info(Lot.objects.filter(auctiontos_seller__in=users, is_deleted=False))
+            .values("auctiontos_seller", "auction")
+            .annotate(**cls.sold_aggregates())
+            .order_by()
+        }
+        bought = {
+            row.pop("auctiontos_winner"): row
+            for row in Lot.objects.filter(auctiontos_winner__in=users, winning_price__isnull=False, is_deleted=False)
+            .values("auctiontos_winner")
+            .annotate(**cls.bought_aggregates())
+            .order_by()
+        }
+        adjustments = {
+            row.pop("invoice"): row
+            for row in InvoiceAdjustment.objects.filter(invoice__in=invoices.values("pk"))
+            .values("invoice")
+            .annotate(**cls.adjustment_aggregates())
+            .order_by()
+        }
+        totals = {}
+        for pk, tos_pk, auction_pk in invoices.values_list("pk", "auctiontos_user", "auction"):
+            lots = {**sold.get((tos_pk, auction_pk), {}), **bought.get(tos_pk, {})}
+            totals[pk] = cls(lots, adjustments.get(pk))
+        return totals
+
+
 class Invoice(models.Model):
     """
     The total amount you get paid or owe to the club for an auction
@@ -3244,14 +3968,27 @@ class Invoice(models.Model):
     )
     calculated_total = models.IntegerField(null=True, blank=True)
     calculated_total.help_text = "This field is set automatically, you shouldn't need to manually change it"
+    recalculate_requested = models.DateTimeField(null=True, blank=True, db_index=True)
+    recalculate_requested.help_text = "Set when calculated_total is out of date, see recalculate_dirty_invoices()"
     memo = models.CharField(max_length=500, blank=True, null=True, default="")
     memo.help_text = "Only other auction admins can see this"
 
+    @property
+    def totals(self):
+        """See InvoiceTotals.  Call clear_totals() if lots or adjustments change while you're still using this invoice"""
+        if getattr(self, "_totals", None) is None:
+            self._totals = InvoiceTotals.for_invoice(self)
+        return self._totals
+
+    def clear_totals(self):
+        self._totals = None
+
+    def refresh_from_db(self, *args, **kwargs):
+        self.clear_totals()
+        super().refresh_from_db(*args, **kwargs)
+
     def sum_adjusments(self, adjustment_type):
-        total = self.adjustments.filter(adjustment_type=adjustment_type).aggregate(total=Sum("amount"))["total"]
-        if not total:
-            return 0
-        return total
+        return self.totals.adjustments[adjustment_type]
 
     @property
     def adjustments(self):
@@ -3271,10 +4008,17 @@ class Invoice(models.Model):
 
     @property
     def recalculate(self):
-        """Store the current net in the calculated_total field.  Call this every time you add or remove a lot from this invoice"""
+        """Store the current net in the calculated_total field right now.
+        When adding or removing lots, use mark_for_recalculation() instead, which is much cheaper when lots of lots sell at once"""
+        self.clear_totals()
         self.calculated_total = self.rounded_net
+        self.recalculate_requested = None
         self.save()
 
+    def mark_for_recalculation(self):
+        """calculated_total will be updated by the recalculate_invoices command, with every other change made in the meantime"""
+        mark_invoices_for_recalculation(Invoice.objects.filter(pk=self.pk))
+
     @property
     def total_adjustment_amount(self):
         """There's a difference between the subtotal and the rounded net -- rounding, manual adjustments, fist bid payouts, etc"""
@@ -3297,8 +4041,10 @@ class Invoice(models.Model):
 
     @property
     def tax(self):
-        if self.auctiontos_user.auction and self.auctiontos_user.auction.tax:
-            return self.total_bought * self.auctiontos_user.auction.tax / 100
+        # self.auction is the same as self.auctiontos_user.auction, see save(), and is usually already loaded
+        auction = self.auction or self.auctiontos_user.auction
+        if auction and auction.tax:
+            return self.total_bought * auction.tax / 100
         return 0
 
     @property
@@ -3384,7 +4130,7 @@ class Invoice(models.Model):
     @property
     def lots_sold(self):
         """Return number of lots the user attempted to sell in this invoice (unsold lots included)"""
-        return len(self.sold_lots_queryset)
+        return self.totals.lots_sold
 
     @property
     def lots_sold_successfully(self):
@@ -3394,7 +4140,7 @@ class Invoice(models.Model):
     @property
     def lots_sold_successfully_count(self):
         """Return number of lots the user sold in this invoice (unsold lots not included)"""
-        return self.lots_sold_successfully.count()
+        return self.totals.lots_sold_successfully
 
     @property
     def lot_labels(self):
@@ -3407,51 +4153,44 @@ class Invoice(models.Model):
     @property
     def unsold_lots(self):
         """Return number of lots the user did not sell. This may be simply lots whose winner has not been set yet."""
-        return len(self.sold_lots_queryset.exclude(auctiontos_winner__isnull=False))
+        return self.totals.unsold_lots
 
     @property
     def unsold_non_donation_lots(self):
         """For non-online auctions only.  Return number of lots the user did not sell. This may be simply lots whose winner has not been set yet."""
         if self.is_online:
             return 0
-        # leave active = True here, this is used for the warning on the invoice page.  If you mark a lot unsold, it'll be set not active
-        return self.sold_lots_queryset.filter(
-            active=True, auctiontos_winner__isnull=True, donation=False, banned=False
-        ).count()
+        # active = True, this is used for the warning on the invoice page.  If you mark a lot unsold, it'll be set not active
+        return self.totals.unsold_non_donation_lots
 
     @property
     def total_sold_gross(self):
         """Total winning price of all lots sold"""
-        return self.sold_lots_queryset.aggregate(total=Sum("winning_price"))["total"] or 0
+        return self.totals.total_sold_gross
 
     @property
     def total_sold(self):
         """Seller's cut of all lots sold"""
-        return self.sold_lots_queryset.aggregate(total_sold=Sum("your_cut"))["total_sold"] or 0
+        return self.totals.total_sold
 
     @property
     def total_sold_club_cut(self):
         """Club's cut of all lots sold"""
-        return self.sold_lots_queryset.aggregate(total=Sum("club_cut"))["total"] or 0
+        return self.totals.total_sold_club_cut
 
     @property
     def lots_bought(self):
         """Return number of lots the user bought in this invoice"""
-        return len(self.bought_lots_queryset)
+        return self.totals.lots_bought
 
     @property
     def total_bought(self):
-        return self.bought_lots_queryset.aggregate(total_bought=Sum("final_price"))["total_bought"] or 0
+        return self.totals.total_bought
 
     @property
     def total_donations(self):
         """Total value of all donated lots"""
-        return (
-            self.sold_lots_queryset.filter(winning_price__isnull=False, donation=True).aggregate(
-                total=Sum("winning_price")
-            )["total"]
-            or 0
-        )
+        return self.totals.total_donations
 
     @property
     def location(self):
@@ -3505,7 +4244,7 @@ class Invoice(models.Model):
 
     @property
     def pre_register_used(self):
-        return self.sold_lots_queryset.filter(pre_register_discount__gt=0).exists()
+        return self.totals.pre_register_used
 
     def save(self, *args, **kwargs):
         if not self.auction:
@@ -3533,6 +4272,19 @@ class InvoiceAdjustment(models.Model):
     amount = models.PositiveIntegerField(default=0, validators=[MinValueValidator(0)])
     notes = models.CharField(max_length=150, default="")
 
+    def clear_invoice_totals(self):
+        """The invoice this was loaded with may already have added up its adjustments, see Invoice.totals"""
+        if self.invoice_id and InvoiceAdjustment._meta.get_field("invoice").is_cached(self):
+            self.invoice.clear_totals()
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.clear_invoice_totals()
+
+    def delete(self, *args, **kwargs):
+        self.clear_invoice_totals()
+        return super().delete(*args, **kwargs)
+
     @property
     def formatted_float_value(self):
         return f"{self.amount:.2f}"
@@ -3567,9 +4319,20 @@ class Bid(models.Model):
     def __str__(self):
         return str(self.user) + " bid " + str(self.amount) + " on lot " + str(self.lot_number)
 
+    def save(self, *args, **kwargs):
+        """Any change to a bid can change the top two bids, so this keeps the lot's bid book current.
+        Pass update_bid_book=False only if you're going to call lot.update_bid_book() yourself"""
+        update_bid_book = kwargs.pop("update_bid_book", True)
+        super().save(*args, **kwargs)
+        if update_bid_book:
+            self.lot_number.update_bid_book()
+
     def delete(self, *args, **kwargs):
-        self.is_deleted = True
-        self.save()
+        with transaction.atomic():
+            # lock the lot so that a bid being placed at the same time can't put this bid back in the bid book
+            Lot.objects.select_for_update().filter(pk=self.lot_number_id).first()
+            self.is_deleted = True
+            self.save()
 
 
 class Watch(models.Model):
@@ -3582,7 +4345,7 @@ class Watch(models.Model):
     lot_number = models.ForeignKey(Lot, on_delete=models.CASCADE)
     # not doing anything with createdon field right now
     # but might be interesting to track at what point in the auction users watch lots
-    createdon = models.DateTimeField(auto_now_add=True, blank=True)
+    createdon = models.DateTimeField(auto_now_add=True, db_index=True, blank=True)
 
     def __str__(self):
         return str(self.user) + " watching " + str(self.lot_number)
@@ -3604,6 +4367,15 @@ class UserBan(models.Model):
     def __str__(self):
         return str(self.user) + " has banned " + str(self.banned_user)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        send_permissions_changed(f"permissions_user_{self.banned_user_id}")
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        send_permissions_changed(f"permissions_user_{self.banned_user_id}")
+        return result
+
 
 class UserIgnoreCategory(models.Model):
     """
@@ -3618,6 +4390,37 @@ class UserIgnoreCategory(models.Model):
         return str(self.user) + " hates " + str(self.category)
 
 
+class IPGeo(models.Model):
+    """Where an IP address is, so that it only has to be looked up once.
+    Filled in by the load_geoip command from an offline GeoIP database, and by set_user_location from ip-api.com"""
+
+    ip_address = models.CharField(max_length=100, unique=True)
+    latitude = models.FloatField(default=0)
+    longitude = models.FloatField(default=0)
+    country = models.ForeignKey(Location, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+    continent = models.ForeignKey(Location, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+    source = models.CharField(max_length=20, default="", blank=True)
+    source.help_text = "Where this came from: GEOIP, IPAPI, or PAGEVIEW for locations copied from an older page view"
+    last_seen = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.ip_address} is at {self.latitude}, {self.longitude}"
+
+    @property
+    def location(self):
+        """For UserData.location"""
+        return self.continent or self.country or Location.objects.filter(name="Other").first()
+
+    @classmethod
+    def lookup(cls, ip_addresses):
+        """Returns a dict of {ip_address: IPGeo} for the IPs that have been located.
+        This is read only, it's called for every page view; last_seen is when the IP was looked up or loaded"""
+        ip_addresses = {ip for ip in ip_addresses if ip}
+        if not ip_addresses:
+            return {}
+        return {geo.ip_address: geo for geo in cls.objects.filter(ip_address__in=ip_addresses)}
+
+
 class PageView(models.Model):
     """Track what lots a user views"""
 
@@ -3626,7 +4429,7 @@ class PageView(models.Model):
     auction.help_text = "Only filled out when a user views an auction's rules page"
     lot_number = models.ForeignKey(Lot, null=True, blank=True, on_delete=models.CASCADE)
     lot_number.help_text = "Only filled out when a user views a specific lot's page"
-    date_start = models.DateTimeField(auto_now_add=True)
+    date_start = models.DateTimeField(auto_now_add=True, db_index=True)
     date_end = models.DateTimeField(null=True, blank=True, default=timezone.now)
     total_time = models.PositiveIntegerField(default=0)
     total_time.help_text = "The total time in seconds the user has spent on the lot page"
@@ -3638,6 +4441,10 @@ class PageView(models.Model):
     session_id = models.CharField(max_length=600, blank=True, null=True)
     notification_sent = models.BooleanField(default=False)
     duplicate_check_completed = models.BooleanField(default=False)
+    visit_key = models.CharField(max_length=40, blank=True, null=True, unique=True)
+    visit_key.help_text = (
+        "Set by record_pageviews() so that viewing the same page again updates this view instead of adding a duplicate"
+    )
     latitude = models.FloatField(default=0)
     longitude = models.FloatField(default=0)
     ip_address = models.CharField(max_length=100, blank=True, null=True)
@@ -3660,6 +4467,12 @@ class PageView(models.Model):
         # thing = self.title
         return f"User {self.user} viewed {thing} for {self.total_time} seconds"
 
+    @staticmethod
+    def make_visit_key(user_pk, lot_pk, url, auction_pk, session_id):
+        """Views with the same user, lot, url, auction and session are one visit, see duplicates"""
+        parts = [user_pk, lot_pk, url, auction_pk, session_id]
+        return hashlib.sha1("|".join("" if part is None else str(part) for part in parts).encode()).hexdigest()
+
     @property
     def duplicates(self):
         """Some duplciates have appeared and I can't figure out how it's possible"""
@@ -3699,15 +4512,10 @@ class PageView(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.latitude and self.ip_address:
-            other_view_with_same_ip = (
-                PageView.objects.exclude(latitude=0, longitude=0)
-                .filter(ip_address=self.ip_address)
-                .order_by("-date_start")
-                .first()
-            )
-            if other_view_with_same_ip:
-                self.latitude = other_view_with_same_ip.latitude
-                self.longitude = other_view_with_same_ip.longitude
+            geo = IPGeo.lookup([self.ip_address]).get(self.ip_address)
+            if geo:
+                self.latitude = geo.latitude
+                self.longitude = geo.longitude
             elif self.user:
                 if self.user.userdata.latitude:
                     self.latitude = self.user.userdata.latitude
@@ -3715,6 +4523,267 @@ class PageView(models.Model):
         super().save(*args, **kwargs)
 
 
+class ActivityRollup(models.Model):
+    """Hourly totals for the stats pages, so that they don't need to count every PageView, Bid, etc.
+    Rows without an auction are for the whole site.  Kept up to date by the rollup_activity command"""
+
+    auction = models.ForeignKey(Auction, null=True, blank=True, on_delete=models.CASCADE)
+    hour = models.DateTimeField()
+    hour.help_text = "The start of the hour"
+    views = models.PositiveIntegerField(default=0)
+    unique_users = models.PositiveIntegerField(default=0)
+    unique_sessions = models.PositiveIntegerField(default=0)
+    unique_sessions.help_text = "Anonymous users, by session"
+    joins = models.PositiveIntegerField(default=0)
+    lots = models.PositiveIntegerField(default=0)
+    bids = models.PositiveIntegerField(default=0)
+    bids.help_text = "Bids that changed the price"
+    watches = models.PositiveIntegerField(default=0)
+    searches = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=["auction", "hour"])]
+
+    def __str__(self):
+        return f"{self.auction or 'Site'} activity at {self.hour}"
+
+
+class PageViewRollup(models.Model):
+    """How many times each page was viewed from each referrer in an hour, see ActivityRollup"""
+
+    auction = models.ForeignKey(Auction, null=True, blank=True, on_delete=models.CASCADE)
+    hour = models.DateTimeField()
+    url = models.CharField(max_length=600, blank=True, null=True)
+    title = models.CharField(max_length=600, blank=True, null=True)
+    referrer = models.CharField(max_length=600, blank=True, null=True)
+    views = models.PositiveIntegerField(default=0)
+    views.help_text = "Number of PageViews"
+    total_views = models.PositiveIntegerField(default=0)
+    total_views.help_text = "Includes viewing the same page again, see PageView.counter"
+
+    class Meta:
+        indexes = [models.Index(fields=["auction", "hour"])]
+
+    def __str__(self):
+        return f"{self.url} viewed {self.views} times at {self.hour}"
+
+
+@functools.cache
+def pageview_buffer():
+    """Redis connection used to buffer page views, see buffer_pageview()"""
+    return redis.Redis.from_url(settings.REDIS_URL)
+
+
+def buffer_pageview(event):
+    """Push a page view onto a Redis list instead of saving it, the flush_pageviews command saves them in batches with record_pageviews()
+    Used by views.pageview when settings.PAGEVIEW_BUFFER is set"""
+    try:
+        pageview_buffer().rpush(PAGEVIEW_BUFFER_KEY, json.dumps(event))
+    except redis.RedisError as e:
+        logger.exception(e)
+        record_pageviews([event])
+
+
+def add_user_interest(increments):
+    """Add to UserInterestCategory.interest, increments is a dict of {(user pk, category pk): amount}
+    This is UserInterestCategory.save() for lots of rows at once: existing rows are updated with F(), one query per distinct amount,
+    missing rows are made with bulk_create, and as_percent is set relative to each user's highest interest"""
+    if not increments:
+        return
+    user_pks = {user_pk for user_pk, category_pk in increments}
+    existing = {
+        (user_pk, category_pk): pk
+        for pk, user_pk, category_pk in UserInterestCategory.objects.filter(user__in=user_pks).values_list(
+            "pk", "user", "category"
+        )
+    }
+    by_amount = {}
+    new_interests = []
+    for key, amount in increments.items():
+        if key in existing:
+            by_amount.setdefault(amount, []).append(existing[key])
+        else:
+            new_interests.append(UserInterestCategory(user_id=key[0], category_id=key[1], interest=amount))
+    for amount, pks in by_amount.items():
+        UserInterestCategory.objects.filter(pk__in=pks).update(interest=F("interest") + amount)
+    UserInterestCategory.objects.bulk_create(new_interests)
+    interests = list(UserInterestCategory.objects.filter(user__in=user_pks).only("pk", "user", "category", "interest"))
+    max_interests = {}
+    for interest in interests:
+        max_interests[interest.user_id] = max(max_interests.get(interest.user_id, 0), interest.interest)
+    changed = [interest for interest in interests if (interest.user_id, interest.category_id) in increments]
+    for interest in changed:
+        # + 1 for the times the max is 0
+        interest.as_percent = min(100, int((interest.interest + 1) / (max_interests[interest.user_id] or 1) * 100))
+    UserInterestCategory.objects.bulk_update(changed, ["as_percent"])
+
+
+def rebuild_user_interest(user_pks):
+    """Recalculate UserInterestCategory for these users from their bids and page views, using the current BID_WEIGHT and VIEW_WEIGHT
+    The weights are summed per user and category with one grouped query each for bids and page views, then saved with bulk_update() and bulk_create()
+    Interests in categories the user no longer has any activity in are removed.  Returns the number of interests saved"""
+    user_pks = list(user_pks)
+    totals = Counter()
+    bids = (
+        Bid.objects.exclude(is_deleted=True)
+        .filter(user__in=user_pks, lot_number__species_category__isnull=False)
+        .values("user", "lot_number__species_category")
+        .annotate(weight=Count("pk") * settings.BID_WEIGHT)
+        .order_by()
+    )
+    # each view of the same page after the first is in counter, see record_pageviews()
+    views = (
+        PageView.objects.filter(user__in=user_pks, lot_number__species_category__isnull=False)
+        .values("user", "lot_number__species_category")
+        .annotate(weight=(Count("pk") + Coalesce(Sum("counter"), 0)) * settings.VIEW_WEIGHT)
+        .order_by()
+    )
+    for qs in [bids, views]:
+        for user_pk, category_pk, weight in qs.values_list("user", "lot_number__species_category", "weight"):
+            totals[(user_pk, category_pk)] += weight
+    max_interests = {}
+    for (user_pk, category_pk), interest in totals.items():
+        max_interests[user_pk] = max(max_interests.get(user_pk, 0), interest)
+    existing = {
+        (user_pk, category_pk): pk
+        for pk, user_pk, category_pk in UserInterestCategory.objects.filter(user__in=user_pks).values_list(
+            "pk", "user", "category"
+        )
+    }
+    changed = []
+    new_interests = []
+    for key, interest in totals.items():
+        # + 1 for the times the max is 0, same as UserInterestCategory.save()
+        as_percent = min(100, int((interest + 1) / (max_interests[key[0]] or 1) * 100))
+        if key in existing:
+            changed.append(UserInterestCategory(pk=existing.pop(key), interest=interest, as_percent=as_percent))
+        else:
+            new_interests.append(
+                UserInterestCategory(user_id=key[0], category_id=key[1], interest=interest, as_percent=as_percent)
+            )
+    UserInterestCategory.objects.filter(pk__in=existing.values()).delete()
+    UserInterestCategory.objects.bulk_update(changed, ["interest", "as_percent"], batch_size=1000)
+    UserInterestCategory.objects.bulk_create(new_interests, batch_size=1000)
+    return len(totals)
+
+
+def record_pageviews(events):
+    """Save a batch of page views.  Each event is a dict made by views.pageview, see pageview_event()
+    Does what saving a single PageView used to: marks campaigns as viewed or joined, adds interest in the lot's category
+    and starts a campaign for logged in users viewing an auction.  Related objects are loaded once per batch
+    A page that's already been viewed by the same user or session adds to the counter of that view, see PageView.visit_key.
+    Everything is saved in one transaction.  Returns the new page views"""
+    if not events:
+        return []
+    # a batch that fails partway is rolled back, so it can be saved again without counting anything twice
+    with transaction.atomic():
+
+        def pks(key):
+            return {int(event[key]) for event in events if str(event.get(key) or "").isdigit()}
+
+        def pk_or_none(value):
+            return int(value) if str(value or "").isdigit() else None
+
+        auctions = Auction.objects.in_bulk(pks("auction"))
+        lots = Lot.objects.filter(pk__in=pks("lot"), is_deleted=False).only("pk", "species_category").in_bulk()
+        users = User.objects.in_bulk(pks("user"))
+        now = timezone.now()
+        uids = {event["uid"] for event in events if event.get("uid")}
+        if uids:
+            UserData.objects.filter(unsubscribe_link__in=uids).update(last_activity=now)
+        # mark auction campaign results if applicable present
+        sources = {event["source"] for event in events if event.get("source")}
+        if sources:
+            campaigns = list(AuctionCampaign.objects.filter(uuid__in=sources))
+            joined = set(
+                AuctionTOS.objects.filter(
+                    user__in=[campaign.user_id for campaign in campaigns if campaign.user_id],
+                    auction__in=[campaign.auction_id for campaign in campaigns if campaign.auction_id],
+                ).values_list("user", "auction")
+            )
+            for campaign in campaigns:
+                result = campaign.result
+                if campaign.result == "NONE":
+                    campaign.result = "VIEWED"
+                if (campaign.user_id, campaign.auction_id) in joined:
+                    campaign.result = "JOINED"
+                if campaign.result != result:
+                    campaign.save()
+        # coordinates come from IPGeo, or the user's location
+        ip_locations = {
+            ip: (geo.latitude, geo.longitude) for ip, geo in IPGeo.lookup(event.get("ip") for event in events).items()
+        }
+        user_locations = {
+            user_pk: (latitude, longitude)
+            for user_pk, latitude, longitude in UserData.objects.filter(user__in=users)
+            .exclude(latitude=0)
+            .values_list("user", "latitude", "longitude")
+        }
+        pageviews = {}
+        interests = Counter()
+        new_campaigns = {}
+        for event in events:
+            user = users.get(pk_or_none(event.get("user")))
+            auction = auctions.get(pk_or_none(event.get("auction")))
+            lot = lots.get(pk_or_none(event.get("lot")))
+            ip = event.get("ip") or ""
+            latitude, longitude = ip_locations.get(ip, (0, 0))
+            if not latitude and user and user.pk in user_locations:
+                latitude, longitude = user_locations[user.pk]
+            session_id = None if user else event.get("session_id")
+            visit_key = PageView.make_visit_key(
+                user and user.pk, lot and lot.pk, event.get("url"), auction and auction.pk, session_id
+            )
+            if visit_key in pageviews:
+                pageviews[visit_key].counter += 1
+            else:
+                pageviews[visit_key] = PageView(
+                    lot_number=lot,
+                    url=event.get("url"),
+                    auction=auction,
+                    session_id=session_id,
+                    user=user,
+                    user_agent=event.get("user_agent", ""),
+                    ip_address=ip,
+                    platform=parse(event.get("user_agent", "")).os.family,
+                    os="UNKNOWN",
+                    referrer=event.get("referrer", ""),
+                    title=event.get("title", ""),
+                    source=event.get("source"),
+                    latitude=latitude,
+                    longitude=longitude,
+                    visit_key=visit_key,
+                )
+            if user and lot and lot.species_category_id:
+                # create interest in this category if this is a new view for this category
+                interests[(user.pk, lot.species_category_id)] += settings.VIEW_WEIGHT
+            if auction and user:
+                new_campaigns[(auction.pk, user.pk)] = (auction, user, event.get("source") or event.get("referrer"))
+        # viewing a page again counts towards the first view instead of adding a duplicate
+        repeats = {}
+        for visit_key, pk in PageView.objects.filter(visit_key__in=pageviews).values_list("visit_key", "pk"):
+            repeats.setdefault(pageviews.pop(visit_key).counter + 1, []).append(pk)
+        for amount, pks in repeats.items():
+            PageView.objects.filter(pk__in=pks).update(counter=F("counter") + amount, date_end=now)
+        # ignore_conflicts covers the same page being viewed in two batches saved at the same time
+        PageView.objects.bulk_create(pageviews.values(), ignore_conflicts=True)
+        add_user_interest(interests)
+        existing_campaigns = set(
+            AuctionCampaign.objects.filter(
+                auction__in=[key[0] for key in new_campaigns], user__in=[key[1] for key in new_campaigns]
+            ).values_list("auction", "user")
+        )
+        # skipping existing campaigns here does the duplicate check in AuctionCampaign.save()
+        AuctionCampaign.objects.bulk_create(
+            [
+                AuctionCampaign(auction=auction, user=user, email=user.email, source=source)
+                for key, (auction, user, source) in new_campaigns.items()
+                if key not in existing_campaigns
+            ]
+        )
+        return list(pageviews.values())
+
+
 class UserLabelPrefs(models.Model):
     """Dimensions used for the label PDF"""
 
@@ -4171,7 +5240,7 @@ class LotHistory(models.Model):
     user = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
     user.help_text = "The user who posted this message."
     message = models.CharField(max_length=400, blank=True, null=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
     seen = models.BooleanField(default=False)
     seen.help_text = "Has the lot submitter seen this message?"
     current_price = models.PositiveIntegerField(null=True, blank=True)
@@ -4402,7 +5471,7 @@ class SearchHistory(models.Model):
 
     user = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
     search = models.CharField(max_length=600)
-    createdon = models.DateTimeField(auto_now_add=True)
+    createdon = models.DateTimeField(auto_now_add=True, db_index=True)
     auction = models.ForeignKey(Auction, null=True, blank=True, on_delete=models.SET_NULL)
 
 
@@ -1,25 +1,75 @@
+import asyncio
 import datetime
-
-from django.contrib.auth.models import User
-from django.test import TestCase
-from django.test.client import Client
-from django.urls import reverse
+import io
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import Sum
+from django.template.loader import render_to_string
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.client import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import re_path, reverse
 from django.utils import timezone
-
+from post_office.models import Email, EmailTemplate
+
+from .consumers import (
+    AuctionConsumer,
+    LotConsumer,
+    bid_on_lot,
+    bid_side_effects,
+    record_bidder_flags,
+    websocket_rate_limiter,
+)
+from .management.commands.closelots import LotClosingScheduler
+from .management.commands.endauctions import declare_winners_on_lots
+from .management.commands.flush_pageviews import save_events
+from .management.commands.remove_duplicate_views import merge_duplicate_views
 from .models import (
+    ActivityRollup,
     Auction,
     AuctionTOS,
+    AuctionTOSImporter,
     Bid,
+    BidderNumberAllocator,
+    Category,
     ChatSubscription,
     Invoice,
     InvoiceAdjustment,
+    InvoiceTotals,
+    IPGeo,
+    Location,
     Lot,
     LotHistory,
+    LotNumberSequence,
+    PageView,
+    PageViewRollup,
     PickupLocation,
+    SearchHistory,
+    UserBan,
     UserData,
+    UserInterestCategory,
     UserLabelPrefs,
+    Watch,
     add_price_info,
+    create_lots,
+    recalculate_dirty_invoices,
+    record_pageviews,
 )
+from .views import LotLabelView, bin_rollups
 
 
 class StandardTestCase(TestCase):
@@ -257,6 +307,54 @@ class AuctionModelTests(TestCase):
         assert auction.ending_soon is True
         assert auction.started is True
 
+    def test_bidder_numbers(self):
+        timeStart = timezone.now() - datetime.timedelta(days=2)
+        timeEnd = timezone.now() + datetime.timedelta(days=3)
+        user = User.objects.create(username="Test user")
+        last_auction = Auction.objects.create(
+            title="Last year's auction", date_end=timeEnd, date_start=timeStart, created_by=user
+        )
+        auction = Auction.objects.create(
+            title="A test auction", date_end=timeEnd, date_start=timeStart, created_by=user
+        )
+        last_location = PickupLocation.objects.create(name="location", auction=last_auction, pickup_time=timeEnd)
+        location = PickupLocation.objects.create(name="location", auction=auction, pickup_time=timeEnd)
+        AuctionTOS.objects.create(
+            auction=last_auction, pickup_location=last_location, email="regular@example.com", bidder_number="42"
+        )
+        # same number as last time
+        tos = AuctionTOS.objects.create(auction=auction, pickup_location=location, email="regular@example.com")
+        assert tos.bidder_number == "42"
+        # last digits of the phone number
+        tos = AuctionTOS.objects.create(auction=auction, pickup_location=location, phone_number="555-123-4567")
+        assert tos.bidder_number == "567"
+        # taken, so a random number, which is remembered for next time
+        tos = AuctionTOS.objects.create(
+            auction=auction, pickup_location=location, phone_number="555-999-4567", user=user
+        )
+        assert tos.bidder_number not in ["42", "567"]
+        user.userdata.refresh_from_db()
+        assert user.userdata.preferred_bidder_number == tos.bidder_number
+        # many people at once, one query for the numbers in use
+        allocator = BidderNumberAllocator(auction)
+        with self.assertNumQueries(1):
+            allocator.preload_last_numbers([f"new_{i}@example.com" for i in range(50)])
+        with self.assertNumQueries(0):
+            numbers = [
+                allocator.allocate(AuctionTOS(auction=auction, email=f"new_{i}@example.com", phone_number="4567"))
+                for i in range(50)
+            ]
+        assert len(set(numbers)) == 50
+        assert not set(numbers) & {"42", "567", tos.bidder_number}
+        # two people can't end up with the same number
+        duplicate_allowed = True
+        try:
+            with transaction.atomic():
+                AuctionTOS.objects.create(auction=auction, pickup_location=location, bidder_number="42")
+        except IntegrityError:
+            duplicate_allowed = False
+        assert not duplicate_allowed
+
 
 class LotModelTests(TestCase):
     def test_calculated_end_bidding_closed(self):
@@ -289,6 +387,52 @@ class LotModelTests(TestCase):
         )
         assert testLot.ended is True
 
+    def test_lot_number_sequence(self):
+        the_future = timezone.now() + datetime.timedelta(days=3)
+        user = User.objects.create(username="Test user")
+        auction = Auction.objects.create(
+            created_by=user, title="A test auction", date_end=the_future, date_start=timezone.now()
+        )
+        lots = [Lot.objects.create(lot_name=f"Lot {i}", auction=auction, quantity=1) for i in range(2)]
+        assert [lot.lot_number_int for lot in lots] == [1, 2]
+        # auctions with lots from before there was a sequence carry on from their highest lot number
+        LotNumberSequence.objects.filter(auction=auction).delete()
+        Lot.objects.filter(pk=lots[1].pk).update(lot_number_int=10)
+        assert LotNumberSequence.allocate(auction, 5) == 11
+        lot = Lot.objects.create(lot_name="Next lot", auction=auction, quantity=1)
+        assert lot.lot_number_int == 16
+
+    def test_create_lots(self):
+        the_future = timezone.now() + datetime.timedelta(days=3)
+        user = User.objects.create(username="Test user")
+        auction = Auction.objects.create(
+            created_by=user,
+            title="A test auction",
+            date_end=the_future,
+            date_start=timezone.now() - datetime.timedelta(days=1),
+            use_seller_dash_lot_numbering=True,
+        )
+        location = PickupLocation.objects.create(name="location", auction=auction, pickup_time=the_future)
+        tos = AuctionTOS.objects.create(user=user, auction=auction, pickup_location=location, bidder_number="555")
+        category = Category.objects.create(name="Livebearers")
+        Lot.objects.create(lot_name="Red guppy", species_category=category, quantity=1, reserve_price=5)
+        saved = Lot.objects.create(lot_name="Blue guppy", auction=auction, auctiontos_seller=tos, user=user, quantity=1)
+        lots = create_lots(
+            [
+                Lot(lot_name=f"Guppy trio {i}", auction=auction, auctiontos_seller=tos, user=user, quantity=1)
+                for i in range(3)
+            ]
+        )
+        assert [lot.lot_number_int for lot in lots] == [saved.lot_number_int + 1 + i for i in range(3)]
+        assert [lot.custom_lot_number for lot in lots] == ["555-2", "555-3", "555-4"]
+        for lot in lots:
+            lot.refresh_from_db()
+            assert lot.species_category == saved.species_category == category
+            assert lot.date_end == auction.date_end
+            assert lot.reserve_price == auction.minimum_bid
+        assert ChatSubscription.objects.filter(lot__in=lots, user=user).count() == 3
+        assert Invoice.objects.filter(auctiontos_user=tos).count() == 1
+
     def test_lot_with_no_bids(self):
         time = timezone.now() + datetime.timedelta(days=30)
         user = User.objects.create(username="Test user")
@@ -457,6 +601,59 @@ class LotModelTests(TestCase):
         assert lot.high_bidder is False
         assert lot.high_bid == 5
 
+    def test_bid_book(self):
+        time = timezone.now() + datetime.timedelta(days=30)
+        lotuser = User.objects.create(username="thisismylot")
+        lot = Lot.objects.create(
+            lot_name="A test lot",
+            date_end=time,
+            reserve_price=5,
+            user=lotuser,
+            quantity=1,
+        )
+        userA = User.objects.create(username="Test user")
+        userB = User.objects.create(username="Test user B")
+        bidA = Bid.objects.create(user=userA, lot_number=lot, amount=10)
+        Bid.objects.create(user=userB, lot_number=lot, amount=6)
+        lot = Lot.objects.select_related("bid_book_high_bidder").get(pk=lot.pk)
+        with self.assertNumQueries(0):
+            assert lot.high_bidder.pk == userA.pk
+            assert lot.high_bid == 7
+            assert lot.max_bid == 10
+        bidA.delete()
+        lot = Lot.objects.get(pk=lot.pk)
+        assert lot.high_bidder.pk == userB.pk
+        assert lot.high_bid == 5
+        # lots from before the bid book existed fill it in the first time it's needed
+        Lot.objects.filter(pk=lot.pk).update(bid_book_current=False, bid_book_high_bidder=None, bid_book_max_bid=None)
+        lot = Lot.objects.get(pk=lot.pk)
+        assert lot.max_bid == 6
+        assert Lot.objects.get(pk=lot.pk).bid_book_max_bid == 6
+        # lowering the reserve brings bids that were under it into the book
+        Bid.objects.create(user=userA, lot_number=lot, amount=3)
+        assert Lot.objects.get(pk=lot.pk).high_bid == 5
+        lot.reserve_price = 2
+        lot.save()
+        assert Lot.objects.get(pk=lot.pk).high_bid == 4
+        # saving a lot that was loaded before a bid leaves the bid in the book
+        stale = Lot.objects.get(pk=lot.pk)
+        Bid.objects.create(user=userB, lot_number=lot, amount=20)
+        stale.lot_name = "A renamed lot"
+        stale.save()
+        lot = Lot.objects.get(pk=lot.pk)
+        assert lot.lot_name == "A renamed lot"
+        assert lot.bid_book_max_bid == 20
+        # a lot that was deleted since it was loaded isn't put back
+        Lot.objects.filter(pk=lot.pk).delete()
+        saved = True
+        try:
+            with transaction.atomic():
+                stale.save()
+        except DatabaseError:
+            saved = False
+        assert not saved
+        assert not Lot.objects.filter(pk=lot.pk).exists()
+
 
 class ChatSubscriptionTests(TestCase):
     def test_chat_subscriptions(self):
@@ -644,6 +841,77 @@ class InvoiceModelTests(StandardTestCase):
         self.adjustment_discount_percent.save()
         assert self.invoiceB.net == -37.5
 
+    def test_totals_match_querysets(self):
+        """InvoiceTotals adds everything up in two queries, these are the querysets it replaced"""
+        self.lotB.partial_refund_percent = 50
+        self.lotB.save()
+        self.lotC.donation = True
+        self.lotC.save()
+        self.in_person_lot.added_by = self.admin_user
+        self.in_person_lot.user = self.admin_user
+        self.in_person_lot.save()
+        InvoiceAdjustment.objects.create(adjustment_type="ADD", amount=3, notes="test", invoice=self.invoiceB)
+        in_person_invoice, c = Invoice.objects.get_or_create(auctiontos_user=self.admin_in_person_tos)
+        for invoice in [self.invoice, self.invoiceB, in_person_invoice]:
+            invoice = Invoice.objects.get(pk=invoice.pk)
+            sold = invoice.sold_lots_queryset
+            bought = invoice.bought_lots_queryset
+            assert invoice.lots_sold == len(sold)
+            assert invoice.lots_sold_successfully_count == sold.filter(auctiontos_winner__isnull=False).count()
+            assert invoice.unsold_lots == sold.filter(auctiontos_winner__isnull=True).count()
+            assert invoice.total_sold == (sold.aggregate(total=Sum("your_cut"))["total"] or 0)
+            assert invoice.total_sold_gross == (sold.aggregate(total=Sum("winning_price"))["total"] or 0)
+            assert invoice.total_sold_club_cut == (sold.aggregate(total=Sum("club_cut"))["total"] or 0)
+            assert invoice.total_donations == (
+                sold.filter(winning_price__isnull=False, donation=True).aggregate(total=Sum("winning_price"))["total"]
+                or 0
+            )
+            assert invoice.pre_register_used == sold.filter(pre_register_discount__gt=0).exists()
+            assert invoice.lots_bought == len(bought)
+            assert invoice.total_bought == (bought.aggregate(total=Sum("final_price"))["total"] or 0)
+            for adjustment_type in ["ADD", "DISCOUNT", "ADD_PERCENT", "DISCOUNT_PERCENT"]:
+                assert invoice.sum_adjusments(adjustment_type) == (
+                    invoice.adjustments.filter(adjustment_type=adjustment_type).aggregate(total=Sum("amount"))["total"]
+                    or 0
+                )
+        assert in_person_invoice.unsold_non_donation_lots == 1
+        assert self.invoiceB.total_bought == 25
+
+    def test_recalculation_queue(self):
+        self.invoiceB.mark_for_recalculation()
+        self.invoiceB.refresh_from_db()
+        assert self.invoiceB.recalculate_requested
+        assert self.invoiceB.calculated_total is None
+        # only flagged invoices are touched
+        assert recalculate_dirty_invoices() == 1
+        self.invoiceB.refresh_from_db()
+        assert self.invoiceB.calculated_total == -37
+        assert self.invoiceB.recalculate_requested is None
+        assert recalculate_dirty_invoices() == 0
+        # forcing a recalculation clears the flag
+        self.invoice.mark_for_recalculation()
+        self.invoiceB.mark_for_recalculation()
+        self.invoice.refresh_from_db()
+        self.invoice.recalculate
+        assert self.invoice.calculated_total == 7
+        assert Invoice.objects.filter(recalculate_requested__isnull=False).exclude(pk=self.invoice.pk).exists()
+        assert not Invoice.objects.filter(pk=self.invoice.pk, recalculate_requested__isnull=False).exists()
+
+    def test_recalculate_auction_invoices(self):
+        self.lotB.partial_refund_percent = 50
+        self.lotB.save()
+        InvoiceAdjustment.objects.create(adjustment_type="DISCOUNT", amount=2, notes="test", invoice=self.invoice)
+        Invoice.objects.get_or_create(auctiontos_user=self.tosC)
+        invoices = Invoice.objects.filter(auction=self.online_auction)
+        totals = InvoiceTotals.for_invoices(invoices)
+        # invoices, sold lots, bought lots, adjustments, invoices again and the update, no matter how many invoices
+        with self.assertNumQueries(6):
+            self.online_auction.invoice_recalculate
+        for invoice in invoices:
+            assert vars(totals[invoice.pk]) == vars(invoice.totals)
+            assert invoice.calculated_total == invoice.rounded_net
+        assert Invoice.objects.get(pk=self.invoiceB.pk).calculated_total == -31
+
 
 class LotPricesTests(TestCase):
     def setUp(self):
@@ -1075,3 +1343,872 @@ class DynamicSetLotWinnerViewTestCase(StandardTestCase):
         )
         data = response.json()
         assert "Multiple" in data.get("lot")
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class LotConsumerTests(TransactionTestCase):
+    """Websocket consumers run ORM work in database_sync_to_async, so these need a real transaction"""
+
+    idle_connections = 2000
+
+    def setUp(self):
+        time_start = timezone.now() - datetime.timedelta(days=1)
+        the_future = timezone.now() + datetime.timedelta(days=3)
+        self.seller = User.objects.create_user(username="seller", password="testpassword", email="a@example.com")
+        self.bidder = User.objects.create_user(username="bidder", password="testpassword", email="b@example.com")
+        self.auction = Auction.objects.create(
+            created_by=self.seller, title="Websocket auction", date_start=time_start, date_end=the_future
+        )
+        self.location = PickupLocation.objects.create(name="location", auction=self.auction, pickup_time=the_future)
+        AuctionTOS.objects.create(user=self.bidder, auction=self.auction, pickup_location=self.location)
+        self.lot = Lot.objects.create(
+            lot_name="A websocket lot", auction=self.auction, user=self.seller, quantity=1, reserve_price=2
+        )
+        self.application = URLRouter([re_path(r"ws/lots/(?P<lot_number>\w+)/$", LotConsumer.as_asgi())])
+
+    def communicator(self, user, query_string=""):
+        communicator = WebsocketCommunicator(self.application, f"/ws/lots/{self.lot.pk}/{query_string}")
+        communicator.scope["user"] = user
+        return communicator
+
+    def test_idle_connections_and_chat(self):
+        async def run():
+            idle = []
+            for i in range(self.idle_connections):
+                communicator = self.communicator(AnonymousUser())
+                connected, subprotocol = await communicator.connect()
+                assert connected
+                idle.append(communicator)
+            chatter = self.communicator(self.bidder)
+            connected, subprotocol = await chatter.connect()
+            assert connected
+            await chatter.send_json_to({"message": "hello"})
+            # the last idle socket to join still hears about the new chat message
+            while True:
+                response = await idle[-1].receive_json_from(timeout=5)
+                if response.get("message") == "hello":
+                    break
+            assert response["username"] == "bidder"
+            for communicator in idle + [chatter]:
+                await communicator.disconnect()
+
+        async_to_sync(run)()
+        assert LotHistory.objects.filter(lot=self.lot, message="hello").count() == 1
+
+    def test_history_on_connect(self):
+        history = [
+            LotHistory.objects.create(lot=self.lot, user=self.bidder, message=f"chat {i}", changed_price=False)
+            for i in range(5)
+        ]
+
+        async def run(query_string):
+            communicator = self.communicator(AnonymousUser(), query_string)
+            connected, subprotocol = await communicator.connect()
+            assert connected
+            response = await communicator.receive_json_from()
+            assert await communicator.receive_nothing()
+            await communicator.disconnect()
+            return response
+
+        response = async_to_sync(run)("")
+        assert response["type"] == "history"
+        chats = [message for message in response["messages"] if message["pk"] == self.bidder.pk]
+        assert [message["message"] for message in chats] == [f"chat {i}" for i in range(5)]
+        # reconnecting with a cursor only gets the messages that were missed
+        response = async_to_sync(run)(f"?since={history[2].pk}")
+        assert [message["history_pk"] for message in response["messages"]] == [history[3].pk, history[4].pk]
+
+    @override_settings(WEBSOCKET_RATE_LIMITS={"chat": {"capacity": 3, "rate": 0.01}})
+    def test_chat_rate_limit(self):
+        async def run():
+            chatter = self.communicator(self.bidder)
+            connected, subprotocol = await chatter.connect()
+            assert connected
+            for i in range(5):
+                await chatter.send_json_to({"message": f"spam {i}"})
+            errors = 0
+            while not await chatter.receive_nothing(timeout=0.5):
+                response = await chatter.receive_json_from()
+                if "error" in response:
+                    errors += 1
+            await chatter.disconnect()
+            return errors
+
+        rejected_before = async_to_sync(websocket_rate_limiter.rejections)("chat")
+        assert async_to_sync(run)() == 2
+        assert LotHistory.objects.filter(lot=self.lot, message__startswith="spam").count() == 3
+        assert async_to_sync(websocket_rate_limiter.rejections)("chat") == rejected_before + 2
+
+    def test_ban_clears_cached_permissions(self):
+        Lot.objects.filter(pk=self.lot.pk).update(date_posted=timezone.now() - datetime.timedelta(days=1))
+        AuctionTOS.objects.create(user=self.seller, auction=self.auction, pickup_location=self.location)
+
+        async def run():
+            bidder = self.communicator(self.bidder)
+            connected, subprotocol = await bidder.connect()
+            assert connected
+            await bidder.receive_json_from()  # history
+            await bidder.send_json_to({"bid": 10})
+            first = await bidder.receive_json_from(timeout=5)
+            await database_sync_to_async(UserBan.objects.create)(user=self.seller, banned_user=self.bidder)
+            await asyncio.sleep(0.2)
+            await bidder.send_json_to({"bid": 20})
+            second = await bidder.receive_json_from(timeout=5)
+            await bidder.disconnect()
+            return first, second
+
+        first, second = async_to_sync(run)()
+        assert "error" not in first
+        assert second["error"] == "This user has banned you from bidding on their lots"
+
+    def test_disabling_online_bidding_clears_cached_permissions(self):
+        Lot.objects.filter(pk=self.lot.pk).update(date_posted=timezone.now() - datetime.timedelta(days=1))
+        AuctionTOS.objects.create(user=self.seller, auction=self.auction, pickup_location=self.location)
+
+        def disable_online_bidding():
+            auction = Auction.objects.get(pk=self.auction.pk)
+            auction.is_online = False
+            auction.online_bidding = "disable"
+            auction.save()
+
+        async def run():
+            bidder = self.communicator(self.bidder)
+            connected, subprotocol = await bidder.connect()
+            assert connected
+            await bidder.receive_json_from()  # history
+            await bidder.send_json_to({"bid": 10})
+            first = await bidder.receive_json_from(timeout=5)
+            await database_sync_to_async(disable_online_bidding)()
+            await asyncio.sleep(0.2)
+            await bidder.send_json_to({"bid": 20})
+            second = await bidder.receive_json_from(timeout=5)
+            await bidder.disconnect()
+            return first, second
+
+        first, second = async_to_sync(run)()
+        assert "error" not in first
+        assert second["error"] == "This auction does not allow online bidding"
+
+    def test_auction_price_deltas(self):
+        # bidding isn't allowed on very new lots
+        Lot.objects.filter(pk=self.lot.pk).update(date_posted=timezone.now() - datetime.timedelta(days=1))
+        AuctionTOS.objects.create(user=self.seller, auction=self.auction, pickup_location=self.location)
+        application = URLRouter([re_path(r"ws/auctions/(?P<slug>[-\w]+)/$", AuctionConsumer.as_asgi())])
+
+        async def run():
+            watcher = WebsocketCommunicator(application, f"/ws/auctions/{self.auction.slug}/")
+            connected, subprotocol = await watcher.connect()
+            assert connected
+            bidder = self.communicator(self.bidder)
+            connected, subprotocol = await bidder.connect()
+            assert connected
+            await bidder.send_json_to({"bid": 10})
+            delta = await watcher.receive_json_from(timeout=5)
+            await bidder.disconnect()
+            await watcher.disconnect()
+            return delta
+
+        delta = async_to_sync(run)()
+        assert delta["type"] == "lot_delta"
+        assert delta["lot"] == self.lot.pk
+        assert delta["info"] == "NEW_HIGH_BIDDER"
+        assert delta["current_high_bid"] == 2
+        assert delta["high_bidder_pk"] == self.bidder.pk
+
+
+class BidConcurrencyTests(TransactionTestCase):
+    """Fire bids at a single lot from many threads at once"""
+
+    number_of_bidders = 20
+
+    def setUp(self):
+        time_start = timezone.now() - datetime.timedelta(days=1)
+        the_future = timezone.now() + datetime.timedelta(days=3)
+        self.seller = User.objects.create_user(username="seller", password="testpassword", email="a@example.com")
+        self.auction = Auction.objects.create(
+            created_by=self.seller, title="Busy auction", date_start=time_start, date_end=the_future
+        )
+        self.location = PickupLocation.objects.create(name="location", auction=self.auction, pickup_time=the_future)
+        AuctionTOS.objects.create(user=self.seller, auction=self.auction, pickup_location=self.location)
+        self.lot = Lot.objects.create(
+            lot_name="A popular lot", auction=self.auction, user=self.seller, quantity=1, reserve_price=2
+        )
+        # email templates are normally added through the admin site
+        EmailTemplate.objects.create(name="outbid_notification", subject="Outbid", content="You've been outbid")
+        # bidding isn't allowed on very new lots
+        Lot.objects.filter(pk=self.lot.pk).update(date_posted=time_start)
+        self.bidders = []
+        for i in range(self.number_of_bidders):
+            bidder = User.objects.create(username=f"bidder_{i}", email=f"bidder_{i}@example.com")
+            AuctionTOS.objects.create(user=bidder, auction=self.auction, pickup_location=self.location)
+            self.bidders.append(bidder)
+
+    def bid_in_parallel(self, amounts):
+        barrier = threading.Barrier(len(amounts))
+        results = [None] * len(amounts)
+
+        def place_bid(i, bidder, amount):
+            barrier.wait()
+            try:
+                results[i] = bid_on_lot(Lot.objects.get(pk=self.lot.pk), bidder, amount)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=place_bid, args=(i, bidder, amount))
+            for i, (bidder, amount) in enumerate(zip(self.bidders, amounts))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        bid_side_effects.join()
+        return results
+
+    def test_parallel_first_bids(self):
+        amounts = [10 + i for i in range(self.number_of_bidders)]
+        results = self.bid_in_parallel(amounts)
+        assert all(results)
+        first_bids = [result for result in results if "placed the first bid" in result["message"]]
+        assert len(first_bids) == 1
+        lot = Lot.objects.get(pk=self.lot.pk)
+        # second highest bid + 1
+        assert lot.high_bid == amounts[-2] + 1
+        assert lot.high_bidder == self.bidders[-1]
+        assert Bid.objects.filter(lot_number=lot).count() == self.number_of_bidders
+        assert LotHistory.objects.filter(lot=lot, changed_price=True).count() == len(
+            [result for result in results if result["send_to"] == "everyone"]
+        )
+        # side effects run after the bids, but nothing is lost
+        assert UserData.objects.filter(user__in=self.bidders, has_bid=True).count() == self.number_of_bidders
+        outbid = [result for result in results if result["type"] == "NEW_HIGH_BIDDER"]
+        assert Email.objects.count() == len(outbid) - 1
+
+    def test_parallel_equal_bids(self):
+        results = self.bid_in_parallel([50] * self.number_of_bidders)
+        assert all(results)
+        lot = Lot.objects.get(pk=self.lot.pk)
+        first_bids = [result for result in results if "placed the first bid" in result["message"]]
+        assert len(first_bids) == 1
+        # everyone else was either below the increment or tied the high bidder
+        assert lot.high_bid == 50
+        assert lot.high_bidder.username == first_bids[0]["high_bidder_name"]
+
+    def test_bidder_flags_without_userdata(self):
+        UserData.objects.filter(user=self.bidders[0]).delete()
+        record_bidder_flags(self.bidders[0].pk, used_proxy_bidding=True)
+        userdata = UserData.objects.get(user=self.bidders[0])
+        assert userdata.has_bid
+        assert userdata.has_used_proxy_bidding
+
+    def test_bump_against_proxy_bid(self):
+        bid_on_lot(Lot.objects.get(pk=self.lot.pk), self.bidders[0], 50)
+        result = bid_on_lot(Lot.objects.get(pk=self.lot.pk), self.bidders[1], 20)
+        assert "is still the high bidder" in result["message"]
+        # the broadcast carries the history pk, so the ?since= cursor covers it
+        history = LotHistory.objects.filter(lot=self.lot, changed_price=True).latest("pk")
+        assert result["history_pk"] == history.pk
+        assert history.message == result["message"]
+
+
+class QueryCountMixin:
+    """assertMaxQueries() for TestCase, which lists the queries when there are too many"""
+
+    @contextmanager
+    def assertMaxQueries(self, budget):
+        with CaptureQueriesContext(connection) as context:
+            yield
+        queries = "\n".join(query["sql"] for query in context.captured_queries)
+        assert len(context) <= budget, f"{len(context)} queries, the budget is {budget}:\n{queries}"
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class QueryBudgetTests(QueryCountMixin, TestCase):
+    """Query count budgets for the bid path and the busiest pages.
+    Each check runs against seeded data, then again after seeding more, and has to stay within budget both times;
+    anything that starts running a query per lot, bid or chat message will fail here.
+    Set QUERY_BUDGET_SIZE to seed more data"""
+
+    size = int(os.environ.get("QUERY_BUDGET_SIZE", 10))
+
+    def setUp(self):
+        time_start = timezone.now() - datetime.timedelta(days=1)
+        the_future = timezone.now() + datetime.timedelta(days=3)
+        self.seller = User.objects.create_user(username="seller", password="testpassword", email="a@example.com")
+        self.buyer = User.objects.create_user(username="buyer", password="testpassword", email="b@example.com")
+        self.auction = Auction.objects.create(
+            created_by=self.seller,
+            title="Big auction",
+            date_start=time_start,
+            date_end=the_future,
+            winning_bid_percent_to_club=25,
+            lot_entry_fee=2,
+            unsold_lot_fee=10,
+            tax=25,
+        )
+        self.location = PickupLocation.objects.create(name="location", auction=self.auction, pickup_time=the_future)
+        self.seller_tos = AuctionTOS.objects.create(
+            user=self.seller, auction=self.auction, pickup_location=self.location, is_admin=True
+        )
+        self.buyer_tos = AuctionTOS.objects.create(user=self.buyer, auction=self.auction, pickup_location=self.location)
+        self.lot = Lot.objects.create(
+            lot_name="A popular lot",
+            auction=self.auction,
+            auctiontos_seller=self.seller_tos,
+            user=self.seller,
+            quantity=1,
+            reserve_price=2,
+        )
+        InvoiceAdjustment.objects.create(
+            adjustment_type="DISCOUNT",
+            amount=10,
+            notes="test",
+            invoice=Invoice.objects.get_or_create(auctiontos_user=self.buyer_tos)[0],
+        )
+        self.seeded = 0
+        self.seed()
+
+    def seed(self):
+        """Add self.size bidders who each bid and chat on self.lot, win a lot from self.seller, and bid on an open lot"""
+        for i in range(self.seeded, self.seeded + self.size):
+            bidder = User.objects.create(username=f"bidder_{i}", email=f"bidder_{i}@example.com")
+            tos = AuctionTOS.objects.create(user=bidder, auction=self.auction, pickup_location=self.location)
+            Bid.objects.create(user=bidder, lot_number=self.lot, amount=10 + i)
+            LotHistory.objects.create(lot=self.lot, user=bidder, message="Is this still available?")
+            Lot.objects.create(
+                lot_name=f"Sold lot {i}",
+                auction=self.auction,
+                auctiontos_seller=self.seller_tos,
+                quantity=1,
+                winning_price=10 + i,
+                auctiontos_winner=tos,
+                active=False,
+            )
+            Lot.objects.create(
+                lot_name=f"Bought lot {i}",
+                auction=self.auction,
+                auctiontos_seller=tos,
+                quantity=1,
+                winning_price=10 + i,
+                auctiontos_winner=self.buyer_tos,
+                active=False,
+            )
+            open_lot = Lot.objects.create(
+                lot_name=f"Open lot {i}", auction=self.auction, user=self.seller, quantity=1, reserve_price=2
+            )
+            Bid.objects.create(user=bidder, lot_number=open_lot, amount=5)
+        self.seeded += self.size
+        # bidding isn't allowed on very new lots
+        Lot.objects.filter(auction=self.auction).update(date_posted=timezone.now() - datetime.timedelta(days=1))
+
+    def test_bid_on_lot(self):
+        for amount in [1000, 2000]:
+            with self.assertMaxQueries(15):
+                bid_on_lot(Lot.objects.get(pk=self.lot.pk), self.buyer, amount)
+            self.seed()
+
+    def test_view_lot(self):
+        self.client.login(username="buyer", password="testpassword")
+        for i in range(2):
+            with self.assertMaxQueries(48):
+                response = self.client.get(reverse("lot_by_pk", kwargs={"pk": self.lot.pk}))
+            assert response.status_code == 200
+            self.seed()
+
+    def test_lot_list(self):
+        self.client.login(username="buyer", password="testpassword")
+        for i in range(2):
+            with self.assertMaxQueries(30):
+                response = self.client.get(reverse("allLots") + f"?auction={self.auction.slug}&status=all")
+            assert response.status_code == 200
+            self.seed()
+
+    def test_invoice_net(self):
+        for i in range(2):
+            for tos in [self.buyer_tos, self.seller_tos]:
+                invoice, created = Invoice.objects.get_or_create(auctiontos_user=tos)
+                with self.assertMaxQueries(4):
+                    assert invoice.net
+            self.seed()
+
+    def test_declare_winners_on_lots(self):
+        for i in range(2):
+            lots = Lot.objects.filter(auction=self.auction, active=True)
+            lots.update(date_end=timezone.now())
+            pks = list(lots.values_list("pk", flat=True))
+            stale = list(lots)
+            # the same number of queries however many lots there are
+            with self.assertMaxQueries(12):
+                declare_winners_on_lots(lots)
+            assert not Lot.objects.filter(auction=self.auction, active=True).exists()
+            assert Lot.objects.filter(pk__in=pks, auctiontos_winner__isnull=False).count() == len(pks)
+            assert LotHistory.objects.filter(lot__in=pks, message__startswith="Won by").count() == len(pks)
+            # a second closer that read the lots before they were closed leaves them alone
+            declare_winners_on_lots(stale)
+            assert LotHistory.objects.filter(lot__in=pks, message__startswith="Won by").count() == len(pks)
+            self.seed()
+
+    def test_lot_labels(self):
+        for i in range(2):
+            view = LotLabelView()
+            view.setup(RequestFactory().get("/"))
+            view.request.user = self.seller
+            view.auction = self.auction
+            view.tos = self.seller_tos
+            # the same number of queries however many labels there are
+            with self.assertMaxQueries(8):
+                render_to_string(view.template_name, view.get_context_data())
+            self.seed()
+
+
+class CSVExportTests(QueryCountMixin, TestCase):
+    def setUp(self):
+        the_future = timezone.now() + datetime.timedelta(days=3)
+        self.seller = User.objects.create_user(username="seller", password="testpassword", email="a@example.com")
+        self.auction = Auction.objects.create(
+            created_by=self.seller,
+            title="Big auction",
+            date_start=timezone.now() - datetime.timedelta(days=1),
+            date_end=the_future,
+        )
+        self.location = PickupLocation.objects.create(name="location", auction=self.auction, pickup_time=the_future)
+        self.seller_tos = AuctionTOS.objects.create(
+            user=self.seller,
+            auction=self.auction,
+            pickup_location=self.location,
+            email=self.seller.email,
+            is_admin=True,
+        )
+        self.people = 0
+
+    def add_people(self, count):
+        """Each person joins, wins a lot from the seller and has an unpaid invoice"""
+        for i in range(self.people, self.people + count):
+            user = User.objects.create(username=f"bidder_{i}", email=f"bidder_{i}@example.com")
+            tos = AuctionTOS.objects.create(
+                user=user, auction=self.auction, pickup_location=self.location, email=user.email
+            )
+            Lot.objects.create(
+                lot_name=f"Sold lot {i}",
+                auction=self.auction,
+                auctiontos_seller=self.seller_tos,
+                quantity=1,
+                winning_price=10 + i,
+                auctiontos_winner=tos,
+                active=False,
+            )
+            Invoice.objects.get_or_create(auctiontos_user=tos)
+        Invoice.objects.filter(auction=self.auction).update(status="UNPAID")
+        self.people += count
+
+    def test_csv_exports(self):
+        self.client.login(username="seller", password="testpassword")
+        for i in range(2):
+            # the same number of queries however many rows there are
+            self.add_people(10)
+            for url, budget in [
+                (reverse("user_list", kwargs={"slug": self.auction.slug}), 12),
+                (reverse("lot_list", kwargs={"slug": self.auction.slug}), 8),
+                (reverse("paypal_csv", kwargs={"slug": self.auction.slug, "chunk": 1}), 12),
+                (reverse("my_lot_report"), 6),
+                (reverse("all_my_users"), 6),
+            ]:
+                with self.assertMaxQueries(budget):
+                    response = self.client.get(url)
+                    content = b"".join(response.streaming_content).decode()
+                assert response.status_code == 200
+                assert len(content.splitlines()) > self.people, url
+
+    async def test_csv_export_under_asgi(self):
+        await sync_to_async(self.add_people)(10)
+        await self.async_client.aforce_login(self.seller)
+        response = await self.async_client.get(reverse("lot_list", kwargs={"slug": self.auction.slug}))
+        # sent a chunk at a time, instead of read into a list by StreamingHttpResponse first
+        assert response.is_async
+        content = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        assert len(content.splitlines()) > self.people
+
+
+class BulkAddUsersTests(QueryCountMixin, TestCase):
+    def setUp(self):
+        the_future = timezone.now() + datetime.timedelta(days=3)
+        self.seller = User.objects.create_user(username="seller", password="testpassword", email="a@example.com")
+        self.auction = Auction.objects.create(
+            created_by=self.seller,
+            title="Big auction",
+            date_start=timezone.now() - datetime.timedelta(days=1),
+            date_end=the_future,
+        )
+        self.location = PickupLocation.objects.create(name="location", auction=self.auction, pickup_time=the_future)
+        self.seller_tos = AuctionTOS.objects.create(
+            user=self.seller, auction=self.auction, pickup_location=self.location, email=self.seller.email
+        )
+
+    def test_bulk_add_users(self):
+        self.client.login(username="seller", password="testpassword")
+        url = reverse("bulk_add_users", kwargs={"slug": self.auction.slug})
+        lines = ["Name,Email,Phone,Bidder number,Member"]
+        lines += [f"Person {i},person_{i}@example.com,555-555-{i:04},,yes" for i in range(600)]
+        # already in the auction, twice in this file, a bidder number that's taken and a bad email
+        lines += [
+            "Seller,a@example.com,,,",
+            "Person 1 again,person_1@example.com,,,",
+            f"Taken number,taken@example.com,,{self.seller_tos.bidder_number},",
+            "Bad email,not an email,,,",
+        ]
+        csv_file = SimpleUploadedFile("users.csv", "\n".join(lines).encode(), content_type="text/csv")
+        response = self.client.post(url, {"csv_file": csv_file})
+        assert response.status_code == 302
+        response = self.client.get(url)
+        assert b"import-progress" in response.content
+        batches = 0
+        while self.client.session.get("bulk_add_users_import"):
+            # sqlite splits each bulk_create() into inserts of about 50 rows
+            with self.assertMaxQueries(35):
+                response = self.client.post(url, {"import_batch": "1"})
+            assert response.status_code == 200
+            batches += 1
+        assert batches == 2
+        assert b"Added 600 users" in response.content
+        assert b"2 rows could not be added" in response.content
+        new_tos = AuctionTOS.objects.filter(auction=self.auction, manually_added=True)
+        assert new_tos.count() == 600
+        assert new_tos.filter(is_club_member=True, bidding_allowed=True).count() == 600
+        numbers = list(AuctionTOS.objects.filter(auction=self.auction).values_list("bidder_number", flat=True))
+        assert len(numbers) == len(set(numbers))
+        assert "" not in numbers
+
+    def test_bulk_add_users_without_pickup_location(self):
+        auction = Auction.objects.create(
+            created_by=self.seller, title="No locations", date_start=timezone.now(), date_end=timezone.now()
+        )
+        importer = AuctionTOSImporter(auction)
+        assert importer.add([{"name": "Someone", "email": "someone@example.com"}]) == []
+        assert importer.errors == [importer.no_pickup_location_error]
+        self.client.login(username="seller", password="testpassword")
+        csv_file = SimpleUploadedFile("users.csv", b"Name,Email\nSomeone,someone@example.com", content_type="text/csv")
+        response = self.client.post(
+            reverse("bulk_add_users", kwargs={"slug": auction.slug}), {"csv_file": csv_file}, follow=True
+        )
+        assert importer.no_pickup_location_error in response.content.decode()
+        assert not self.client.session.get("bulk_add_users_import")
+        assert not self.client.session.get("initial_formset_data")
+        assert not AuctionTOS.objects.filter(auction=auction).exists()
+
+
+class RecordPageViewsTests(QueryCountMixin, TestCase):
+    def setUp(self):
+        self.seller = User.objects.create_user(username="seller", password="testpassword", email="a@example.com")
+        self.buyer = User.objects.create_user(username="buyer", password="testpassword", email="b@example.com")
+        self.auction = Auction.objects.create(
+            created_by=self.seller,
+            title="Big auction",
+            date_start=timezone.now() - datetime.timedelta(days=1),
+            date_end=timezone.now() + datetime.timedelta(days=3),
+        )
+        self.category = Category.objects.create(name="Livebearers")
+        self.lots = [
+            Lot.objects.create(
+                lot_name=f"Lot {i}", auction=self.auction, user=self.seller, quantity=1, species_category=self.category
+            )
+            for i in range(5)
+        ]
+        self.users = 0
+
+    def add_users(self, count):
+        for i in range(self.users, self.users + count):
+            User.objects.create(username=f"viewer_{i}", email=f"viewer_{i}@example.com")
+        self.users += count
+
+    def test_record_pageviews(self):
+        lot = self.lots[0]
+        self.client.login(username="buyer", password="testpassword")
+        response = self.client.post(
+            reverse("pageview"),
+            {
+                "url": "/lots/1/?src=x",
+                "lot": lot.pk,
+                "auction": self.auction.pk,
+                "first_view": "true",
+                "referrer": "",
+                "src": "x" * 300,
+            },
+        )
+        assert response.status_code == 200
+        assert PageView.objects.filter(user=self.buyer, lot_number=lot, url="/lots/1/").count() == 1
+        assert len(PageView.objects.get(url="/lots/1/").source) == 200
+        interest = UserInterestCategory.objects.get(user=self.buyer, category=self.category)
+        assert interest.interest == settings.VIEW_WEIGHT
+        for i in range(2):
+            # the same number of queries however many users and views there are
+            self.add_users(10)
+            events = [
+                {
+                    "user": user.pk,
+                    "lot": lot.pk,
+                    "auction": self.auction.pk,
+                    "url": f"/lots/{lot.pk}/",
+                    "ip": "127.0.0.1",
+                }
+                for user in User.objects.all()
+                for lot in self.lots
+            ]
+            # 2 of these are the savepoint around the batch
+            with self.assertMaxQueries(18):
+                record_pageviews(events)
+        interest.refresh_from_db()
+        assert interest.interest == settings.VIEW_WEIGHT * 11
+        assert interest.as_percent == 100
+
+    def test_save_buffered_pageviews(self):
+        # a view that can't be saved is dropped, without losing the rest of its batch
+        events = [{"url": f"/lots/{i}/", "user_agent": "Firefox"} for i in range(5)]
+        events.insert(2, {"url": "/lots/bad/", "user_agent": 5})
+        assert save_events(events) == 5
+        assert PageView.objects.filter(url__startswith="/lots/").count() == 5
+
+
+class LoadGeoIPTests(QueryCountMixin, TestCase):
+    def test_load_geoip(self):
+        continent = Location.objects.create(name="North America")
+        for ip in ["1.2.3.4", "1.2.4.1", "10.0.0.1", "2001:db8::1", "not an ip"]:
+            PageView.objects.create(ip_address=ip)
+        with tempfile.TemporaryDirectory() as folder:
+            ipv4 = Path(folder) / "ipv4.csv"
+            ipv4.write_text(
+                "network,geoname_id,latitude,longitude\n1.2.3.0/24,6252001,38.0,-97.0\n1.2.4.0/24,6252001,40.0,-75.0\n"
+            )
+            ipv6 = Path(folder) / "ipv6.csv"
+            ipv6.write_text("network,geoname_id,latitude,longitude\n2001:db8::/32,2635167,54.0,-2.0\n")
+            locations = Path(folder) / "locations.csv"
+            locations.write_text(
+                "geoname_id,continent_name,country_name\n6252001,North America,United States\n2635167,Europe,United Kingdom\n"
+            )
+            with self.assertMaxQueries(8):
+                call_command(
+                    "load_geoip", blocks=[str(ipv4), str(ipv6)], locations=str(locations), update_pageviews=True
+                )
+        assert IPGeo.objects.get(ip_address="1.2.3.4").location == continent
+        assert IPGeo.objects.get(ip_address="1.2.4.1").latitude == 40
+        assert IPGeo.objects.get(ip_address="2001:db8::1").longitude == -2
+        assert not IPGeo.objects.filter(ip_address="10.0.0.1").exists()
+        assert PageView.objects.get(ip_address="1.2.3.4").latitude == 38
+        # record_pageviews() uses the cache instead of older page views
+        record_pageviews([{"url": "/", "ip": "2001:db8::1"}])
+        assert PageView.objects.filter(ip_address="2001:db8::1", latitude=54).count() == 2
+
+
+class MergeDuplicateViewsTests(QueryCountMixin, TestCase):
+    def setUp(self):
+        self.seller = User.objects.create_user(username="seller", password="testpassword", email="a@example.com")
+        self.buyer = User.objects.create_user(username="buyer", password="testpassword", email="b@example.com")
+
+    def test_merge_duplicate_views(self):
+        for i in range(2):
+            for total_time in [10, 20, 30]:
+                PageView.objects.create(
+                    user=self.buyer, url=f"/lots/{i}/", total_time=total_time, notification_sent=total_time == 20
+                )
+            PageView.objects.create(user=self.seller, url=f"/lots/{i}/")
+            with self.assertMaxQueries(8):
+                assert merge_duplicate_views() == 2
+        view = PageView.objects.get(user=self.buyer, url="/lots/0/")
+        assert view.total_time == 60
+        assert view.counter == 2
+        assert view.notification_sent
+        assert not PageView.objects.filter(duplicate_check_completed=False).exists()
+        # the same page viewed again is counted on the first view
+        event = {"user": self.buyer.pk, "url": "/lots/2/"}
+        record_pageviews([event, event])
+        record_pageviews([event])
+        view = PageView.objects.get(user=self.buyer, url="/lots/2/")
+        assert view.counter == 2
+
+    def test_merge_duplicate_views_without_url(self):
+        lot = Lot.objects.create(lot_name="A lot", user=self.seller, quantity=1)
+        PageView.objects.create(user=self.buyer, url="/lots/1/")
+        for i in range(3):
+            PageView.objects.create(user=self.buyer, lot_number=lot, url=None)
+        assert merge_duplicate_views() == 2
+        assert PageView.objects.get(user=self.buyer, lot_number=lot).counter == 2
+        assert PageView.objects.filter(user=self.buyer).count() == 2
+
+
+class UserInterestTests(QueryCountMixin, TestCase):
+    def setUp(self):
+        self.seller = User.objects.create_user(username="seller", password="testpassword", email="a@example.com")
+        self.buyer = User.objects.create_user(username="buyer", password="testpassword", email="b@example.com")
+        self.auction = Auction.objects.create(
+            created_by=self.seller,
+            title="Big auction",
+            date_start=timezone.now() - datetime.timedelta(days=1),
+            date_end=timezone.now() + datetime.timedelta(days=3),
+        )
+        self.lot = Lot.objects.create(
+            lot_name="A popular lot", auction=self.auction, user=self.seller, quantity=1, reserve_price=2
+        )
+        self.bidders = 0
+        self.add_bidders(10)
+
+    def add_bidders(self, count):
+        """Each bidder bids on self.lot and on a lot of their own"""
+        for i in range(self.bidders, self.bidders + count):
+            bidder = User.objects.create(username=f"bidder_{i}", email=f"bidder_{i}@example.com")
+            Bid.objects.create(user=bidder, lot_number=self.lot, amount=10 + i)
+            open_lot = Lot.objects.create(
+                lot_name=f"Open lot {i}", auction=self.auction, user=self.seller, quantity=1, reserve_price=2
+            )
+            Bid.objects.create(user=bidder, lot_number=open_lot, amount=5)
+        self.bidders += count
+
+    def test_rebuild_user_interest(self):
+        category = Category.objects.create(name="Livebearers")
+        stale = UserInterestCategory.objects.create(
+            user=self.buyer, category=Category.objects.create(name="Plants"), interest=5
+        )
+        for i in range(2):
+            Lot.objects.filter(auction=self.auction).update(species_category=category)
+            PageView.objects.create(user=self.buyer, lot_number=self.lot, counter=2)
+            with self.assertMaxQueries(8):
+                call_command("update_user_interest", stdout=io.StringIO())
+            self.add_bidders(10)
+        interest = UserInterestCategory.objects.get(user=self.buyer, category=category)
+        assert interest.interest == settings.VIEW_WEIGHT * 6
+        assert interest.as_percent == 100
+        assert not UserInterestCategory.objects.filter(pk=stale.pk).exists()
+        bidder = User.objects.get(username="bidder_0")
+        assert UserInterestCategory.objects.get(user=bidder).interest == settings.BID_WEIGHT * 2
+        # only users with activity since the watermark are rebuilt
+        UserInterestCategory.objects.filter(user=bidder).update(interest=1)
+        call_command("update_user_interest", since="2100-01-01", stdout=io.StringIO())
+        assert UserInterestCategory.objects.get(user=bidder).interest == 1
+        Bid.objects.create(user=bidder, lot_number=self.lot, amount=100)
+        call_command("update_user_interest", since=timezone.localdate().isoformat(), stdout=io.StringIO())
+        assert UserInterestCategory.objects.get(user=bidder).interest == settings.BID_WEIGHT * 3
+
+
+class ActivityRollupTests(QueryCountMixin, TestCase):
+    def setUp(self):
+        the_future = timezone.now() + datetime.timedelta(days=3)
+        self.seller = User.objects.create_user(username="seller", password="testpassword", email="a@example.com")
+        self.buyer = User.objects.create_user(username="buyer", password="testpassword", email="b@example.com")
+        self.auction = Auction.objects.create(
+            created_by=self.seller,
+            title="Big auction",
+            date_start=timezone.now() - datetime.timedelta(days=1),
+            date_end=the_future,
+        )
+        self.location = PickupLocation.objects.create(name="location", auction=self.auction, pickup_time=the_future)
+        self.seller_tos = AuctionTOS.objects.create(
+            user=self.seller, auction=self.auction, pickup_location=self.location, is_admin=True
+        )
+        AuctionTOS.objects.create(user=self.buyer, auction=self.auction, pickup_location=self.location)
+        self.lot = Lot.objects.create(
+            lot_name="A popular lot",
+            auction=self.auction,
+            auctiontos_seller=self.seller_tos,
+            user=self.seller,
+            quantity=1,
+            reserve_price=2,
+        )
+
+    def test_rollup_activity(self):
+        for i in range(3):
+            PageView.objects.create(lot_number=self.lot, url="/lots/1/", referrer="google.com", counter=1)
+        PageView.objects.create(auction=self.auction, user=self.buyer, url="/auctions/big-auction/")
+        Watch.objects.create(user=self.buyer, lot_number=self.lot)
+        SearchHistory.objects.create(user=self.buyer, search="guppy", auction=self.auction)
+        LotHistory.objects.create(lot=self.lot, user=self.buyer, changed_price=True, current_price=20)
+        for i in range(2):
+            # the second run recounts the last day, which is split over two transactions
+            with self.assertMaxQueries(24 if i == 0 else 40):
+                call_command("rollup_activity")
+        rollup = ActivityRollup.objects.get(auction=self.auction)
+        assert rollup.views == 4
+        assert rollup.unique_users == 1
+        assert rollup.joins == AuctionTOS.objects.filter(auction=self.auction).count()
+        assert (rollup.bids, rollup.watches, rollup.searches) == (1, 1, 1)
+        assert ActivityRollup.objects.get(auction__isnull=True).views == 4
+        page = PageViewRollup.objects.get(auction=self.auction, referrer="google.com")
+        assert (page.views, page.total_views) == (3, 6)
+        self.client.login(username="seller", password="testpassword")
+        data = self.client.get(reverse("auction_stats_activity", kwargs={"slug": self.auction.slug})).json()
+        views = next(dataset for dataset in data["datasets"] if dataset["label"] == "Views")
+        assert sum(views["data"]) == 4
+        data = self.client.get(reverse("auction_stats_referrers", kwargs={"slug": self.auction.slug})).json()
+        assert "google.com" in data["labels"]
+        # the first bin starts partway through the hour
+        start = rollup.hour + datetime.timedelta(minutes=30)
+        activity = ActivityRollup.objects.filter(auction=self.auction)
+        assert bin_rollups(activity, ["views"], 2, start, start + datetime.timedelta(hours=2)) == [[4, 0]]
+
+    def test_rollup_activity_recounts_repeat_views(self):
+        view = PageView.objects.create(lot_number=self.lot, url="/lots/viewed-again/")
+        PageView.objects.filter(pk=view.pk).update(date_start=timezone.now() - datetime.timedelta(hours=3))
+        call_command("rollup_activity")
+        # viewed again after its hour was counted
+        PageView.objects.filter(pk=view.pk).update(counter=2)
+        call_command("rollup_activity")
+        assert PageViewRollup.objects.get(auction=self.auction, url="/lots/viewed-again/").total_views == 3
+
+
+class BrokenChannelLayer(InMemoryChannelLayer):
+    """A channel layer that can't be reached, like Redis going down"""
+
+    async def receive(self, channel):
+        msg = "Redis is down"
+        raise ConnectionError(msg)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class LotClosingSchedulerTests(TestCase):
+    def setUp(self):
+        time_start = timezone.now() - datetime.timedelta(days=1)
+        the_future = timezone.now() + datetime.timedelta(days=3)
+        self.seller = User.objects.create_user(username="seller", password="testpassword", email="a@example.com")
+        self.bidder = User.objects.create_user(username="bidder", password="testpassword", email="b@example.com")
+        self.auction = Auction.objects.create(
+            created_by=self.seller, title="Online auction", date_start=time_start, date_end=the_future
+        )
+        self.location = PickupLocation.objects.create(name="location", auction=self.auction, pickup_time=the_future)
+        self.seller_tos = AuctionTOS.objects.create(
+            user=self.seller, auction=self.auction, pickup_location=self.location
+        )
+        AuctionTOS.objects.create(user=self.bidder, auction=self.auction, pickup_location=self.location)
+        self.lot = Lot.objects.create(
+            lot_name="A lot", auction=self.auction, auctiontos_seller=self.seller_tos, quantity=1, reserve_price=2
+        )
+        self.later_lot = Lot.objects.create(
+            lot_name="Another lot", auction=self.auction, auctiontos_seller=self.seller_tos, quantity=1
+        )
+        Bid.objects.create(user=self.bidder, lot_number=self.lot, amount=5)
+        self.scheduler = LotClosingScheduler()
+        self.scheduler.load()
+
+    def test_close_due_lots(self):
+        assert self.scheduler.metrics()["scheduled"] == 2
+        assert self.scheduler.seconds_until_next() > 60
+        # the lot was extended, then the auction's end was moved to now
+        Lot.objects.filter(pk=self.lot.pk).update(date_end=timezone.now())
+        self.scheduler.schedule(self.lot.pk, timezone.now().timestamp() + 3600)
+        self.scheduler.schedule(self.lot.pk, timezone.now().timestamp())
+        assert self.scheduler.seconds_until_next() == 0
+        self.scheduler.run_due()
+        lot = Lot.objects.get(pk=self.lot.pk)
+        assert not lot.active
+        assert lot.winner == self.bidder
+        assert Lot.objects.get(pk=self.later_lot.pk).active
+        metrics = self.scheduler.metrics()
+        assert metrics["closed"] == 1
+        assert metrics["scheduled"] == 1
+
+    @override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "auctions.tests.BrokenChannelLayer"}})
+    def test_channel_layer_down(self):
+        async def run_briefly():
+            try:
+                await asyncio.wait_for(self.scheduler.run(), timeout=0.5)
+            except TimeoutError:
+                return True
+
+        # still running when the time is up, instead of exiting on the first error
+        assert async_to_sync(run_briefly)()
@@ -7,10 +7,12 @@ from collections import Counter
 from datetime import datetime, timedelta
 from datetime import timezone as date_tz
 from io import BytesIO, TextIOWrapper
+from itertools import islice
 from random import choice, randint, sample, uniform
 from urllib.parse import unquote, urlencode
 
 import qr_code
+from asgiref.sync import sync_to_async
 from chartjs.colors import next_color
 from chartjs.views.columns import BaseColumnsHighChartsView
 from chartjs.views.lines import BaseLineChartView
@@ -22,8 +24,9 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
 from django.contrib.messages.views import SuccessMessageMixin
 from django.contrib.sites.models import Site
-from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.exceptions import PermissionDenied
 from django.core.files.base import ContentFile
+from django.core.handlers.asgi import ASGIRequest
 from django.db.models import (
     Avg,
     Case,
@@ -49,6 +52,7 @@ from django.http import (
     HttpResponseNotAllowed,
     HttpResponseRedirect,
     JsonResponse,
+    StreamingHttpResponse,
 )
 from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
@@ -75,7 +79,6 @@ from qr_code.qrcode.utils import QRCodeOptions
 from reportlab.platypus import (
     Image as PImage,
 )
-from user_agents import parse
 from webpush import send_user_notification
 from webpush.models import PushInformation
 
@@ -118,12 +121,13 @@ from .forms import (
 )
 from .models import (
     FAQ,
+    ActivityRollup,
     AdCampaign,
     AdCampaignResponse,
     Auction,
-    AuctionCampaign,
     AuctionIgnore,
     AuctionTOS,
+    AuctionTOSImporter,
     Bid,
     BlogPost,
     Category,
@@ -135,6 +139,7 @@ from .models import (
     LotHistory,
     LotImage,
     PageView,
+    PageViewRollup,
     PickupLocation,
     SearchHistory,
     UserBan,
@@ -144,11 +149,20 @@ from .models import (
     UserLabelPrefs,
     Watch,
     add_price_info,
+    add_tos_report_info,
+    buffer_pageview,
+    create_lots,
+    distance_between,
     distance_to,
     find_image,
     guess_category,
+    load_invoices_with_totals,
+    mark_invoices_for_recalculation,
     median_value,
     nearby_auctions,
+    recalculate_dirty_invoices,
+    recalculate_invoices,
+    record_pageviews,
 )
 from .tables import AuctionHTMxTable, AuctionTOSHTMxTable, LotHTMxTable, LotHTMxTableForUsers
 
@@ -246,6 +260,53 @@ def bin_data(
     return counts_list
 
 
+def bin_rollups(rollups, fields, number_of_bins, start_bin, end_bin):
+    """bin_data() for a queryset of ActivityRollup, which are already counted by hour.
+    Each hour goes in the bin that the start of the hour falls in, and the hour that start_bin is part of goes in the first bin.
+    Returns a list of bins for each of `fields`"""
+    bin_size = (end_bin - start_bin).total_seconds() / number_of_bins
+    result = [[0] * number_of_bins for field in fields]
+    first_hour = start_bin.astimezone(date_tz.utc).replace(minute=0, second=0, microsecond=0)
+    for hour, *values in rollups.filter(hour__gte=first_hour, hour__lt=end_bin).values_list("hour", *fields):
+        bin_index = max(0, int((hour - start_bin).total_seconds() // bin_size))
+        for i, value in enumerate(values):
+            result[i][bin_index] += value
+    return result
+
+
+# rows fetched from the database at a time when streaming a CSV file
+CSV_CHUNK_SIZE = 500
+
+
+class Echo:
+    """Just enough of a file for csv.writer to write to, returning each line instead of storing it"""
+
+    def write(self, value):
+        return value
+
+
+async def iterate_in_thread(iterable, chunk_size=CSV_CHUNK_SIZE):
+    """An async iterator over a sync one, reading chunk_size items at a time in Django's sync thread and yielding them joined together.
+    StreamingHttpResponse reads all of a sync iterator into a list before sending any of it when it's served by ASGI"""
+    iterator = iter(iterable)
+    next_chunk = sync_to_async(lambda: list(islice(iterator, chunk_size)))
+    while chunk := await next_chunk():
+        yield "".join(chunk)
+
+
+def csv_response(request, filename, rows):
+    """Stream a CSV download, one line at a time as `rows` (an iterable of lists) is consumed.
+    The download starts before the last row has been read from the database, and only a chunk of rows is held in memory at a time,
+    under ASGI as well, see iterate_in_thread()"""
+    writer = csv.writer(Echo())
+    lines = (writer.writerow(row) for row in rows)
+    if isinstance(request, ASGIRequest):
+        lines = iterate_in_thread(lines)
+    response = StreamingHttpResponse(lines, content_type="text/csv")
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
 class AdminEmailMixin:
     """Add an admin_email value from settings to the context of a request"""
 
@@ -1153,100 +1214,43 @@ def clean_referrer(url):
     return url
 
 
+def pageview_event(request):
+    """The parts of a page view request that record_pageviews() needs, as something that can be put into JSON"""
+    data = request.POST
+    url = data.get("url", None)
+    url_without_params = re.sub(r"\?.*", "", url)
+    ip = ""
+    x_forwarded_for = request.META.get("HTTP_X_FORWARDED_FOR")
+    if x_forwarded_for:
+        ip = x_forwarded_for.split(",")[0]
+    else:
+        ip = request.META.get("REMOTE_ADDR")
+    return {
+        "auction": data.get("auction", None),
+        "lot": data.get("lot", None),
+        "url": url_without_params[:600],
+        # anonymous users go by session
+        "user": request.user.pk if request.user.is_authenticated else None,
+        "session_id": None if request.user.is_authenticated else request.session.session_key,
+        "user_agent": request.META.get("HTTP_USER_AGENT", "")[:200],
+        "referrer": clean_referrer(data.get("referrer", None)[:600]),
+        # the same lengths as PageView.source and UserData.unsubscribe_link
+        "source": (data.get("src") or "")[:200] or None,
+        "uid": (data.get("uid") or "")[:255] or None,
+        "ip": (ip or "")[:100],
+        "title": data.get("title", "")[:600],
+    }
+
+
 def pageview(request):
-    """Record page views"""
+    """Record page views.  With settings.PAGEVIEW_BUFFER they're pushed onto Redis and saved in batches by the flush_pageviews command"""
     if request.method == "POST":
-        data = request.POST
-        auction = data.get("auction", None)
-        if auction:
-            auction = Auction.objects.filter(pk=auction).first()
-        lot_number = data.get("lot", None)
-        if lot_number:
-            lot_number = Lot.objects.filter(pk=lot_number, is_deleted=False).first()
-        url = data.get("url", None)
-        url_without_params = re.sub(r"\?.*", "", url)
-        url_without_params = url_without_params[:600]
-        first_view = data.get("first_view", False)
-        if request.user.is_authenticated:
-            user = request.user
-            session_id = None
-        else:
-            # anonymous users go by session
-            user = None
-            session_id = request.session.session_key
+        first_view = request.POST.get("first_view", False)
         if first_view == "true":  # good ol Javascript
-            user_agent = request.META.get("HTTP_USER_AGENT", "")
-            # platform = 'UNKNOWN'
-            os = "UNKNOWN"
-            parsed_ua = parse(user_agent)
-            # if parsed_ua.is_mobile:
-            #     platform = 'MOBILE'
-            # if parsed_ua.is_tablet:
-            #     platform = 'TABLET'
-            # elif parsed_ua.is_pc:
-            #     platform = 'DESKTOP'
-            user_agent = user_agent[:200]
-            referrer = clean_referrer(data.get("referrer", None)[:600])
-            source = data.get("src", None)
-            uid = data.get("uid", None)
-            # mark auction campaign results if applicable present
-            ip = ""
-            x_forwarded_for = request.META.get("HTTP_X_FORWARDED_FOR")
-            if x_forwarded_for:
-                ip = x_forwarded_for.split(",")[0]
+            if settings.PAGEVIEW_BUFFER:
+                buffer_pageview(pageview_event(request))
             else:
-                ip = request.META.get("REMOTE_ADDR")
-            if uid:  # and not request.user.is_authenticated:
-                userdata = UserData.objects.filter(unsubscribe_link=uid).first()
-                if userdata:
-                    userdata.last_activity = timezone.now()
-                    userdata.save()
-            if source:
-                campaign = AuctionCampaign.objects.filter(uuid=source).first()
-                if campaign and campaign.result == "NONE":
-                    campaign.result = "VIEWED"
-                    campaign.save()
-                if campaign and campaign.user is not None and campaign.auction is not None:
-                    tos = AuctionTOS.objects.filter(user=campaign.user, auction=campaign.auction).first()
-                    if tos:
-                        campaign.result = "JOINED"
-                        campaign.save()
-            PageView.objects.create(
-                lot_number=lot_number,
-                url=url_without_params,
-                auction=auction,
-                session_id=session_id,
-                user=user,
-                user_agent=user_agent,
-                ip_address=ip[:100],
-                platform=parsed_ua.os.family,
-                os=os,
-                referrer=referrer,
-                title=data.get("title", "")[:600],
-                source=source,
-            )
-            if user and lot_number and lot_number.species_category:
-                # create interest in this category if this is a new view for this category
-                interest, created = UserInterestCategory.objects.get_or_create(
-                    category=lot_number.species_category,
-                    user=user,
-                    defaults={"interest": 0},
-                )
-                interest.interest += settings.VIEW_WEIGHT
-                interest.save()
-            if auction and user:
-                if not source:
-                    source = referrer
-                try:
-                    campaign = AuctionCampaign.objects.create(
-                        auction=auction,
-                        user=user,
-                        email=user.email,
-                        source=source,
-                    )
-                except ValidationError:
-                    # campaign already exists
-                    pass
+                record_pageviews([pageview_event(request)])
         # code below would run on subsequent pageviews.  Not worth the extra server effort for an update every 10 seconds.
         # some corresponding js on base_page_view.html is also commented out
         # else:
@@ -1308,54 +1312,48 @@ class UpdateLotPushNotificationsView(APIPostView):
 @login_required
 def my_won_lot_csv(request):
     """CSV file showing won lots"""
-    lots = add_price_info(
-        Lot.objects.filter(Q(winner=request.user) | Q(auctiontos_winner__email=request.user.email)).exclude(
-            is_deleted=True
-        )
+    lots = (
+        Lot.objects.filter(Q(winner=request.user) | Q(auctiontos_winner__email=request.user.email))
+        .exclude(is_deleted=True)
+        .select_related("auction")
     )
     current_site = Site.objects.get_current()
-    response = HttpResponse(content_type="text/csv")
-    response["Content-Disposition"] = (
-        f'attachment; filename="my_won_lots_from_{current_site.domain.replace(".", "_")}.csv"'
-    )
-    writer = csv.writer(response)
-    writer.writerow(["Lot number", "Name", "Auction", "Winning price", "Link"])
-    for lot in lots:
-        writer.writerow(
-            [
+
+    def rows():
+        yield ["Lot number", "Name", "Auction", "Winning price", "Link"]
+        for lot in lots.iterator(chunk_size=CSV_CHUNK_SIZE):
+            yield [
                 lot.lot_number_display,
                 lot.lot_name,
                 lot.auction,
                 f"${lot.winning_price}",
                 "https://" + lot.full_lot_link,
             ]
-        )
-    return response
+
+    return csv_response(request, f"my_won_lots_from_{current_site.domain.replace('.', '_')}.csv", rows())
 
 
 @login_required
 def my_lot_report(request):
     """CSV file showing sold lots"""
     lots = add_price_info(
-        Lot.objects.filter(Q(user=request.user) | Q(auctiontos_seller__email=request.user.email)).exclude(
-            is_deleted=True
-        )
+        Lot.objects.filter(Q(user=request.user) | Q(auctiontos_seller__email=request.user.email))
+        .exclude(is_deleted=True)
+        .select_related("auction")
     )
     current_site = Site.objects.get_current()
-    response = HttpResponse(content_type="text/csv")
-    response["Content-Disposition"] = f'attachment; filename="my_lots_from_{current_site.domain.replace(".", "_")}.csv"'
-    writer = csv.writer(response)
-    writer.writerow(["Lot number", "Name", "Auction", "Status", "Winning price", "My cut"])
-    for lot in lots:
-        status = "Unsold"
-        if lot.banned:
-            status = "Removed"
-        elif lot.deactivated:
-            status = "Deactivated"
-        elif lot.winner or lot.auctiontos_winner:
-            status = "Sold"
-        writer.writerow(
-            [
+
+    def rows():
+        yield ["Lot number", "Name", "Auction", "Status", "Winning price", "My cut"]
+        for lot in lots.iterator(chunk_size=CSV_CHUNK_SIZE):
+            status = "Unsold"
+            if lot.banned:
+                status = "Removed"
+            elif lot.deactivated:
+                status = "Deactivated"
+            elif lot.winner_id or lot.auctiontos_winner_id:
+                status = "Sold"
+            yield [
                 lot.lot_number_display,
                 lot.lot_name,
                 lot.auction,
@@ -1363,8 +1361,8 @@ def my_lot_report(request):
                 lot.winning_price,
                 lot.your_cut,
             ]
-        )
-    return response
+
+    return csv_response(request, f"my_lots_from_{current_site.domain.replace('.', '_')}.csv", rows())
 
 
 @login_required
@@ -1372,13 +1370,21 @@ def auctionReport(request, slug):
     """Get a CSV file showing all users who are participating in this auction"""
     auction = get_object_or_404(Auction, slug=slug, is_deleted=False)
     if auction.permission_check(request.user):
-        # Create the HttpResponse object with the appropriate CSV header.
-        response = HttpResponse(content_type="text/csv")
         end = timezone.now().strftime("%Y-%m-%d")
-        response["Content-Disposition"] = 'attachment; filename="' + slug + "-report-" + end + '.csv"'
-        writer = csv.writer(response)
-        writer.writerow(
-            [
+        users = add_tos_report_info(
+            AuctionTOS.objects.filter(auction=auction)
+            .select_related("user__userdata__club")
+            .select_related("pickup_location")
+            .order_by("createdon"),
+            auction,
+        )
+        invoices = {
+            invoice.auctiontos_user_id: invoice
+            for invoice in load_invoices_with_totals(Invoice.objects.filter(auction=auction).order_by("date"))
+        }
+
+        def rows():
+            yield [
                 "Join date",
                 "Bidder number",
                 "Username",
@@ -1408,76 +1414,60 @@ def auctionReport(request, slug):
                 "Account created on",
                 "Memo",
             ]
-        )
-        users = (
-            AuctionTOS.objects.filter(auction=auction)
-            .select_related("user__userdata")
-            .select_related("pickup_location")
-            .order_by("createdon")
-        )
-        # .annotate(distance_traveled=distance_to(\
-        # '`auctions_userdata`.`latitude`', '`auctions_userdata`.`longitude`', \
-        # lat_field_name='`auctions_pickuplocation`.`latitude`',\
-        # lng_field_name="`auctions_pickuplocation`.`longitude`",\
-        # approximate_distance_to=1)\
-        # )
-        for data in users:
-            distance = ""
-            club = ""
-            if data.user and not data.manually_added:
-                # these things will only be written out if the user wants you to have it
-                lotsViewed = PageView.objects.filter(lot_number__auction=auction, user=data.user)
-                lotsBid = Bid.objects.exclude(is_deleted=True).filter(lot_number__auction=auction, user=data.user)
-                lot_qs = Lot.objects.exclude(is_deleted=True).filter(
-                    user=data.user,
-                    auction__isnull=True,
-                    date_posted__gte=auction.date_start - timedelta(days=2),
-                )
-                if auction.is_online:
-                    lotsOutsideAuction = lot_qs.filter(date_posted__lte=auction.date_end + timedelta(days=2))
+            for data in users.iterator(chunk_size=CSV_CHUNK_SIZE):
+                distance = ""
+                club = ""
+                if data.user and not data.manually_added:
+                    # these things will only be written out if the user wants you to have it
+                    lotsViewed = data.pageview_count
+                    lotsBid = data.bid_count
+                    numberLotsOutsideAuction = data.lots_outside_auction
+                    profitOutsideAuction = data.value_outside_auction
+                    userdata = getattr(data.user, "userdata", None)
+                    distance = -1
+                    if userdata and userdata.latitude:
+                        distance = ""
+                        if data.pickup_location and data.pickup_location.latitude is not None:
+                            distance = distance_between(
+                                userdata.latitude,
+                                userdata.longitude,
+                                data.pickup_location.latitude,
+                                data.pickup_location.longitude,
+                                approximate_distance_to=5,
+                            )
+                    distance = distance or ""
+                    if userdata and userdata.club:
+                        club = userdata.club
+                    username = data.user.username
+                    previous_auctions = data.other_auctions_joined
+                    number_of_userbans = data.userban_count
+                    account_age = data.user.date_joined
                 else:
-                    lotsOutsideAuction = lot_qs.filter(date_posted__lte=auction.date_start + timedelta(days=5))
-                numberLotsOutsideAuction = lotsOutsideAuction.count()
-                profitOutsideAuction = lotsOutsideAuction.aggregate(total=Sum("winning_price"))["total"]
-                if not profitOutsideAuction:
-                    profitOutsideAuction = 0
-                distance = data.distance_traveled or ""
+                    previous_auctions = ""
+                    lotsViewed = ""
+                    lotsBid = ""
+                    numberLotsOutsideAuction = ""
+                    profitOutsideAuction = ""
+                    username = ""
+                    number_of_userbans = 0
+                    account_age = ""
+                address = data.address or ""
+                invoice = invoices.get(data.pk)
                 try:
-                    club = data.user.userdata.club
+                    invoiceStatus = invoice.get_status_display()
+                    totalSpent = invoice.total_bought
+                    totalPaid = invoice.total_sold
+                    invoiceTotal = invoice.rounded_net
+                    grossSold = invoice.total_sold_gross
+                    clubCut = invoice.total_sold_club_cut
                 except:
-                    pass
-                username = data.user.username
-                previous_auctions = AuctionTOS.objects.filter(user=data.user).exclude(pk=data.pk).count()
-                number_of_userbans = data.number_of_userbans
-                account_age = data.user.date_joined
-            else:
-                previous_auctions = ""
-                lotsViewed = ""
-                lotsBid = ""
-                numberLotsOutsideAuction = ""
-                profitOutsideAuction = ""
-                username = ""
-                number_of_userbans = 0
-                account_age = ""
-            lotsSumbitted = Lot.objects.exclude(is_deleted=True).filter(auctiontos_seller=data, auction=auction)
-            lotsWon = Lot.objects.exclude(is_deleted=True).filter(auctiontos_winner=data, auction=auction)
-            breederPoints = Lot.objects.exclude(is_deleted=True).filter(
-                auctiontos_seller=data, auction=auction, i_bred_this_fish=True
-            )
-            address = data.address or ""
-            try:
-                invoice = Invoice.objects.get(auction=auction, auctiontos_user=data)
-                invoiceStatus = invoice.get_status_display()
-                totalSpent = invoice.total_bought
-                totalPaid = invoice.total_sold
-                invoiceTotal = invoice.rounded_net
-            except:
-                invoiceStatus = ""
-                totalSpent = 0
-                totalPaid = 0
-                invoiceTotal = 0
-            writer.writerow(
-                [
+                    invoiceStatus = ""
+                    totalSpent = 0
+                    totalPaid = 0
+                    invoiceTotal = 0
+                    grossSold = 0
+                    clubCut = 0
+                yield [
                     data.createdon.strftime("%m-%d-%Y"),
                     data.bidder_number,
                     username,
@@ -1488,17 +1478,17 @@ def auctionReport(request, slug):
                     data.pickup_location,
                     distance,
                     club,
-                    len(lotsViewed),
-                    len(lotsBid),
-                    len(lotsSumbitted),
-                    len(lotsWon),
+                    lotsViewed,
+                    lotsBid,
+                    data.lots_submitted_count,
+                    data.lots_won_count,
                     invoiceStatus,
                     f"{totalSpent:.2f}",
-                    f"{data.gross_sold:.2f}",
+                    f"{grossSold:.2f}",
                     f"{totalPaid:.2f}",
-                    f"{data.total_club_cut:.2f}",
+                    f"{clubCut:.2f}",
                     f"{invoiceTotal:.2f}",
-                    len(breederPoints),
+                    data.breeder_points_count,
                     numberLotsOutsideAuction,
                     profitOutsideAuction,
                     data.time_spent_reading_rules,
@@ -1507,8 +1497,8 @@ def auctionReport(request, slug):
                     account_age,
                     data.memo,
                 ]
-            )
-        return response
+
+        return csv_response(request, f"{slug}-report-{end}.csv", rows())
     messages.error(request, "Your account doesn't have permission to view this page")
     return redirect("/")
 
@@ -1516,20 +1506,24 @@ def auctionReport(request, slug):
 @login_required
 def userReport(request):
     """Get a CSV file showing all users from all auctions you're an admin for"""
-    response = HttpResponse(content_type="text/csv")
-    response["Content-Disposition"] = "attachment; filename=all_auction_contacts.csv"
-    writer = csv.writer(response)
-    found = []
-    writer.writerow(["Name", "Email", "Phone"])
     auctions = Auction.objects.filter(
         Q(created_by=request.user) | Q(auctiontos__is_admin=True, auctiontos__user=request.user)
     )
-    users = AuctionTOS.objects.filter(auction__in=auctions).exclude(email_address_status="BAD")
-    for user in users:
-        if user.email not in found:
-            writer.writerow([user.name, user.email, user.phone_as_string])
-            found.append(user.email)
-    return response
+    users = (
+        AuctionTOS.objects.filter(auction__in=auctions)
+        .exclude(email_address_status="BAD")
+        .only("name", "email", "phone_number")
+    )
+
+    def rows():
+        found = set()
+        yield ["Name", "Email", "Phone"]
+        for user in users.iterator(chunk_size=CSV_CHUNK_SIZE):
+            if user.email not in found:
+                yield [user.name, user.email, user.phone_as_string]
+                found.add(user.email)
+
+    return csv_response(request, "all_auction_contacts.csv", rows())
 
 
 @login_required
@@ -1537,14 +1531,12 @@ def auctionInvoicesPaypalCSV(request, slug, chunk):
     """Get a CSV file of all unpaid invoices that owe the club money"""
     auction = Auction.objects.get(slug=slug, is_deleted=False)
     if auction.permission_check(request.user):
-        # Create the HttpResponse object with the appropriate CSV header.
-        response = HttpResponse(content_type="text/csv")
         dueDate = timezone.now().strftime("%m/%d/%Y")
         current_site = Site.objects.get_current()
-        response["Content-Disposition"] = f'attachment; filename="{slug}-paypal-{chunk}.csv"'
-        writer = csv.writer(response)
-        writer.writerow(
-            [
+        invoices = recalculate_invoices(auction.paypal_invoices.select_related("auctiontos_user").order_by("pk"))
+
+        def rows():
+            yield [
                 "Recipient Email",
                 "Recipient First Name",
                 "Recipient Last Name",
@@ -1561,33 +1553,29 @@ def auctionInvoicesPaypalCSV(request, slug, chunk):
                 "Terms and Conditions",
                 "Memo to Self",
             ]
-        )
-        invoices = auction.paypal_invoices
-        count = 0
-        chunkSize = 150  # attention: this is also set in models.auction.paypal_invoice_chunks
-        for invoice in invoices:
-            invoice.recalculate
-            # we loop through everything regardless of which chunk
-            if not invoice.user_should_be_paid:
-                count += 1
-                if count <= chunkSize * chunk and count > chunkSize * (chunk - 1):
-                    email = invoice.auctiontos_user.email
-                    firstName = ""
-                    lastName = invoice.auctiontos_user.name
-                    invoiceNumber = invoice.pk
-                    reference = ""
-                    itemName = "Auction total"
-                    description = ""
-                    itemAmount = invoice.absolute_amount
-                    shippingAmount = 0
-                    discountAmount = 0
-                    currencyCode = "USD"
-                    noteToCustomer = f"https://{current_site.domain}/invoices/{invoice.pk}/"
-                    termsAndConditions = ""
-                    memoToSelf = invoice.auctiontos_user.memo
-                    if itemAmount > 0 and email:
-                        writer.writerow(
-                            [
+            count = 0
+            chunkSize = 150  # attention: this is also set in models.auction.paypal_invoice_chunks
+            for invoice in invoices:
+                # we loop through everything regardless of which chunk
+                if not invoice.user_should_be_paid:
+                    count += 1
+                    if count <= chunkSize * chunk and count > chunkSize * (chunk - 1):
+                        email = invoice.auctiontos_user.email
+                        firstName = ""
+                        lastName = invoice.auctiontos_user.name
+                        invoiceNumber = invoice.pk
+                        reference = ""
+                        itemName = "Auction total"
+                        description = ""
+                        itemAmount = invoice.absolute_amount
+                        shippingAmount = 0
+                        discountAmount = 0
+                        currencyCode = "USD"
+                        noteToCustomer = f"https://{current_site.domain}/invoices/{invoice.pk}/"
+                        termsAndConditions = ""
+                        memoToSelf = invoice.auctiontos_user.memo
+                        if itemAmount > 0 and email:
+                            yield [
                                 email,
                                 firstName,
                                 lastName,
@@ -1604,8 +1592,8 @@ def auctionInvoicesPaypalCSV(request, slug, chunk):
                                 termsAndConditions,
                                 memoToSelf,
                             ]
-                        )
-        return response
+
+        return csv_response(request, f"{slug}-paypal-{chunk}.csv", rows())
     messages.error(request, "Your account doesn't have permission to view this page")
     return redirect("/")
 
@@ -1615,10 +1603,6 @@ def auctionLotList(request, slug):
     """Get a CSV file showing all sold lots, who bought/sold them, and the winner's location"""
     auction = Auction.objects.get(slug=slug, is_deleted=False)
     if auction.permission_check(request.user):
-        # Create the HttpResponse object with the appropriate CSV header.
-        response = HttpResponse(content_type="text/csv")
-        response["Content-Disposition"] = 'attachment; filename="' + slug + '-lot-list.csv"'
-        writer = csv.writer(response)
         first_row_fields = [
             "Lot number",
             "Lot",
@@ -1639,33 +1623,37 @@ def auctionLotList(request, slug):
             first_row_fields.append(auction.custom_checkbox_name)
         if auction.custom_field_1 != "disable" and auction.custom_field_1_name:
             first_row_fields.append(auction.custom_field_1_name)
-        writer.writerow(first_row_fields)
-        # lots = Lot.objects.exclude(is_deleted=True).filter(auction__slug=slug, auctiontos_winner__isnull=False).select_related('user', 'winner')
-        lots = auction.lots_qs.filter(winning_price__isnull=False).select_related("user", "winner")
+        lots = auction.lots_qs.filter(winning_price__isnull=False).select_related(
+            "auction", "auctiontos_seller__pickup_location", "auctiontos_winner__pickup_location"
+        )
         lots = add_price_info(lots)
-        for lot in lots:
-            row = [
-                lot.lot_number_display,
-                lot.lot_name,
-                lot.auctiontos_seller.name,
-                lot.auctiontos_seller.email,
-                lot.auctiontos_seller.phone_as_string,
-                lot.location,
-                lot.auctiontos_winner.name,
-                lot.auctiontos_winner.email,
-                lot.auctiontos_winner.phone_as_string,
-                lot.winner_location,
-                lot.i_bred_this_fish_display,
-                f"{lot.winning_price:.2f}",
-                f"{lot.club_cut:.2f}",
-                f"{lot.your_cut:.2f}",
-            ]
-            if auction.use_custom_checkbox_field and auction.custom_checkbox_name:
-                row.append(lot.custom_checkbox_label)
-            if auction.custom_field_1 != "disable" and auction.custom_field_1_name:
-                row.append(lot.custom_field_1)
-            writer.writerow(row)
-        return response
+
+        def rows():
+            yield first_row_fields
+            for lot in lots.iterator(chunk_size=CSV_CHUNK_SIZE):
+                row = [
+                    lot.lot_number_display,
+                    lot.lot_name,
+                    lot.auctiontos_seller.name,
+                    lot.auctiontos_seller.email,
+                    lot.auctiontos_seller.phone_as_string,
+                    lot.location,
+                    lot.auctiontos_winner.name,
+                    lot.auctiontos_winner.email,
+                    lot.auctiontos_winner.phone_as_string,
+                    lot.winner_location,
+                    lot.i_bred_this_fish_display,
+                    f"{lot.winning_price:.2f}",
+                    f"{lot.club_cut:.2f}",
+                    f"{lot.your_cut:.2f}",
+                ]
+                if auction.use_custom_checkbox_field and auction.custom_checkbox_name:
+                    row.append(lot.custom_checkbox_label)
+                if auction.custom_field_1 != "disable" and auction.custom_field_1_name:
+                    row.append(lot.custom_field_1)
+                yield row
+
+        return csv_response(request, f"{slug}-lot-list.csv", rows())
     messages.error(request, "Your account doesn't have permission to view this page")
     return redirect("/")
 
@@ -1940,6 +1928,18 @@ class AuctionUpdate(UpdateView, AuctionPermissionsMixin):
     model = Auction
     template_name = "auction_edit_form.html"
     form_class = AuctionEditForm
+    # changing any of these changes the totals of every invoice in the auction
+    invoice_fields = [
+        "winning_bid_percent_to_club",
+        "winning_bid_percent_to_club_for_club_members",
+        "lot_entry_fee",
+        "lot_entry_fee_for_club_members",
+        "unsold_lot_fee",
+        "pre_register_lot_discount_percent",
+        "first_bid_payout",
+        "invoice_rounding",
+        "tax",
+    ]
 
     def dispatch(self, request, *args, **kwargs):
         self.auction = self.get_object()
@@ -1969,7 +1969,10 @@ class AuctionUpdate(UpdateView, AuctionPermissionsMixin):
         return context
 
     def form_valid(self, form, **kwargs):
+        invoices_changed = any(field in form.changed_data for field in self.invoice_fields)
         form = super().form_valid(form)
+        if invoices_changed:
+            self.object.invoice_recalculate
         if (
             not self.get_object().is_online
             and self.get_object().online_bidding == "buy_now_only"
@@ -2318,7 +2321,7 @@ class DynamicSetLotWinner(AuctionViewMixin, TemplateView):
                 result_lot_qs = self.auction.lots_qs.filter(custom_lot_number=lot)
             else:
                 result_lot_qs = self.auction.lots_qs.filter(lot_number_int=lot)
-            # This can happen if two people are submitting lots at the exact same millisecond.  It seems very unlikely but an easy enough edge case to catch.
+            # Lots created before LotNumberSequence could be given the same number if two people submitted them at the exact same millisecond
             if result_lot_qs.count() > 1:
                 error = "Multiple lots with this lot number.  Go to the lot's page and set the winner there."
             else:
@@ -2554,15 +2557,16 @@ class BulkAddUsers(TemplateView, ContextMixin, AuctionPermissionsMixin):
                     )
                 else:
                     auctiontos = AuctionTOS.objects.filter(auction=other_auction)
+                    importer = AuctionTOSImporter(self.auction)
                     total_skipped = 0
                     total_tos = 0
                     for tos in auctiontos:
-                        if not self.tos_is_in_auction(self.auction, tos.name, tos.email):
+                        if not importer.is_in_auction(tos.name, tos.email):
                             initial_formset_data.append(
                                 {
                                     "bidder_number": tos.bidder_number,
                                     "name": tos.name,
-                                    "phone": tos.phone_number,
+                                    "phone_number": tos.phone_number,
                                     "email": tos.email,
                                     "address": tos.address,
                                     "is_club_member": tos.is_club_member,
@@ -2593,13 +2597,15 @@ class BulkAddUsers(TemplateView, ContextMixin, AuctionPermissionsMixin):
         return self.render_to_response(context)
 
     def handle_csv_file(self, csv_file, *args, **kwargs):
-        """If a CSV file has been uploaded, parse it and redirect"""
+        """If a CSV file has been uploaded, parse it and redirect.
+        Small files are shown in the formset to be checked before they're saved,
+        anything bigger than max_users_that_can_be_added_at_once is added in batches by import_next_batch()"""
 
         def extract_info(row, field_name_list, default_response=""):
             """Pass a row, and a lowercase list of field names
             extract the first match found (case insenstive) and return the value from the row
             emptry string returned if the value is not found in the row"""
-            case_insensitive_row = {k.lower(): v for k, v in row.items()}
+            case_insensitive_row = {k.lower(): v for k, v in row.items() if k}
             for name in field_name_list:
                 try:
                     return case_insensitive_row[name]
@@ -2609,12 +2615,8 @@ class BulkAddUsers(TemplateView, ContextMixin, AuctionPermissionsMixin):
 
         def columns_exist_in_csv(csv_reader, columns):
             """returns True if any value in the list `columns` exists in the file"""
-            first_row = next(csv_reader)
-            result = extract_info(first_row, columns, None)
-            if result is None:
-                return False
-            else:
-                return True
+            fieldnames = [name.lower() for name in csv_reader.fieldnames or [] if name]
+            return any(column in fieldnames for column in columns)
 
         csv_file.seek(0)
         csv_reader = csv.DictReader(TextIOWrapper(csv_file.file))
@@ -2647,51 +2649,99 @@ class BulkAddUsers(TemplateView, ContextMixin, AuctionPermissionsMixin):
             some_columns_exist = True
         if not some_columns_exist:
             error = "Unable to read information from this CSV file.  Make sure it contains an email and name column"
-        total_tos = 0
+        importer = AuctionTOSImporter(self.auction)
+        if not importer.pickup_location:
+            messages.error(self.request, importer.no_pickup_location_error)
+            return redirect(reverse("bulk_add_users", kwargs={"slug": self.auction.slug}))
         total_skipped = 0
-        initial_formset_data = []
+        rows = []
         for row in csv_reader:
-            bidder_number = extract_info(row, bidder_number_fields)
             email = extract_info(row, email_field_names)
             name = extract_info(row, name_field_names)
             phone = extract_info(row, phone_field_names)
             address = extract_info(row, address_field_names)
-            is_club_member = extract_info(row, is_club_member_fields)
-            if (email or name or phone or address) and total_tos <= self.max_users_that_can_be_added_at_once:
-                if self.tos_is_in_auction(self.auction, name, email):
+            if email or name or phone or address:
+                if importer.is_in_auction(name, email):
                     total_skipped += 1
                 else:
-                    total_tos += 1
-                    initial_formset_data.append(
+                    importer.remember(name, email)
+                    rows.append(
                         {
-                            "bidder_number": bidder_number,
+                            "bidder_number": extract_info(row, bidder_number_fields),
                             "name": name,
-                            "phone": phone,
+                            "phone_number": phone,
                             "email": email,
                             "address": address,
-                            "is_club_member": is_club_member,
+                            "is_club_member": extract_info(row, is_club_member_fields),
                         }
                     )
-        # this needs to be added to the session in order to persist when moving from POST (this csv processing) to GET
-        self.request.session["initial_formset_data"] = initial_formset_data
-        if total_tos >= self.max_users_that_can_be_added_at_once:
-            messages.error(
-                self.request,
-                f"You can only add {self.max_users_that_can_be_added_at_once} users at once; run this again to add additional users.",
-            )
-        if total_skipped:
-            messages.info(
-                self.request,
-                f"{total_skipped} users are already in this auction (matched by email, or name if email not set) and do not appear below",
-            )
+        if len(rows) > self.max_users_that_can_be_added_at_once:
+            # too many to check by hand, import_next_batch() is called by the progress bar until they're all added
+            self.request.session["bulk_add_users_import"] = {
+                "auction": self.auction.pk,
+                "rows": rows,
+                "total": len(rows),
+                "added": 0,
+                "skipped": total_skipped,
+                "errors": [],
+            }
+        else:
+            # this needs to be added to the session in order to persist when moving from POST (this csv processing) to GET
+            self.request.session["initial_formset_data"] = rows
+            if total_skipped:
+                messages.info(
+                    self.request,
+                    f"{total_skipped} users are already in this auction (matched by email, or name if email not set) and do not appear below",
+                )
         if error:
             messages.error(self.request, error)
-        if total_tos:
-            self.extra_rows = total_tos
         # note that regardless of whether this is valid or not, we redirect to the same page after parsing the CSV file
         return redirect(reverse("bulk_add_users", kwargs={"slug": self.auction.slug}))
 
+    @property
+    def pending_import(self):
+        """A large CSV file that's being added in batches, see handle_csv_file()"""
+        pending = self.request.session.get("bulk_add_users_import")
+        if pending and pending["auction"] == self.auction.pk:
+            return pending
+        return None
+
+    def import_next_batch(self):
+        """Called over and over by the HTMX progress bar, adds the next batch of rows from a large CSV file"""
+        pending = self.pending_import
+        if not pending:
+            return HttpResponse("")
+        importer = AuctionTOSImporter(self.auction)
+        importer.add(pending["rows"][: importer.batch_size])
+        pending["rows"] = pending["rows"][importer.batch_size :]
+        pending["added"] += importer.added
+        pending["skipped"] += importer.skipped
+        pending["errors"] += importer.errors
+        if pending["rows"]:
+            self.request.session["bulk_add_users_import"] = pending
+        else:
+            del self.request.session["bulk_add_users_import"]
+        return render(
+            self.request,
+            "auctions/bulk_add_users_progress.html",
+            {"auction": self.auction, "progress": self.import_progress(pending)},
+        )
+
+    def import_progress(self, pending):
+        remaining = len(pending["rows"])
+        return {
+            "total": pending["total"],
+            "done": pending["total"] - remaining,
+            "remaining": remaining,
+            "percent": int((pending["total"] - remaining) / pending["total"] * 100),
+            "added": pending["added"],
+            "skipped": pending["skipped"],
+            "errors": pending["errors"],
+        }
+
     def post(self, request, *args, **kwargs):
+        if request.POST.get("import_batch"):
+            return self.import_next_batch()
         csv_file = request.FILES.get("csv_file", None)
         if csv_file:
             return self.handle_csv_file(csv_file)
@@ -2724,19 +2774,10 @@ class BulkAddUsers(TemplateView, ContextMixin, AuctionPermissionsMixin):
             .distinct()
             .order_by("-date_posted")[:10]
         )
+        if self.pending_import:
+            context["import_progress"] = self.import_progress(self.pending_import)
         return context
 
-    def tos_is_in_auction(self, auction, name, email):
-        """Return the tos if the name or email are already present in the auction, otherwise None"""
-        qs = AuctionTOS.objects.filter(auction=auction)
-        if email:
-            qs = qs.filter(email=email)
-        elif name:
-            qs = qs.filter(Q(name=name, email=None) | Q(name=name, email=""))
-        else:
-            return None
-        return qs.first()
-
     def dispatch(self, request, *args, **kwargs):
         self.auction = Auction.objects.exclude(is_deleted=True).filter(slug=kwargs.pop("slug")).first()
         if not self.auction:
@@ -2803,6 +2844,7 @@ class BulkAddLots(TemplateView, ContextMixin, AuctionPermissionsMixin):
         )
         if lot_formset.is_valid():
             lots = lot_formset.save(commit=False)
+            new_lots = []
             for lot in lots:
                 lot.auctiontos_seller = self.tos
                 lot.auction = self.auction
@@ -2818,13 +2860,16 @@ class BulkAddLots(TemplateView, ContextMixin, AuctionPermissionsMixin):
                         # we need to set lot.user here
                         if self.tos.user:
                             lot.user = self.tos.user
-                lot.save()
+                    new_lots.append(lot)
+                else:
+                    lot.save()
+            create_lots(new_lots)
             if lots:
                 messages.success(self.request, f"Updated lots for {self.tos.name}")
                 invoice, created = Invoice.objects.get_or_create(
                     auctiontos_user=self.tos, auction=self.auction, defaults={}
                 )
-                invoice.recalculate
+                invoice.mark_for_recalculation()
             # when saving labels, it doesn't take you off from the page you're on
             # So we need to go somewhere, and then say "download labels"
             if "print" in str(self.request.GET.get("type", "")):
@@ -3361,7 +3406,7 @@ class LotValidation(LoginRequiredMixin):
                 invoice, created = Invoice.objects.get_or_create(
                     auctiontos_user=auctiontos, auction=lot.auction, defaults={}
                 )
-                invoice.recalculate
+                invoice.mark_for_recalculation()
         else:
             # this lot is NOT part of an auction
             try:
@@ -4568,6 +4613,8 @@ class Invoices(ListView, LoginRequiredMixin):
         qs = Invoice.objects.filter(
             Q(auctiontos_user__user=self.request.user) | Q(auctiontos_user__email=self.request.user.email)
         ).order_by("-date")
+        # totals are shown on this page
+        recalculate_dirty_invoices(qs)
         return qs
 
     def get_context_data(self, **kwargs):
@@ -4703,12 +4750,11 @@ class InvoiceView(DetailView, FormMixin, AuctionPermissionsMixin):
             form_kwargs={"invoice": self.get_object()}, queryset=self.queryset
         )
         helper = InvoiceAdjustmentFormSetHelper()
+        # always show an up to date total here, even if the recalculate_invoices command hasn't got to this invoice yet
+        self.object.recalculate
         context = self.get_context_data(object=self.object)
         context["formset"] = invoice_adjustment_formset
         context["helper"] = helper
-        # recaluclating slows things down,
-        # I am not sure if it's a good idea to have it here or not
-        self.object.recalculate
         return self.render_to_response(context)
 
 
@@ -4900,11 +4946,18 @@ class LotLabelView(TemplateView, WeasyTemplateResponseMixin, AuctionPermissionsM
         labels_per_column = int(available_height // (context["label_height"] + context["label_margin_bottom"]))
         context["labels_per_page"] = labels_per_row * labels_per_column
 
-        labels = self.get_queryset()
+        labels = list(
+            self.get_queryset().select_related(
+                "auctiontos_winner__pickup_location", "auctiontos_seller", "user", "winner", "species_category"
+            )
+        )
+        # nothing else about these lots changes, so this is one UPDATE instead of a save() for each of them
+        Lot.objects.filter(pk__in=[label.pk for label in labels]).update(
+            label_printed=True, label_needs_reprinting=False
+        )
         for label in labels:
-            label.label_printed = True
-            label.label_needs_reprinting = False
-            label.save()
+            # every label is in this auction, sharing it means its fields are read once instead of once per label
+            label.auction = self.auction
 
         # First column width is fixed at 0.63 for most labels and overridden for large and thermal
         # context['first_column_width'] = (context['label_width'] / 4)
@@ -4943,7 +4996,8 @@ class LotLabelView(TemplateView, WeasyTemplateResponseMixin, AuctionPermissionsM
                 label_second_column_fields.append(getattr(label, field))
             label.first_column_fields = label_first_column_fields
             label.second_column_fields = label_second_column_fields
-        context["labels"] = (["empty"] * context["empty_labels"]) + list(labels)
+        context["labels"] = (["empty"] * context["empty_labels"]) + labels
+        context["multi_location"] = self.auction.multi_location
         context["text_area_width"] = context["label_width"] - context["first_column_width"]
         context["description_font_size"] = int(context["font_size"] * 0.7)
         context["first_column_font_size"] = int(context["font_size"] * 0.8)
@@ -5048,10 +5102,8 @@ class InvoiceBulkUpdateStatus(TemplateView, FormMixin, AuctionPermissionsMixin):
 
     def post(self, request, *args, **kwargs):
         invoices = self.get_queryset()
-        for invoice in invoices:
-            invoice.status = self.new_invoice_status
-            invoice.recalculate
-            invoice.save()
+        mark_invoices_for_recalculation(invoices)
+        invoices.update(status=self.new_invoice_status)
         return HttpResponse("<script>location.reload();</script>", status=200)
 
 
@@ -5590,12 +5642,13 @@ class AdminDashboard(TemplateView):
             context["last_activity_days"].append((timezone.now() - day["day"]).days)
             context["last_activity_count"].append(day["c"])
         seven_days_ago = timezone.now() - timedelta(days=7)
-        page_view_qs = PageView.objects.filter(date_end__gte=seven_days_ago)
+        # counted hourly by the rollup_activity command
+        page_view_qs = PageViewRollup.objects.filter(auction__isnull=True, hour__gte=seven_days_ago)
         context["page_views"] = (
             page_view_qs.values("url", "title")
             .annotate(
-                unique_view_count=Count("url"),
-                total_view_count=Sum("counter") + F("unique_view_count"),
+                unique_view_count=Sum("views"),
+                total_view_count=Sum("total_views"),
             )
             .order_by("-total_view_count")[:100]
         )
@@ -5610,7 +5663,7 @@ class AdminDashboard(TemplateView):
         context["referrers"] = (
             referrers.values("referrer", "url", "title")
             .annotate(
-                total_clicks=Count("referrer"),
+                total_clicks=Sum("views"),
                 # total_view_count=Sum('counter') + F('unique_view_count')
             )
             .order_by("-total_clicks")[:100]
@@ -5983,25 +6036,15 @@ class AuctionStatsActivityJSONView(BaseLineChartView, AuctionStatsPermissionsMix
         return ["Views", "Joins", "New lots", "Searches", "Bids", "Watches"]
 
     def get_data(self):
-        """Wonder if these qs should be properties of the Auction model...
+        """Counted from ActivityRollup, see the rollup_activity command
         Might add invoice views here, but it would require updating the pageview model to have an invoice field similar to how auction and lot currently work"""
-
-        views = PageView.objects.filter(Q(auction=self.auction) | Q(lot_number__auction=self.auction))
-        joins = AuctionTOS.objects.filter(auction=self.auction)
-        new_lots = Lot.objects.filter(auction=self.auction)
-        searches = SearchHistory.objects.filter(auction=self.auction)
-        bids = LotHistory.objects.filter(lot__auction=self.auction, changed_price=True)
-        watches = Watch.objects.filter(lot_number__auction=self.auction)
-
-        # what follows is a delightful reminder of how important a consistent naming scheme is
-        return [
-            bin_data(views, "date_start", self.bins, self.date_start, self.date_end),
-            bin_data(joins, "createdon", self.bins, self.date_start, self.date_end),
-            bin_data(new_lots, "date_posted", self.bins, self.date_start, self.date_end),
-            bin_data(searches, "createdon", self.bins, self.date_start, self.date_end),
-            bin_data(bids, "timestamp", self.bins, self.date_start, self.date_end),
-            bin_data(watches, "createdon", self.bins, self.date_start, self.date_end),
-        ]
+        return bin_rollups(
+            ActivityRollup.objects.filter(auction=self.auction),
+            ["views", "joins", "lots", "searches", "bids", "watches"],
+            self.bins,
+            self.date_start,
+            self.date_end,
+        )
 
 
 class AuctionStatsAttritionJSONView(BaseLineChartView, AuctionStatsPermissionsMixin):
@@ -6150,12 +6193,13 @@ class AuctionStatsLotSellPricesJSONView(AuctionStatsBarChartJSONView):
 class AuctionStatsReferrersJSONView(AuctionStatsBarChartJSONView):
     def get_labels(self):
         self.views = (
-            PageView.objects.filter(Q(auction=self.auction) | Q(lot_number__auction=self.auction))
+            PageViewRollup.objects.filter(auction=self.auction)
             .exclude(referrer__isnull=True)
             .exclude(referrer__startswith="auction.fish")
             .exclude(referrer__exact="")
             .values("referrer")
-            .annotate(count=Count("referrer"))
+            .annotate(count=Sum("views"))
+            .order_by()
         )
         result = []
         for view in self.views:
@@ -25,7 +25,11 @@ while True:
 END
 
 # Run migrations and start the server
-python manage.py migrate --no-input
+# don't start on a half migrated database, a migration that stops (like 0177 when bidder numbers are shared) says why
+if ! python manage.py migrate --no-input; then
+    echo "Migrations failed, not starting fishauctions" >&2
+    exit 1
+fi
 python manage.py collectstatic --no-input > /dev/null 2>&1
 
 if [ "${DEBUG}" = "True" ]; then
@@ -36,6 +40,10 @@ else
     echo Starting fishauctions in production mode
     crontab /etc/cron.d/django-cron
     service cron start
+    # close lots the moment they end, endauctions in the crontab is the fallback
+    python manage.py closelots > /proc/1/fd/1 2>&1 &
+    # save page views in batches when PAGEVIEW_BUFFER is set, see views.pageview
+    python manage.py flush_pageviews > /proc/1/fd/1 2>&1 &
     #exec daphne -b 0.0.0.0 -p 8000 fishauctions.asgi:application
     exec gunicorn fishauctions.asgi:application -k uvicorn.workers.UvicornWorker -w 8 -b 0.0.0.0:8000
 fi
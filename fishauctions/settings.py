@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 import datetime
 import os
 import sys
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -119,20 +120,16 @@ LOGGING = {
     },
 }
 
+REDIS_URL = (
+    "redis://:" + os.environ.get("REDIS_PASSWORD", "unsecure") + "@" + os.environ.get("REDIS_HOST", "redis") + ":6379/0"
+)
+
 # Channels
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
-            "hosts": [
-                (
-                    "redis://:"
-                    + os.environ.get("REDIS_PASSWORD", "unsecure")
-                    + "@"
-                    + os.environ.get("REDIS_HOST", "redis")
-                    + ":6379/0"
-                )
-            ],
+            "hosts": [REDIS_URL],
             # "hosts": [('127.0.0.1', 6379)],
             "capacity": 2000,  # default 100
             "expiry": 20,  # default 60
@@ -140,6 +137,13 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Token bucket limits on websocket frames, per user per lot.  See auctions.consumers.WebsocketRateLimiter
+# capacity is how many frames can be sent in a burst, rate is how many more are allowed per second after that
+WEBSOCKET_RATE_LIMITS = {
+    "bid": {"capacity": 5, "rate": 1},
+    "chat": {"capacity": 5, "rate": 0.5},
+}
+
 # Application definition
 INSTALLED_APPS = [
     "auctions",
@@ -276,6 +280,11 @@ if "test" in sys.argv:
         "default": {
             "ENGINE": "django.db.backends.sqlite3",
             "NAME": BASE_DIR / "db.sqlite3",
+            # take the write lock at the start of each transaction so that concurrent bids queue up
+            # the same way they do with select_for_update() in MySQL; this needs a file, not an in-memory db
+            "OPTIONS": {"transaction_mode": "IMMEDIATE", "timeout": 20},
+            # kept out of the repo, test runs leave the file and its journal behind
+            "TEST": {"NAME": Path(tempfile.gettempdir()) / "fishauctions_test_db.sqlite3"},
         }
     }
 else:
@@ -408,6 +417,9 @@ INTERNAL_IPS = [
     #    '127.0.0.1', # uncomment this to enable the django debug toolbar
 ]
 
+# Push page views onto Redis and save them in batches with the flush_pageviews command, instead of saving each one in /api/pageview/
+PAGEVIEW_BUFFER = os.environ.get("PAGEVIEW_BUFFER", "False") == "True"
+
 VIEW_WEIGHT = 1
 BID_WEIGHT = 10
 WEIGHT_AGAINST_TOP_INTEREST = 20
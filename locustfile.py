@@ -1,35 +1,215 @@
+"""
+Load tests for the closing minutes of an auction.
+
+Needs `pip install locust websocket-client`.  Seed an auction to test against, then point locust at the site:
+    python manage.py seed_load_test --lots 200 --bidders 100 --output loadtest.json
+    locust --host https://example.com
+Set LOAD_TEST_FIXTURE if the fixture isn't ./loadtest.json.  Use http:// hosts for local testing, websockets follow the host's scheme
+
+Bid to broadcast latency is the number that matters most: it's reported as "bid to broadcast" in locust's stats,
+and p50/p95/p99 are logged when the test stops.
+"""
+
+import itertools
+import json
+import logging
+import os
+import random
 import time
+from pathlib import Path
+
+import gevent
+from locust import HttpUser, between, events, task
+from websocket import WebSocketConnectionClosedException, create_connection
+
+logger = logging.getLogger(__name__)
+
+with Path(os.environ.get("LOAD_TEST_FIXTURE", "loadtest.json")).open() as f:
+    FIXTURE = json.load(f)
+
+# every simulated bidder logs in as a different seeded user
+bidder_accounts = itertools.cycle(FIXTURE["bidders"])
+# admins set winners on lots in order, like the person at the front of the room
+lots_to_sell = itertools.cycle(FIXTURE["lots"])
+# seconds between sending a bid and seeing it broadcast, for the report at the end
+bid_latencies = []
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, round(percent / 100 * (len(values) - 1)))
+    return values[index]
 
-from locust import HttpUser, between, task
 
+@events.test_stop.add_listener
+def report_bid_latency(environment, **kwargs):
+    if not bid_latencies:
+        logger.warning("No bids were broadcast")
+        return
+    logger.info("Bid to broadcast latency over %s bids:", len(bid_latencies))
+    for percent in [50, 95, 99]:
+        logger.info("  p%s: %.0f ms", percent, percentile(bid_latencies, percent) * 1000)
 
-class QuickstartUser(HttpUser):
-    # note: use ws:// for testing, wss requires ssl
-    wsurl = "wss://example.com/ws/lots"  # no trailing /
-    wait_time = between(1, 10)
-    lot_to_bid_on = 1234
-    lot_start_pk = 1110
-    lot_end_pk = 1115
+
+class SiteUser(HttpUser):
+    abstract = True
+
+    @property
+    def csrf_headers(self):
+        return {"X-CSRFToken": self.client.cookies.get("csrftoken", ""), "Referer": self.host}
+
+    def login(self, username):
+        self.client.get("/login/", name="/login")
+        self.client.post(
+            "/login/",
+            data={"login": username, "password": FIXTURE["password"]},
+            headers=self.csrf_headers,
+            name="/login",
+        )
+
+
+class AnonymousBrowser(SiteUser):
+    """Someone refreshing the lot list and looking at lots without logging in"""
+
+    weight = 5
+    wait_time = between(1, 5)
+
+    def on_start(self):
+        self.lots = FIXTURE["lots"]
 
     @task
     def lot_list(self):
-        self.client.get("/lots")
+        self.client.get(f"/lots/?auction={FIXTURE['auction']}", name="/lots")
+        self.pageview(url="/lots/", first_view="true")
 
     @task(3)
     def view_lot(self):
-        for lot in range(self.lot_start_pk, self.lot_end_pk):
-            # ws = create_connection(f"{self.wsurl}/{lot}/")
-            self.client.get(f"/lots/{lot}", name="/lot")
-            time.sleep(1)
-            # ws.close()
-
-    # @task(10)
-    # def bid(self):
-    #     self.client.post("/login", json={"username":"tester", "password":"1234"})
-    #     ws = create_connection(f"{self.wsurl}/{self.lot_to_bid_on}/")
-    #     ws.send('{"bid":10}')
-    #     result = ws.recv()
-    #     ws.close()
+        lot = random.choice(self.lots)
+        self.client.get(f"/lots/{lot['pk']}/", name="/lots/<pk>")
+        self.pageview(url=f"/lots/{lot['pk']}/", lot=lot["pk"], first_view="true")
+        # the page keeps reporting how long it's been looked at
+        self.pageview(url=f"/lots/{lot['pk']}/", lot=lot["pk"], first_view="false")
+
+    def pageview(self, **data):
+        data.setdefault("referrer", "")
+        self.client.post("/api/pageview/", data=data, headers=self.csrf_headers, name="/api/pageview")
+
+
+class WebsocketBidder(SiteUser):
+    """A logged in user sitting on a lot page: chatting, and bidding against everyone else on that lot"""
+
+    weight = 3
+    wait_time = between(2, 10)
 
     def on_start(self):
-        pass
+        self.account = next(bidder_accounts)
+        self.login(self.account["username"])
+        self.price = 0
+        self.my_bid = 0
+        self.bid_sent_at = None
+        self.ws = None
+        self.connect(random.choice(FIXTURE["lots"]))
+
+    def on_stop(self):
+        self.disconnect()
+
+    def connect(self, lot):
+        self.disconnect()
+        url = self.host.replace("http", "ws", 1) + f"/ws/lots/{lot['pk']}/"
+        cookie = "; ".join(f"{name}={value}" for name, value in self.client.cookies.items())
+        started = time.time()
+        try:
+            self.ws = create_connection(url, cookie=cookie, origin=self.host)
+        except Exception as e:
+            events.request.fire(
+                request_type="WS", name="connect", response_time=0, response_length=0, exception=e, context={}
+            )
+            return
+        events.request.fire(
+            request_type="WS",
+            name="connect",
+            response_time=(time.time() - started) * 1000,
+            response_length=0,
+            exception=None,
+            context={},
+        )
+        self.price = 0
+        self.my_bid = 0
+        self.receiver = gevent.spawn(self.receive)
+
+    def disconnect(self):
+        if self.ws:
+            self.receiver.kill()
+            self.ws.close()
+            self.ws = None
+
+    def receive(self):
+        while self.ws:
+            try:
+                message = self.ws.recv()
+            except WebSocketConnectionClosedException:
+                return
+            data = json.loads(message)
+            if data.get("current_high_bid") and data.get("info") != "INFO":
+                self.price = max(self.price, int(data["current_high_bid"]))
+            if self.bid_sent_at and ("error" in data or data.get("info") not in (None, "CHAT")):
+                # the first bid result after sending a bid is (nearly always) the one for this bid
+                latency = time.time() - self.bid_sent_at
+                self.bid_sent_at = None
+                name = "bid rejected" if "error" in data else "bid to broadcast"
+                if name == "bid to broadcast":
+                    bid_latencies.append(latency)
+                events.request.fire(
+                    request_type="WS",
+                    name=name,
+                    response_time=latency * 1000,
+                    response_length=len(message),
+                    exception=None,
+                    context={},
+                )
+
+    @task(10)
+    def bid(self):
+        if not self.ws:
+            return
+        # escalating bids, sometimes with a proxy bid well above the current price
+        increment = max(1, self.price // 20)
+        amount = max(self.price + increment, self.my_bid + 1) + random.choice([0, 0, 0, 1, 5])
+        self.my_bid = amount
+        self.bid_sent_at = time.time()
+        self.ws.send(json.dumps({"bid": amount}))
+
+    @task(2)
+    def chat(self):
+        if self.ws:
+            self.ws.send(json.dumps({"message": random.choice(["Nice fish", "Still available?", "Going up!"])}))
+
+    @task(1)
+    def change_lot(self):
+        self.connect(random.choice(FIXTURE["lots"]))
+
+
+class AuctionAdmin(SiteUser):
+    """Someone at the front of the room entering winners with DynamicSetLotWinner"""
+
+    fixed_count = 1
+    wait_time = between(3, 8)
+
+    def on_start(self):
+        self.login(FIXTURE["admin"])
+        self.url = f"/auctions/{FIXTURE['auction']}/lots/set-winners/"
+        self.client.get(self.url, name="/auctions/<slug>/lots/set-winners")
+
+    @task
+    def sell_lot(self):
+        lot = next(lots_to_sell)
+        winner = random.choice(FIXTURE["bidders"])["bidder_number"]
+        data = {"lot": lot["lot_number"], "price": random.randint(2, 40), "winner": winner}
+        # the page validates as each field is typed, then saves
+        for action in ["validate", "validate", "save"]:
+            self.client.post(
+                self.url,
+                data={**data, "action": action},
+                headers=self.csrf_headers,
+                name=f"/auctions/<slug>/lots/set-winners ({action})",
+            )